@@ -29,12 +29,13 @@ class DB(object):
     def __init__(self, **kwargs):
         pass
 
-    def create(self, conn_str: str, *, is_pool=True, **kwargs):
+    def create(self, conn_str: str, *, is_pool=True, pool_size: int = 0, **kwargs):
         """
         创建一个数据库连接
         :param conn_str:
         :param kwargs:
             is_pool 是否使用链接池模式
+            pool_size 有界连接池大小 大于0时启用 仅支持mysql oracle
         :return:
         """
         if conn_str is None:
@@ -42,6 +43,8 @@ class DB(object):
 
         # 收集参数
         kwargs["is_pool"] = is_pool
+        if pool_size:
+            kwargs["pool_size"] = pool_size
 
         # 处理#号密码bug  使用随机字符串替换#
         #
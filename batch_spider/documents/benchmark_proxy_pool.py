@@ -0,0 +1,87 @@
+# coding:utf8
+"""
+代理池获取代理性能测试
+
+    本地启动http服务提供代理文件 测试不同代理池大小 选择方式下 ProxyPool.get 每秒调用次数
+    python benchmark_proxy_pool.py
+"""
+import os
+import tempfile
+import threading
+import time
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+from batch_spider.share.network.proxy import ProxyPool
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(directory: str) -> HTTPServer:
+    handler = lambda *args, **kwargs: QuietHandler(*args, directory=directory, **kwargs)
+    server = HTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def benchmark(proxy_source_url: str, seconds: float = 1, **kwargs) -> float:
+    """
+        统计 seconds 秒内 get 的调用次数
+    Args:
+        proxy_source_url:
+        seconds:
+        **kwargs: ProxyPool 参数
+
+    Returns:
+        每秒调用次数
+    """
+    proxy_pool = ProxyPool(proxy_source_url=proxy_source_url, **kwargs)
+    # 预热 完成首次加载
+    proxy_pool.get()
+    count = 0
+    start_ts = time.time()
+    end_ts = start_ts + seconds
+    while 1:
+        for _ in range(1000):
+            proxy_pool.get()
+        count += 1000
+        if time.time() > end_ts:
+            break
+    calls = count / (time.time() - start_ts)
+    proxy_pool.close()
+    return calls
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    server = start_server(directory)
+    print("{:>8} {:>10} {:>12} {:>14}".format("size", "mode", "check_valid", "calls/s"))
+    for size in [10, 100, 1000, 10000]:
+        filename = "benchmark_proxy_{}.txt".format(size)
+        with open(os.path.join(directory, filename), "w") as f:
+            for i in range(size):
+                f.write("10.{}.{}.{}:8080\n".format(i >> 16 & 255, i >> 8 & 255, i & 255))
+        proxy_source_url = "http://127.0.0.1:{}/{}".format(server.server_port, filename)
+        for select_mode in ["queue", "p2c", "weighted"]:
+            for check_valid in [False, True]:
+                calls = benchmark(
+                    proxy_source_url,
+                    select_mode=select_mode,
+                    check_valid=check_valid,
+                    # 不做网络检测 不限制使用次数 仅测试代理池本身的开销
+                    valid_timeout=-1,
+                    max_proxy_use_num=0,
+                    local_proxy_file_cache_timeout=0,
+                )
+                print(
+                    "{:>8} {:>10} {:>12} {:>14.0f}".format(
+                        size, select_mode, str(check_valid), calls
+                    )
+                )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
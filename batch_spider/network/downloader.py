@@ -2,14 +2,16 @@
 """
 下载器
 """
+import functools
 import io
 import os
 import time
 import random
+from contextlib import contextmanager
 from urllib.parse import quote as urlquote
 from urllib.parse import urljoin
 from collections import deque
-from typing import List, Optional, Dict, AnyStr, Union
+from typing import List, Optional, Dict, AnyStr, Union, Tuple, Iterable, Iterator
 
 try:
     import pycurl
@@ -25,6 +27,7 @@ try:
     from hyper.contrib import HTTP20Adapter
 except:
     HTTP20Adapter = None
+import gevent.queue
 import requests
 import requests_ftp
 from requests.models import Response as requestsResponse
@@ -37,6 +40,8 @@ requests_ftp.monkeypatch_session()
 from batch_spider import util
 from batch_spider.utils import log
 from batch_spider.network import proxy
+from batch_spider.network.sink import FileSink
+from batch_spider.share.utils.requests import response_to_file
 
 logger = log.get_logger(__file__)
 
@@ -188,6 +193,139 @@ default_user_agent_pool = UserAgentPool()
 default_cookie_pool = CookiePool()
 
 
+@functools.lru_cache(maxsize=1024)
+def _format_header_key(key: str) -> str:
+    """headers统一转换为大写开头 同 util.format_headers"""
+    return "-".join([x.capitalize() for x in key.split("-")])
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_cookie_str(cookies_str: str) -> Tuple:
+    """
+        解析cookie字符串 a=1;b=2
+    Args:
+        cookies_str:
+
+    Returns:
+        ((key, value), ...) 缓存结果不可变 使用时转换为dict
+    """
+    return tuple(
+        tuple(x.split("=", maxsplit=1)) for x in cookies_str.split(";") if x.strip()
+    )
+
+
+class CurlHandlePool(object):
+    """
+    可复用的 curl easy handle 池
+        handle 归还时 reset 清空选项并清除 cookie 保留连接缓存 DNS缓存 TLS会话 下次请求同一主机(或经同一代理)时复用连接
+        所有 handle 通过 CurlShare 共享 DNS TLS会话 连接缓存
+        同一时刻一个 handle 只被一个线程/协程使用 用完即归还 空闲 handle 最多保留 max_idle 个
+    """
+
+    def __init__(self, curl_module, max_idle: int = 1000, share_connection: bool = True):
+        """
+
+        Args:
+            curl_module: pycurl 或 geventcurl
+            max_idle: 最大空闲 handle 数
+            share_connection: 是否共享连接缓存 用于 multi handle 时应关闭 由 multi 管理连接 否则每个主机最大连接数限制不生效
+        """
+        self.curl_module = curl_module
+        self.max_idle = max_idle
+        self._idle = deque()
+        self.share = None
+        try:
+            share = pycurl.CurlShare()
+            for lock_data in ("LOCK_DATA_DNS", "LOCK_DATA_SSL_SESSION", "LOCK_DATA_CONNECT"):
+                if lock_data == "LOCK_DATA_CONNECT" and not share_connection:
+                    continue
+                # LOCK_DATA_CONNECT 需要 libcurl>=7.57
+                if hasattr(pycurl, lock_data):
+                    try:
+                        share.setopt(pycurl.SH_SHARE, getattr(pycurl, lock_data))
+                    except pycurl.error:
+                        pass
+            self.share = share
+        except Exception as e:
+            logger.warning("CurlShare 不可用: {}".format(e))
+
+    def get(self):
+        try:
+            return self._idle.pop()
+        except IndexError:
+            pass
+        c = self.curl_module.Curl()
+        if self.share is not None:
+            # reset 不会清除 SHARE 选项 仅在创建时设置
+            c.setopt(pycurl.SHARE, self.share)
+        return c
+
+    def put(self, c, discard: bool = False):
+        """
+            归还 handle
+        Args:
+            c:
+            discard: 直接关闭 请求异常时连接状态未知 不再复用
+
+        Returns:
+
+        """
+        if not discard and len(self._idle) < self.max_idle:
+            try:
+                # cookie 不随 reset 清除 需手动清除 避免串到其他请求
+                c.setopt(pycurl.COOKIELIST, "ALL")
+                c.reset()
+                self._idle.append(c)
+                return
+            except Exception as e:
+                logger.debug("curl handle reset error: {}".format(e))
+        try:
+            c.close()
+        except Exception:
+            pass
+        return
+
+    @contextmanager
+    def handle(self):
+        c = self.get()
+        try:
+            yield c
+        except BaseException:
+            self.put(c, discard=True)
+            raise
+        else:
+            self.put(c)
+
+    def close(self):
+        while self._idle:
+            self.put(self._idle.pop(), discard=True)
+        if self.share is not None:
+            try:
+                self.share.close()
+            except Exception:
+                pass
+            self.share = None
+        return
+
+
+class _MultiWaiter(object):
+    """
+    GeventCurl 在请求完成时调用 switch 失败时调用 throw 此处转为放入完成队列
+    """
+
+    __slots__ = ("queue", "curl")
+
+    def __init__(self, queue, curl):
+        self.queue = queue
+        self.curl = curl
+
+    def switch(self, value):
+        self.queue.put((self.curl, None))
+
+    def throw(self, exception):
+        self.queue.put((self.curl, exception))
+
+
 class Downloader(object):
     """
     定制
@@ -212,8 +350,12 @@ class Downloader(object):
         h2: bool = False,
         use_pycurl: bool = False,
         use_gevent_pycurl: bool = False,
+        reuse_curl: bool = True,
         use_default_headers: bool = True,
         format_headers: bool = True,
+        headers: Dict = None,
+        cookies: Dict = None,
+        copy_meta: bool = True,
         **kwargs
     ):
         """
@@ -232,8 +374,12 @@ class Downloader(object):
             h2: 是否使用http/2协议
             use_pycurl: 是否使用pycurl下载 仅支持多线程 不支持协程
             use_gevent_pycurl: 是否使用gevent pycurl下载 仅支持多线程 不支持协程
+            reuse_curl: pycurl下载时是否复用 curl handle 复用连接 DNS缓存 TLS会话 默认True
             use_default_headers: 是否使用default_headers
             format_headers: 是否自动格式化header 默认 True
+            headers: 公共headers 与 default_headers 合并 初始化时格式化一次 优先级低于每次请求传入的headers
+            cookies: 公共cookies 优先级低于每次请求的cookie
+            copy_meta: response.meta 中是否复制 headers cookies 关闭后直接引用本次请求的参数 减少复制开销
             **kwargs:
         """
         super().__init__()
@@ -258,6 +404,10 @@ class Downloader(object):
         self.h2 = h2
         self.use_pycurl = use_pycurl
         self.use_gevent_pycurl = use_gevent_pycurl
+        self.reuse_curl = reuse_curl
+        self._curl_handle_pool: CurlHandlePool = None
+        # download_many 使用的 handle 池
+        self._multi_curl_handle_pool: CurlHandlePool = None
 
         # http请求超时时间
         self.timeout = timeout
@@ -284,27 +434,45 @@ class Downloader(object):
         self.use_default_headers = use_default_headers
         # 是否格式化headers
         self.format_headers = format_headers
+        # 下载到文件时每次写入的数据块大小
+        self.sink_chunk_size = 64 * 1024
+        # 视为代理不可用的状态码 其他状态码均视为代理可用 用于代理评分
+        self.proxy_fail_status_codes = frozenset([403, 407, 429, 502, 503, 504])
+        # 公共 headers cookies
+        self.headers = headers or {}
+        self.cookies = cookies or {}
+        # response.meta 是否复制 headers cookies
+        self.copy_meta = copy_meta
+        # headers模版 default_headers(不含User-Agent) 与 self.headers 合并并格式化后的结果 首次请求时生成
+        self._header_template: Dict = None
         # 多余参数
         self.kwargs = kwargs
 
         # requests 支持的参数列表
-        self.requests_module_kwargs = [
-            "params",
-            "data",
-            "json",
-            "headers",
-            "cookies",
-            "files",
-            "auth",
-            "timeout",
-            "allow_redirects",
-            "proxies",
-            "verify",
-            "stream",
-            "cert",
-        ]
+        self.requests_module_kwargs = frozenset(
+            [
+                "params",
+                "data",
+                "json",
+                "headers",
+                "cookies",
+                "files",
+                "auth",
+                "timeout",
+                "allow_redirects",
+                "proxies",
+                "verify",
+                "stream",
+                "cert",
+            ]
+        )
 
     def close(self):
+        for _handle_pool in (self._curl_handle_pool, self._multi_curl_handle_pool):
+            if _handle_pool:
+                _handle_pool.close()
+        self._curl_handle_pool = None
+        self._multi_curl_handle_pool = None
         if self.cookie_pool:
             self.cookie_pool.close()
         if self.user_agent_pool:
@@ -320,6 +488,37 @@ class Downloader(object):
         }
         return headers
 
+    def _get_headers(self) -> Dict:
+        """
+            根据模版生成本次请求的headers 仅需复制模版并设置User-Agent
+        Returns:
+
+        """
+        if type(self).default_headers is not Downloader.default_headers:
+            # 子类自定义了 default_headers 无法缓存
+            headers = self.default_headers if self.use_default_headers else {}
+            headers.update(self.headers)
+            return self._format_headers(headers)
+        if self._header_template is None:
+            headers = {}
+            if self.use_default_headers:
+                headers = self.default_headers
+                # User-Agent 每次请求从ua池获取 模版中仅占位 保持headers顺序不变
+                headers["User-Agent"] = None
+            headers.update(self.headers)
+            self._header_template = self._format_headers(headers)
+        headers = self._header_template.copy()
+        if headers.get("User-Agent", "") is None:
+            headers["User-Agent"] = (
+                self.user_agent_pool.get() if self.user_agent_pool else ""
+            )
+        return headers
+
+    def _format_headers(self, headers: Dict) -> Dict:
+        if not self.format_headers:
+            return headers
+        return {_format_header_key(k): v for k, v in headers.items()}
+
     def convert_http_protocol(
         self, request: Union[Dict, AnyStr]
     ) -> Union[Dict, AnyStr]:
@@ -366,7 +565,7 @@ class Downloader(object):
         method = kwargs.get("method", "GET")
 
         # 处理headers
-        default_headers = self.default_headers if self.use_default_headers else {}
+        default_headers = self._get_headers()
         # 处理cookie
         _cookie = ""
         _cookies = {}
@@ -381,12 +580,8 @@ class Downloader(object):
         # 用户调用 优先级最高
         headers = kwargs.pop("headers", {})
         if headers:
-            default_headers.update(headers)
-        kwargs["headers"] = (
-            util.format_headers(default_headers)
-            if self.format_headers
-            else default_headers
-        )
+            default_headers.update(self._format_headers(headers))
+        kwargs["headers"] = default_headers
 
         # 处理https验证
         if "verify" not in kwargs:
@@ -410,16 +605,17 @@ class Downloader(object):
         if "cookies" not in kwargs:
             cookies_str = kwargs["headers"].get("Cookie", "")
             cookies_str += ";" + (_session or self.session).headers.get("Cookie", "")
-            kwargs["cookies"] = dict(
-                [x.split("=", maxsplit=1) for x in cookies_str.split(";") if x.strip()]
-            )
-            kwargs["cookies"].update(_cookies)
+            cookies = dict(self.cookies)
+            cookies.update(_parse_cookie_str(cookies_str))
+            cookies.update(_cookies)
+            kwargs["cookies"] = cookies
+        elif self.cookies:
+            kwargs["cookies"] = {**self.cookies, **kwargs["cookies"]}
         #
 
         # 处理多余参数
-        for key in list(kwargs.keys()):
-            if key not in self.requests_module_kwargs:
-                kwargs.pop(key)
+        for key in [key for key in kwargs if key not in self.requests_module_kwargs]:
+            kwargs.pop(key)
 
         # 下载
         if ("data" in kwargs or "json" in kwargs) and method == "GET":
@@ -454,12 +650,13 @@ class Downloader(object):
                     response = requests.request(method, url, **kwargs)
         return response
 
-    def _download_by_pycurl(self, method, url, **kwargs) -> requestsResponse:
+    def _download_by_pycurl(self, method, url, sink=None, **kwargs) -> requestsResponse:
         """
             使用pycurl下载
         Args:
             method:
             url:
+            sink: 响应内容直接写入 sink 不缓存在内存中
             **kwargs:
 
         Returns:
@@ -469,8 +666,56 @@ class Downloader(object):
         if self.use_gevent_pycurl:
             _pycurl = geventcurl
         #
-
+        if self.reuse_curl:
+            if self._curl_handle_pool is None:
+                self._curl_handle_pool = CurlHandlePool(_pycurl)
+            with self._curl_handle_pool.handle() as c:
+                return self._perform_pycurl(c, _pycurl, method, url, sink=sink, **kwargs)
         c = _pycurl.Curl()
+        try:
+            return self._perform_pycurl(c, _pycurl, method, url, sink=sink, **kwargs)
+        finally:
+            c.close()
+
+    def _perform_pycurl(
+        self, c, _pycurl, method, url, sink=None, **kwargs
+    ) -> requestsResponse:
+        """
+            设置下载参数并执行请求
+        Args:
+            c: curl handle
+            _pycurl: pycurl 或 geventcurl
+            method:
+            url:
+            sink:
+            **kwargs:
+
+        Returns:
+
+        """
+        response_headers_buffer, buffer = self._setup_pycurl(
+            c, _pycurl, method, url, sink=sink, **kwargs
+        )
+        # 发送下载请求
+        c.perform()
+        return self._build_pycurl_response(
+            c, _pycurl, url, response_headers_buffer, buffer
+        )
+
+    def _setup_pycurl(self, c, _pycurl, method, url, sink=None, **kwargs) -> Tuple:
+        """
+            设置下载参数
+        Args:
+            c: curl handle
+            _pycurl: pycurl 或 geventcurl
+            method:
+            url:
+            sink: 响应内容写入 sink 此时响应内容buffer为None
+            **kwargs:
+
+        Returns:
+            (响应头buffer, 响应内容buffer)
+        """
         # 设置下载参数
         c.setopt(_pycurl.CUSTOMREQUEST, method)
         c.setopt(_pycurl.URL, requote_uri(url))
@@ -518,23 +763,43 @@ class Downloader(object):
         # buffer response headers
         response_headers_buffer = io.BytesIO()
         c.setopt(_pycurl.HEADERFUNCTION, response_headers_buffer.write)
-        # buffer内容
-        buffer = io.BytesIO()
-        c.setopt(_pycurl.WRITEDATA, buffer)
+        if sink is not None:
+            # 边下载边写入 内存占用仅为一个数据块
+            buffer = None
+            c.setopt(_pycurl.WRITEFUNCTION, sink.write)
+        else:
+            # buffer内容
+            buffer = io.BytesIO()
+            c.setopt(_pycurl.WRITEDATA, buffer)
         # http/2支持
         if self.h2:
             c.setopt(_pycurl.HTTP_VERSION, _pycurl.CURL_HTTP_VERSION_2_0)
 
-        # TODO 支持stream
+        return response_headers_buffer, buffer
 
-        # 发送下载请求
-        c.perform()
+    def _build_pycurl_response(
+        self, c, _pycurl, url, response_headers_buffer, buffer
+    ) -> requestsResponse:
+        """
+            请求完成后 构造requests的Response对象
+        Args:
+            c: curl handle
+            _pycurl: pycurl 或 geventcurl
+            url:
+            response_headers_buffer:
+            buffer: 为None时内容已写入sink
 
-        # 构造requests的Response对象
+        Returns:
+
+        """
         r = requestsResponse()
         r.status_code = c.getinfo(_pycurl.RESPONSE_CODE)
-        r._content = buffer.getvalue()
-        r.raw = buffer
+        if buffer is None:
+            r._content = b""
+            r._content_consumed = True
+        else:
+            r._content = buffer.getvalue()
+            r.raw = buffer
         # 解析headers
         r_headers = {}
         for line in (
@@ -549,46 +814,105 @@ class Downloader(object):
             r.url = urljoin(url, r.headers["location"])
         else:
             r.url = url
-        c.close()
         return r
 
     @util.retry_decorator(Exception)
-    def _download(self, request, **kwargs) -> requestsResponse:
+    def _download(self, request, sink=None, **kwargs) -> requestsResponse:
         """
             下载
         Args:
             request:
+            sink: 响应内容分块写入 sink(如 FileSink) 不缓存在内存中 response.content 为空
             **kwargs:
 
         Returns:
 
         """
+        if sink is not None:
+            # 重试时从头写入
+            sink.reset()
+            kwargs["stream"] = True
+        # 代理是否由代理池分配 仅此时向代理池报告使用结果
+        proxy_from_pool = (
+            self.proxy_enable
+            and "proxies" not in kwargs
+            and not (isinstance(request, dict) and "proxies" in request)
+        )
         # 整理参数
         _session, method, url, kwargs = self.prepare_request(request, **kwargs)
         # 下载
         _download_start = time.time()
-        if self.use_pycurl or self.use_gevent_pycurl:
-            response = self._download_by_pycurl(method, url, **kwargs)
-        else:
-            response = self._download_by_requests(method, url, _session, **kwargs)
+        try:
+            if self.use_pycurl or self.use_gevent_pycurl:
+                response = self._download_by_pycurl(method, url, sink=sink, **kwargs)
+            else:
+                response = self._download_by_requests(method, url, _session, **kwargs)
+                if sink is not None:
+                    try:
+                        response_to_file(response, sink, chunk_size=self.sink_chunk_size)
+                    finally:
+                        response.close()
+                    response._content = b""
+        except Exception:
+            if proxy_from_pool:
+                self._report_proxy(kwargs.get("proxies"), success=False)
+            raise
         _download_end = time.time()
+        if proxy_from_pool:
+            self._report_proxy(
+                kwargs.get("proxies"),
+                success=response.status_code not in self.proxy_fail_status_codes,
+                latency=_download_end - _download_start,
+            )
+        self._record_response_meta(response, _download_start, _download_end, **kwargs)
+        if not kwargs["stream"]:
+            response.close()
+        return response
+
+    def _report_proxy(self, proxies, *, success: bool, latency: float = None):
+        """
+            向代理池报告代理使用结果 用于代理评分
+        Args:
+            proxies:
+            success:
+            latency:
+
+        Returns:
 
-        # 记录使用的属性
+        """
+        report = getattr(self.proxy_pool, "report", None)
+        if report is None or not proxies:
+            return
+        try:
+            report(proxies, success=success, latency=latency)
+        except Exception as e:
+            logger.debug("report proxy error: {}".format(e))
+        return
+
+    def _record_response_meta(self, response, start: float, end: float, **kwargs):
+        """
+            记录下载使用的属性
+        Args:
+            response:
+            start: 下载开始时间
+            end: 下载结束时间
+            **kwargs: 下载参数
+
+        Returns:
+
+        """
+        headers, cookies = kwargs["headers"], kwargs["cookies"]
+        if self.copy_meta:
+            headers, cookies = headers.copy(), cookies.copy()
         response.meta = {
             "proxies": kwargs.get("proxies", None),
-            "headers": kwargs["headers"].copy(),
-            "cookies": kwargs["cookies"].copy(),
-            "time": {
-                "start": _download_start,
-                "end": _download_end,
-                "use": _download_end - _download_start,
-            },
+            "headers": headers,
+            "cookies": cookies,
+            "time": {"start": start, "end": end, "use": end - start},
         }
         # 兼容
         response.proxies = kwargs.get("proxies", None)
-        if not kwargs["stream"]:
-            response.close()
-        return response
+        return
 
     def download(self, request, **kwargs):
         response = None
@@ -619,6 +943,148 @@ class Downloader(object):
             return response, exception
         return response
 
+    def download_to_file(
+        self, request, file_path: str, *, hash_name: str = "md5", **kwargs
+    ):
+        """
+            下载到文件 响应内容边下载边写入 内存占用与文件大小无关
+            下载失败或状态码异常时不保存文件
+            response.sink.size 文件大小 response.sink.hexdigest 文件hash  response.sink.mmap() 读取文件
+        Args:
+            request:
+            file_path: 文件路径
+            hash_name: hash算法 为空则不计算
+            **kwargs: 同 download
+
+        Returns:
+            同 download
+        """
+        sink = FileSink(file_path, hash_name=hash_name)
+        result = self.download(request, sink=sink, **kwargs)
+        response = result[0] if self.with_exception else result
+        if response is not None and response:
+            sink.commit()
+        else:
+            # 下载异常或状态码异常
+            sink.abort()
+        if response is not None:
+            response.sink = sink
+        return result
+
+    def download_many(
+        self,
+        request_list: Iterable,
+        *,
+        concurrency: int = 1000,
+        max_host_connections: int = 0,
+        **kwargs
+    ) -> Iterator[Tuple]:
+        """
+            批量下载 所有请求在同一个 curl multi handle 中并发执行 按完成顺序返回
+            http/2 (h2=True) 时同一主机的请求复用连接多路传输
+            不需要为每个请求启动协程 适合大量并发 需安装pycurl
+            tips:
+                1、下载失败不重试 不做http/https转换
+                2、超时使用 timeout 参数 对每个请求单独计时
+        Args:
+            request_list: url 或 {"url": ""} 的可迭代对象 按需取出 可以是生成器
+            concurrency: 最大同时进行的请求数
+            max_host_connections: 每个主机最大连接数 0不限制
+            **kwargs: 同 download
+
+        Returns:
+            迭代器 (request, response, exception)
+        """
+        if pycurl is None or geventcurl is None:
+            raise Exception("download_many need: pip install pycurl")
+        if self._multi_curl_handle_pool is None:
+            self._multi_curl_handle_pool = CurlHandlePool(pycurl, share_connection=False)
+        handle_pool = self._multi_curl_handle_pool
+        multi = geventcurl.GeventCurl()
+        if max_host_connections:
+            multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, max_host_connections)
+        if self.h2 and hasattr(pycurl, "PIPE_MULTIPLEX"):
+            multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+        # 完成的请求由 GeventCurl 通过 waiter 通知
+        done_queue = gevent.queue.Queue()
+        # curl handle -> (request, url, 下载参数, 开始时间, 响应头buffer, 响应内容buffer)
+        active = {}
+        request_iter = iter(request_list)
+        try:
+            while 1:
+                while len(active) < concurrency:
+                    request = next(request_iter, None)
+                    if request is None:
+                        break
+                    try:
+                        self._add_multi_request(
+                            multi, handle_pool, done_queue, active, request, **kwargs
+                        )
+                    except Exception as e:
+                        logger.error("download exception: {}".format(e))
+                        yield request, None, e
+                if not active:
+                    break
+                c, exception = done_queue.get()
+                request, url, _kwargs, start, response_headers_buffer, buffer = active.pop(c)
+                multi.remove_handle(c)
+                del c.waiter
+                response = None
+                if exception is None:
+                    response = self._build_pycurl_response(
+                        c, pycurl, url, response_headers_buffer, buffer
+                    )
+                    self._record_response_meta(response, start, time.time(), **_kwargs)
+                    if not response and self.show_fail_log:
+                        logger.error(
+                            "download failed: {} {}".format(
+                                response.status_code, response.url
+                            )
+                        )
+                else:
+                    logger.error("download exception: {}".format(exception))
+                handle_pool.put(c, discard=exception is not None)
+                yield request, response, exception
+        finally:
+            # 迭代被中断时 清理未完成的请求
+            for c in active:
+                try:
+                    multi.remove_handle(c)
+                except Exception:
+                    pass
+                handle_pool.put(c, discard=True)
+            multi.close()
+
+    def _add_multi_request(
+        self, multi, handle_pool, done_queue, active: dict, request, **kwargs
+    ):
+        """
+            将请求加入 multi handle
+        Args:
+            multi: GeventCurl
+            handle_pool: CurlHandlePool
+            done_queue: 完成队列
+            active: 进行中的请求
+            request:
+            **kwargs:
+
+        Returns:
+            curl handle
+        """
+        _session, method, url, _kwargs = self.prepare_request(request, **kwargs)
+        c = handle_pool.get()
+        try:
+            response_headers_buffer, buffer = self._setup_pycurl(
+                c, pycurl, method, url, **_kwargs
+            )
+        except BaseException:
+            handle_pool.put(c, discard=True)
+            raise
+        c.waiter = _MultiWaiter(done_queue, c)
+        active[c] = (request, url, _kwargs, time.time(), response_headers_buffer, buffer)
+        multi.add_handle(c)
+        return c
+
 
 if __name__ == "__main__":
     pass
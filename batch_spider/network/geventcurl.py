@@ -62,6 +62,16 @@ class GeventCurl(object):
         curl = getattr(curl, "_obj", curl)
         self._obj.remove_handle(curl)
 
+    def close(self):
+        """停止所有 watcher 及定时器 并关闭 multi handle"""
+        if self._timeout is not None:
+            self._timeout.stop()
+            self._timeout = None
+        for watcher in self._watchers.values():
+            watcher.stop()
+        self._watchers.clear()
+        self._obj.close()
+
     def _set_socket(self, event, fd, multi, data):
         """Called by libcurl when it wants to change the file descriptors it cares about."""
         # pycurl's event happen to match libev's event
@@ -0,0 +1,116 @@
+# coding:utf8
+"""
+下载内容写入文件
+
+    响应内容分块直接写入文件 同时计算hash 不在内存中缓存完整内容 适合大文件下载
+
+    response = downloader.download_to_file(url, "a.pdf")
+    sink = response.sink
+    print(sink.size, sink.hexdigest)
+    with sink.mmap() as data:
+        data[:4]
+
+    tips:
+        1、下载过程中写入 file_path + ".part" commit 时重命名 失败时 abort 删除 不会留下不完整的文件
+        2、下载重试时会调用 reset 从头写入
+"""
+import hashlib
+import mmap
+import os
+from contextlib import contextmanager
+
+
+class FileSink(object):
+    def __init__(self, file_path: str, *, hash_name: str = "md5"):
+        """
+
+        Args:
+            file_path: 文件路径
+            hash_name: hashlib 支持的算法名 为空则不计算
+        """
+        self.file_path = file_path
+        self.part_file_path = file_path + ".part"
+        self.hash_name = hash_name
+        self.size = 0
+        self._hash = None
+        self._file = None
+        self.reset()
+
+    def reset(self):
+        """
+            清空已写入的内容 重新开始
+        Returns:
+
+        """
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.part_file_path, "wb")
+        self._hash = hashlib.new(self.hash_name) if self.hash_name else None
+        self.size = 0
+        return
+
+    def write(self, chunk: bytes):
+        """
+            写入一块数据 可直接作为 pycurl WRITEFUNCTION
+        Args:
+            chunk:
+
+        Returns:
+
+        """
+        self._file.write(chunk)
+        if self._hash is not None:
+            self._hash.update(chunk)
+        self.size += len(chunk)
+        return None
+
+    @property
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest() if self._hash is not None else ""
+
+    def commit(self):
+        """
+            写入完成 重命名为目标文件
+        Returns:
+
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.replace(self.part_file_path, self.file_path)
+        return
+
+    def abort(self):
+        """
+            放弃写入 删除临时文件
+        Returns:
+
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            try:
+                os.remove(self.part_file_path)
+            except OSError:
+                pass
+        return
+
+    @contextmanager
+    def mmap(self):
+        """
+            以 mmap 方式只读打开已完成的文件 供解析使用 按需加载 不占用进程内存
+            with sink.mmap() as data:
+                data.find(b"%%EOF")
+        Returns:
+
+        """
+        with open(self.file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # 空文件无法 mmap
+                yield b""
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield data
+            finally:
+                data.close()
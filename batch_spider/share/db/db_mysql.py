@@ -9,18 +9,24 @@ MySQLdb 好像不会 但是有机器环境依赖......
 """
 import json
 import copy
+import os
 import time
 import datetime
+import tempfile
 from collections import OrderedDict, defaultdict
-from typing import List, Tuple
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
 
 import pymysql
+import pymysql.cursors
 
 try:
     import MySQLdb
+    import MySQLdb.cursors
 except ImportError:
     MySQLdb = None
 
+from batch_spider.share.db.pool import ConnectionPool
 from batch_spider.share.utils import log
 
 # 定义需要捕获的异常
@@ -166,10 +172,47 @@ class Cursor(object):
         #     raise e
         return result
 
+    def executemany(self, sql, args, retry=0):
+        """
+            同 execute 连接超时等错误时自动重连
+        Args:
+            sql:
+            args:
+            retry:
+
+        Returns:
+
+        """
+        try:
+            result = self.cursor.executemany(sql, args)
+        except catch_error as e:
+            if retry < 20 and e.args[0] in (
+                2006,
+                2013,
+                "cursor closed",
+                "Cursor closed",
+            ):
+                self.logger.debug("mysql连接错误:{}  重连中...".format(e))
+                time.sleep(retry * 5)
+                # 重连 保留原游标的 max_stmt_length 设置
+                max_stmt_length = getattr(self.cursor, "max_stmt_length", None)
+                mysql_conn = get_mysql_conn(self.setting_dict, **self.kwargs)
+                self.cursor = mysql_conn.cursor()
+                self.conn = mysql_conn
+                if max_stmt_length:
+                    self.cursor.max_stmt_length = max_stmt_length
+                return self.executemany(sql, args, retry=retry + 1)
+            raise e
+        return result
+
 
 class MySQLOpt(object):
     # 连接池 共用
     connection_list = {}
+    # 有界连接池 setting key => ConnectionPool 仅 pool_size 大于0时使用
+    connection_pool_dict = {}
+    # max_allowed_packet 缓存 setting key => size
+    max_allowed_packet_dict = {}
 
     def __init__(self, setting_dict, **kwargs):
         """
@@ -177,8 +220,13 @@ class MySQLOpt(object):
             setting_dict: mysql连接参数字典
             **kwargs:
                 is_pool: 是否使用连接池模式
+                pool_size: 有界连接池大小 大于0时启用
+                    共用对象每次操作从连接池取出连接 操作完成后归还
+                    copy() 得到的对象独占一个连接池中的连接 close() 时归还
+                    相同连接参数的对象共用一个连接池 全部 close() 后连接池才关闭
         """
         self.is_pool = kwargs.pop("is_pool", True)
+        self.pool_size = kwargs.pop("pool_size", 0)
 
         # 额外参数
         self.kwargs = kwargs
@@ -193,6 +241,18 @@ class MySQLOpt(object):
         # 私有变量
         self._conn = None
         self._cursor = None
+        self._pool: ConnectionPool = None
+        # 是否持有连接池的引用 close时释放 最后一个持有者释放时关闭连接池
+        self._pool_acquired = False
+        if self.pool_size > 0:
+            self._pool = MySQLOpt.connection_pool_dict.get(self.key)
+            if self._pool is None or not self._pool.acquire():
+                self._pool = ConnectionPool(
+                    self.get_cursor, max_size=self.pool_size, logger=self.logger
+                )
+                self._pool.acquire()
+                MySQLOpt.connection_pool_dict[self.key] = self._pool
+            self._pool_acquired = True
 
     def __del__(self):
         try:
@@ -218,7 +278,10 @@ class MySQLOpt(object):
 
         """
         if not self._cursor:
-            if not self.is_pool or self.key not in MySQLOpt.connection_list.keys():
+            if self._pool is not None:
+                # 从连接池中取出一个连接 close时归还
+                self._cursor = self._pool.checkout()
+            elif not self.is_pool or self.key not in MySQLOpt.connection_list.keys():
                 self._cursor = self.get_cursor()
                 if self.is_pool:
                     MySQLOpt.connection_list[self.key] = self._cursor
@@ -241,6 +304,30 @@ class MySQLOpt(object):
         )
         return cursor
 
+    @contextmanager
+    def cursor_context(self, new_cursor: bool = False):
+        """
+            获取本次操作使用的游标
+                连接池模式下的共用对象 每次从连接池取出连接 操作完成后归还 多个协程可以并发操作
+                其他情况使用 self.cursor
+        Args:
+            new_cursor: 非连接池模式下 是否在当前连接上新建一个游标 用完后关闭
+
+        Returns:
+
+        """
+        if self._pool is not None and self.is_pool:
+            with self._pool.connection() as _cursor:
+                yield _cursor
+        elif new_cursor and self._pool is None:
+            _cursor = self.get_cursor(connection=self.conn)
+            try:
+                yield _cursor
+            finally:
+                _cursor.close()
+        else:
+            yield self.cursor
+
     @staticmethod
     def handle_values(data, keys=None, strip=True) -> OrderedDict:
         """
@@ -332,7 +419,8 @@ class MySQLOpt(object):
             }
         )
         try:
-            self.cursor.execute(sql)
+            with self.cursor_context() as _cursor:
+                _cursor.execute(sql)
             resp = 0
         except Exception as e:
             if ignore_duplicate and "Duplicate entry" in str(e):
@@ -413,7 +501,8 @@ class MySQLOpt(object):
                     }
                 )
                 try:
-                    rows = self.cursor.execute(sql)
+                    with self.cursor_context() as _cursor:
+                        rows = _cursor.execute(sql)
                     self.logger.debug("insert rows {}".format(rows))
                     resp = 0
                 except Exception as e:
@@ -427,6 +516,198 @@ class MySQLOpt(object):
             return resp, error_data
         return resp
 
+    @staticmethod
+    def to_db_value(value):
+        """
+            转换为参数化sql可接受的值 字典 列表等转换为json字符串
+        Args:
+            value:
+
+        Returns:
+
+        """
+        if isinstance(value, (dict, list, tuple, set)):
+            if isinstance(value, set):
+                value = list(value)
+            return json.dumps(value, ensure_ascii=False)
+        return value
+
+    def get_max_allowed_packet(self) -> int:
+        """
+            获取 max_allowed_packet 结果会被缓存
+        Returns:
+
+        """
+        if self.key not in MySQLOpt.max_allowed_packet_dict:
+            size = 1024 * 1024
+            try:
+                _r = self.query_all("show variables like 'max_allowed_packet';")
+                if _r:
+                    size = int(_r[0][1])
+            except Exception as e:
+                self.logger.exception(e)
+            MySQLOpt.max_allowed_packet_dict[self.key] = size
+        return MySQLOpt.max_allowed_packet_dict[self.key]
+
+    def insert_many(
+        self,
+        data: list,
+        *,
+        table_name: str = "",
+        batch: int = 10000,
+        group_by_keys: bool = False,
+        ignore_duplicate: bool = True,
+        **kwargs,
+    ) -> int:
+        """
+            批量保存数据 参数化 executemany 方式
+            相比 add_many:
+                1、不复制数据 不拼接转义sql  由驱动将 executemany 改写为多行insert
+                2、单条sql的长度根据 max_allowed_packet 自动调整
+                3、字符串不做 strip
+        Args:
+            data: 数据
+            table_name: 表名
+            batch: 每次 executemany 的数据条数 驱动内部会再按 max_allowed_packet 切分
+            group_by_keys: 是否按照keys分组处理 默认False  则如果遇到数据中存在key不一致的情况 会抛出异常
+            ignore_duplicate: 忽略重复错误
+            **kwargs:
+
+        Returns:
+            受影响行数
+        """
+        table_name = table_name or self.table_name
+        if not table_name:
+            raise ValueError("table name {}".format(table_name))
+        if not data:
+            raise ValueError("data is {}".format(data))
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+
+        # 按照keys分组 不复制数据
+        # 固定keys顺序 取每组第一个数据
+        data_group_dict = defaultdict(list)
+        group_keys_dict = {}
+        for item in data:
+            keys_flag = frozenset(item.keys())
+            if keys_flag not in group_keys_dict:
+                group_keys_dict[keys_flag] = list(item.keys())
+            data_group_dict[keys_flag].append(item)
+        if not group_by_keys:
+            assert len(data_group_dict) == 1, "数据结构不一致"
+
+        max_stmt_length = max(self.get_max_allowed_packet() - 1024, 1024)
+        rows = 0
+        with self.cursor_context(new_cursor=True) as _cursor:
+            # 预留1k给sql头部等
+            _cursor.cursor.max_stmt_length = max_stmt_length
+            for keys_flag, group_data in data_group_dict.items():
+                keys = group_keys_dict[keys_flag]
+                sql = "insert {ignore}into {table_name} ({keys}) values ({values});".format(
+                    ignore="ignore " if ignore_duplicate else "",
+                    table_name=table_name,
+                    keys=",".join("`{}`".format(k) for k in keys),
+                    values=",".join(["%s"] * len(keys)),
+                )
+                to_db_value = self.to_db_value
+                for i in range(0, len(group_data), batch):
+                    args = [
+                        tuple(to_db_value(item[k]) for k in keys)
+                        for item in group_data[i : i + batch]
+                    ]
+                    rows += _cursor.executemany(sql, args) or 0
+        self.logger.debug("insert rows {}".format(rows))
+        return rows
+
+    def load_data_infile(
+        self,
+        data: list,
+        *,
+        table_name: str = "",
+        keys: list = None,
+        chunk_size: int = 100_000,
+        ignore_duplicate: bool = True,
+        **kwargs,
+    ) -> int:
+        """
+            使用 LOAD DATA LOCAL INFILE 导入数据 适用于百万级以上的数据
+            数据按 chunk_size 分块写入临时文件后导入 内存占用与数据总量无关
+            tips:
+                服务端需开启 local_infile
+        Args:
+            data: 数据 可以是生成器
+            table_name: 表名
+            keys: 字段列表 默认取第一个数据的keys
+            chunk_size: 每个临时文件的数据条数
+            ignore_duplicate: 忽略重复错误
+            **kwargs:
+
+        Returns:
+            受影响行数
+        """
+        table_name = table_name or self.table_name
+        if not table_name:
+            raise ValueError("table name {}".format(table_name))
+        charset = self.setting_dict["params"].get("charset", ["utf8mb4"])[0]
+
+        def _escape(value) -> str:
+            if value is None:
+                return "\\N"
+            if isinstance(value, bool):
+                value = int(value)
+            elif isinstance(value, bytes):
+                value = value.decode(charset)
+            value = str(self.to_db_value(value))
+            return (
+                value.replace("\\", "\\\\")
+                .replace("\t", "\\t")
+                .replace("\n", "\\n")
+                .replace("\r", "\\r")
+                .replace("\0", "\\0")
+            )
+
+        _kwargs = dict(self.kwargs, local_infile=True)
+        conn = get_mysql_conn(self.setting_dict, **_kwargs)
+        rows = 0
+        try:
+            _cursor = conn.cursor()
+            iterator = iter(data)
+            while 1:
+                fd, file_path = tempfile.mkstemp(suffix=".tsv")
+                count = 0
+                try:
+                    with os.fdopen(fd, "w", encoding=charset, newline="") as f:
+                        for item in iterator:
+                            if keys is None:
+                                keys = list(item.keys())
+                            f.write("\t".join(_escape(item[k]) for k in keys))
+                            f.write("\n")
+                            count += 1
+                            if count >= chunk_size:
+                                break
+                    if not count:
+                        break
+                    sql = (
+                        "load data local infile %s {ignore}into table {table_name} "
+                        "character set {charset} "
+                        "fields terminated by '\\t' escaped by '\\\\' "
+                        "lines terminated by '\\n' ({keys});"
+                    ).format(
+                        ignore="ignore " if ignore_duplicate else "",
+                        table_name=table_name,
+                        charset=charset,
+                        keys=",".join("`{}`".format(k) for k in keys),
+                    )
+                    rows += _cursor.execute(sql, (file_path,)) or 0
+                    self.logger.debug("load data rows {}".format(rows))
+                finally:
+                    os.remove(file_path)
+                if count < chunk_size:
+                    break
+        finally:
+            conn.close()
+        return rows
+
     def update(
         self,
         data,
@@ -475,7 +756,8 @@ class MySQLOpt(object):
                 "where_sql": where_sql,
             }
         )
-        return self.cursor.execute(sql)
+        with self.cursor_context() as _cursor:
+            return _cursor.execute(sql)
 
     def delete(
         self,
@@ -513,7 +795,8 @@ class MySQLOpt(object):
         where_sql = where_sql or order_condition
 
         sql = sql.format(**{"table_name": table_name, "where_sql": where_sql})
-        return self.cursor.execute(sql)
+        with self.cursor_context() as _cursor:
+            return _cursor.execute(sql)
 
     def query_all(self, sql, *, args=None) -> List[Tuple]:
         """
@@ -525,12 +808,46 @@ class MySQLOpt(object):
         Returns:
 
         """
-        _cursor = self.get_cursor(connection=self.conn)
-        _cursor.execute(sql, args=args)
-        result = _cursor.fetchall()
-        _cursor.close()
+        with self.cursor_context(new_cursor=True) as _cursor:
+            _cursor.execute(sql, args=args)
+            result = _cursor.fetchall()
         return result
 
+    def query_iter(
+        self, sql, *, args=None, chunk_size: int = 1000
+    ) -> Iterator[List[Tuple]]:
+        """
+            使用服务端游标(SSCursor)流式查询 每次返回 chunk_size 条
+            内存占用只与 chunk_size 有关 与结果集大小无关
+            tips:
+                1、流式读取期间连接不能执行其他sql 所以使用独立的连接 迭代结束后关闭
+                2、迭代期间连接上的结果集未读完 因此不会自动重连
+        Args:
+            sql:
+            args:
+            chunk_size: 每次返回的行数
+
+        Returns:
+
+        """
+        conn = get_mysql_conn(self.setting_dict, **self.kwargs)
+        try:
+            if "mysqldb" in self.setting_dict["type"]:
+                cursor_class = MySQLdb.cursors.SSCursor
+            else:
+                cursor_class = pymysql.cursors.SSCursor
+            _cursor = conn.cursor(cursor_class)
+            _cursor.execute(sql, args)
+            while 1:
+                rows = _cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            # 提前中断时直接关闭连接 避免关闭游标时读取剩余结果
+            conn.close()
+        return
+
     def query_single_attr(self, sql, *, args=None) -> List:
         """
             查询单个字段使用
@@ -549,6 +866,20 @@ class MySQLOpt(object):
         Returns:
 
         """
+        if self._pool is not None:
+            # 归还连接
+            if self._cursor:
+                self._pool.checkin(self._cursor)
+            self._cursor = None
+            self._conn = None
+            if self._pool_acquired:
+                self._pool_acquired = False
+                if (
+                    self._pool.release()
+                    and MySQLOpt.connection_pool_dict.get(self.key) is self._pool
+                ):
+                    MySQLOpt.connection_pool_dict.pop(self.key)
+            return
         try:
             if self._cursor:
                 self._cursor.close()
@@ -584,4 +915,8 @@ class MySQLOpt(object):
             self.setting_dict["type"] = protocol
         #
         db_opt = MySQLOpt(self.setting_dict, **_kwargs)
+        # 连接池模式下 复制的对象从连接池中取连接 指定协议时仍新建连接
+        if self._pool is not None and not protocol and self._pool.acquire():
+            db_opt._pool = self._pool
+            db_opt._pool_acquired = True
         return db_opt
@@ -17,9 +17,11 @@ import time
 import json
 import datetime
 from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 
 import cx_Oracle
 
+from batch_spider.share.db.pool import ConnectionPool
 from batch_spider.share.utils import log
 
 catch_error = (cx_Oracle.DatabaseError,)
@@ -117,9 +119,13 @@ class Cursor(object):
 class OracleOpt(object):
     # 连接池 共用
     connection_list = {}
+    # 有界连接池 setting key => ConnectionPool 仅 pool_size 大于0时使用
+    connection_pool_dict = {}
 
     def __init__(self, setting_dict, logger=None, **kwargs):
         self.is_pool = kwargs.pop("is_pool", True)
+        # 有界连接池大小 大于0时启用 用法同 MySQLOpt
+        self.pool_size = kwargs.pop("pool_size", 0)
         # 额外参数
         self.kwargs = kwargs
 
@@ -133,6 +139,18 @@ class OracleOpt(object):
         # 私有变量
         self._conn = None
         self._cursor = None
+        self._pool: ConnectionPool = None
+        # 是否持有连接池的引用 close时释放 最后一个持有者释放时关闭连接池
+        self._pool_acquired = False
+        if self.pool_size > 0:
+            self._pool = OracleOpt.connection_pool_dict.get(self.key)
+            if self._pool is None or not self._pool.acquire():
+                self._pool = ConnectionPool(
+                    self.get_cursor, max_size=self.pool_size, logger=self.logger
+                )
+                self._pool.acquire()
+                OracleOpt.connection_pool_dict[self.key] = self._pool
+            self._pool_acquired = True
 
     def __del__(self):
         try:
@@ -158,7 +176,10 @@ class OracleOpt(object):
 
         """
         if not self._cursor:
-            if not self.is_pool or self.key not in OracleOpt.connection_list.keys():
+            if self._pool is not None:
+                # 从连接池中取出一个连接 close时归还
+                self._cursor = self._pool.checkout()
+            elif not self.is_pool or self.key not in OracleOpt.connection_list.keys():
                 self._cursor = self.get_cursor()
                 if self.is_pool:
                     OracleOpt.connection_list[self.key] = self._cursor
@@ -181,6 +202,29 @@ class OracleOpt(object):
         )
         return cursor
 
+    @contextmanager
+    def cursor_context(self):
+        """
+            获取本次操作使用的游标 用完后关闭
+                连接池模式下的共用对象 每次从连接池取出连接 操作完成后归还
+                其他情况在当前连接上新建游标
+        Returns:
+
+        """
+        if self._pool is not None and self.is_pool:
+            with self._pool.connection() as _pool_cursor:
+                _cursor = self.get_cursor(_pool_cursor.conn)
+                try:
+                    yield _cursor
+                finally:
+                    _cursor.close()
+        else:
+            _cursor = self.get_cursor(self.conn)
+            try:
+                yield _cursor
+            finally:
+                _cursor.close()
+
     def handle_values(self, data, keys=None) -> OrderedDict:
         """
             处理字典中的值 转换为mysql接受的格式
@@ -271,9 +315,9 @@ class OracleOpt(object):
                 "table_name": table_name,
             }
         )
-        _cursor = self.get_cursor(self.conn)
         try:
-            _cursor.execute(sql)
+            with self.cursor_context() as _cursor:
+                _cursor.execute(sql)
             resp = 0
         except Exception as e:
             if ignore_duplicate and (
@@ -283,8 +327,6 @@ class OracleOpt(object):
                 resp = 1
             else:
                 raise e
-        finally:
-            _cursor.close()
         return resp
 
     def add_many(
@@ -334,52 +376,50 @@ class OracleOpt(object):
                 table_name, ignore_unique_key
             )
 
-        _cursor = self.get_cursor(self.conn)
-
-        for data in data_group_list:
-            # 固定keys 取第一个数据
-            # 如果不固定 则当给定数据的key顺序不固定时会出现入库错乱
-            first_data_keys = list(data[0].keys())
-            resp = 0
-            while data:
-                _data = data[:batch]
-                data = data[batch:]
-                # 每次100
-                sql = 'INSERT {hint} INTO "{table_name}"("{keys}") {values}'
-                # 拼接sql
-                values_list = []
-                for item in _data:
-                    order_data = self.handle_values(item, keys=first_data_keys)
-                    keys = '","'.join(order_data.keys())
-                    values = ",".join(order_data.values())
-                    values_list.append(values)
-
-                value_sql_list = ["select {} from dual".format(values_list[0])]
-                if len(values_list) > 1:
-                    value_sql_list.extend(
-                        "union all select {} from dual".format(x)
-                        for x in values_list[1:]
+        with self.cursor_context() as _cursor:
+            for data in data_group_list:
+                # 固定keys 取第一个数据
+                # 如果不固定 则当给定数据的key顺序不固定时会出现入库错乱
+                first_data_keys = list(data[0].keys())
+                resp = 0
+                while data:
+                    _data = data[:batch]
+                    data = data[batch:]
+                    # 每次100
+                    sql = 'INSERT {hint} INTO "{table_name}"("{keys}") {values}'
+                    # 拼接sql
+                    values_list = []
+                    for item in _data:
+                        order_data = self.handle_values(item, keys=first_data_keys)
+                        keys = '","'.join(order_data.keys())
+                        values = ",".join(order_data.values())
+                        values_list.append(values)
+
+                    value_sql_list = ["select {} from dual".format(values_list[0])]
+                    if len(values_list) > 1:
+                        value_sql_list.extend(
+                            "union all select {} from dual".format(x)
+                            for x in values_list[1:]
+                        )
+                    sql = sql.format(
+                        **{
+                            "hint": dup_index_hint,
+                            "table_name": table_name,
+                            "keys": keys,
+                            "values": " ".join(value_sql_list),
+                        }
                     )
-                sql = sql.format(
-                    **{
-                        "hint": dup_index_hint,
-                        "table_name": table_name,
-                        "keys": keys,
-                        "values": " ".join(value_sql_list),
-                    }
-                )
-                try:
-                    _cursor.execute(sql)
-                    self.logger.debug("insert rows {}".format(_cursor.rowcount))
-                    resp = 0
-                except Exception as e:
-                    if "Unknown column" in str(e):
-                        self.logger.debug("错误数据: {}".format(_data[0]))
-                        if ignore_unknown_column:
-                            error_data.extend(_data)
-                            continue
-                    raise e
-        _cursor.close()
+                    try:
+                        _cursor.execute(sql)
+                        self.logger.debug("insert rows {}".format(_cursor.rowcount))
+                        resp = 0
+                    except Exception as e:
+                        if "Unknown column" in str(e):
+                            self.logger.debug("错误数据: {}".format(_data[0]))
+                            if ignore_unknown_column:
+                                error_data.extend(_data)
+                                continue
+                        raise e
         if ignore_unknown_column:
             return resp, error_data
         return resp
@@ -394,15 +434,14 @@ class OracleOpt(object):
         Returns:
 
         """
-        _cursor = self.get_cursor(connection=self.conn)
-        r = _cursor.execute(sql, parameters=parameters)
-        # 仅当sql是一个query时 才会有返回值 否则是None
-        # https://cx-oracle.readthedocs.io/en/latest/cursor.html#Cursor.execute
-        if r:
-            result = _cursor.fetchall()
-        else:
-            result = []
-        _cursor.close()
+        with self.cursor_context() as _cursor:
+            r = _cursor.execute(sql, parameters=parameters)
+            # 仅当sql是一个query时 才会有返回值 否则是None
+            # https://cx-oracle.readthedocs.io/en/latest/cursor.html#Cursor.execute
+            if r:
+                result = _cursor.fetchall()
+            else:
+                result = []
         return result
 
     def get_unique_indexs(self, table_name: str):
@@ -426,6 +465,20 @@ class OracleOpt(object):
         Returns:
 
         """
+        if self._pool is not None:
+            # 归还连接
+            if self._cursor:
+                self._pool.checkin(self._cursor)
+            self._cursor = None
+            self._conn = None
+            if self._pool_acquired:
+                self._pool_acquired = False
+                if (
+                    self._pool.release()
+                    and OracleOpt.connection_pool_dict.get(self.key) is self._pool
+                ):
+                    OracleOpt.connection_pool_dict.pop(self.key)
+            return
         try:
             self.cursor.close()
         except:
@@ -453,4 +506,8 @@ class OracleOpt(object):
         _kwargs.update(kwargs)
         _kwargs.update({"is_pool": False})
         db_opt = OracleOpt(self.setting_dict, **_kwargs)
+        # 连接池模式下 复制的对象从连接池中取连接
+        if self._pool is not None and self._pool.acquire():
+            db_opt._pool = self._pool
+            db_opt._pool_acquired = True
         return db_opt
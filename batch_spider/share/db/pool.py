@@ -0,0 +1,185 @@
+# coding:utf8
+"""
+数据库连接池
+
+    pool = ConnectionPool(create_func, max_size=10)
+    with pool.connection() as cursor:
+        cursor.execute(sql)
+
+    tips:
+        1、连接数达到 max_size 时 checkout 会阻塞等待其他连接归还 gevent patch 后为协程等待
+        2、空闲超过 max_idle_time 的连接会被关闭 空闲超过 ping_interval 的连接取出时会先做健康检查
+        3、池中对象为重新封装过的 Cursor 通过其 conn 属性访问原始连接
+        4、多个对象共用一个连接池时 各自 acquire/release 最后一个使用者 release 时才关闭连接池
+"""
+import threading
+import time
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+
+from batch_spider.share.utils import log
+
+
+class ConnectionPool(object):
+    def __init__(
+        self,
+        create_func,
+        *,
+        max_size: int = 10,
+        max_idle_time: int = 5 * 60,
+        ping_interval: int = 30,
+        wait_timeout: int = 60,
+        logger=None,
+    ):
+        """
+
+        Args:
+            create_func: 创建新连接的函数
+            max_size: 最大连接数
+            max_idle_time: 最大空闲时间 超过则关闭
+            ping_interval: 空闲超过此时间的连接 取出时检查是否可用
+            wait_timeout: 等待可用连接的最长时间
+            logger:
+        """
+        self.create_func = create_func
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.ping_interval = ping_interval
+        self.wait_timeout = wait_timeout
+        self.logger = logger or log.get_logger(__file__)
+
+        # 后进先出 使常用连接保持活跃 不常用的连接自然超时关闭
+        self._idle = LifoQueue()
+        self._semaphore = threading.BoundedSemaphore(max_size)
+        self._closed = False
+        # 使用者计数
+        self._ref_lock = threading.Lock()
+        self._ref_count = 0
+
+    def acquire(self) -> bool:
+        """
+            增加一个使用者
+        Returns:
+            连接池已关闭时返回False
+        """
+        with self._ref_lock:
+            if self._closed:
+                return False
+            self._ref_count += 1
+            return True
+
+    def release(self) -> bool:
+        """
+            减少一个使用者 最后一个使用者释放时关闭连接池
+        Returns:
+            连接池是否已关闭
+        """
+        with self._ref_lock:
+            self._ref_count -= 1
+            if self._ref_count > 0:
+                return False
+        self.close()
+        return True
+
+    def checkout(self):
+        """
+            获取一个连接
+        Returns:
+
+        """
+        if not self._semaphore.acquire(timeout=self.wait_timeout):
+            raise TimeoutError(
+                "wait for connection timeout: {}s max_size: {}".format(
+                    self.wait_timeout, self.max_size
+                )
+            )
+        try:
+            while 1:
+                try:
+                    item, last_used_ts = self._idle.get_nowait()
+                except Empty:
+                    return self.create_func()
+                idle_time = time.time() - last_used_ts
+                if idle_time > self.max_idle_time:
+                    self._close_item(item)
+                    continue
+                if idle_time > self.ping_interval and not self._ping(item):
+                    self._close_item(item)
+                    continue
+                return item
+        except:
+            self._semaphore.release()
+            raise
+
+    def checkin(self, item, discard: bool = False):
+        """
+            归还连接
+        Args:
+            item:
+            discard: 是否直接关闭 不再放回连接池
+
+        Returns:
+
+        """
+        try:
+            if discard or self._closed:
+                self._close_item(item)
+            else:
+                self._idle.put((item, time.time()))
+        finally:
+            self._semaphore.release()
+        return
+
+    @contextmanager
+    def connection(self):
+        """
+            with pool.connection() as item:
+                ...
+            sql错误等普通异常不影响连接 正常归还
+            被中断(如协程被kill)时连接可能处于读写中途 直接关闭
+        Returns:
+
+        """
+        item = self.checkout()
+        try:
+            yield item
+        except Exception:
+            self.checkin(item)
+            raise
+        except BaseException:
+            self.checkin(item, discard=True)
+            raise
+        else:
+            self.checkin(item)
+
+    def close(self):
+        """
+            关闭连接池 已取出的连接在归还时关闭
+        Returns:
+
+        """
+        self._closed = True
+        while 1:
+            try:
+                item, _ = self._idle.get_nowait()
+            except Empty:
+                break
+            self._close_item(item)
+        return
+
+    def _close_item(self, item):
+        for _obj in (item, getattr(item, "conn", None)):
+            try:
+                if _obj is not None:
+                    _obj.close()
+            except Exception:
+                pass
+        return
+
+    def _ping(self, item) -> bool:
+        try:
+            item.conn.ping()
+            return True
+        except Exception as e:
+            self.logger.debug("连接不可用: {}".format(e))
+            return False
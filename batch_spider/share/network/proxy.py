@@ -5,11 +5,15 @@
 import os
 import time
 import json
+import heapq
 import random
+import base64
 import socket
 import datetime
+import itertools
 from urllib import parse
 from collections import deque
+from contextlib import contextmanager, nullcontext
 from typing import Union, List, Dict
 
 import redis
@@ -23,6 +27,14 @@ if not os.path.exists(proxy_path):
     os.mkdir(proxy_path)
 
 
+# http代理源的缓存校验信息 {url: {"etag": "", "last_modified": "", "check_ts": 0}}
+# 用于条件请求 内容未变化时服务端返回304 不再重新下载
+_http_proxy_source_cache_dict = {}
+
+# 代理文件解析结果缓存 {文件路径: (修改时间, 文件大小, 代理列表)} 文件未变化时不再重新解析
+_proxy_file_parse_cache_dict = {}
+
+
 # 代理类型定义
 class LimitProxy(object):
     """
@@ -76,6 +88,7 @@ def get_proxy_from_http(proxy_source_url, **kwargs):
     filename = proxy_source_url.split("/")[-1]
     abs_filename = os.path.join(proxy_path, filename)
     update_interval = kwargs.get("local_proxy_file_cache_timeout", 60)
+    cache_info = _http_proxy_source_cache_dict.get(proxy_source_url, {})
     update_flag = 0
     if not update_interval:
         # 强制更新
@@ -83,13 +96,34 @@ def get_proxy_from_http(proxy_source_url, **kwargs):
     elif not os.path.exists(abs_filename):
         # 文件不存在则更新
         update_flag = 1
-    elif time.time() - os.stat(abs_filename).st_mtime > update_interval:
+    elif (
+        time.time()
+        - max(os.stat(abs_filename).st_mtime, cache_info.get("check_ts", 0))
+        > update_interval
+    ):
         # 超过更新间隔
         update_flag = 1
     if update_flag:
-        response = requests.get(proxy_source_url, timeout=20)
-        with open(os.path.join(proxy_path, filename), "w") as f:
-            f.write(response.text)
+        headers = {}
+        if cache_info and os.path.exists(abs_filename):
+            # 条件请求 内容未变化时返回304
+            if cache_info.get("etag"):
+                headers["If-None-Match"] = cache_info["etag"]
+            if cache_info.get("last_modified"):
+                headers["If-Modified-Since"] = cache_info["last_modified"]
+        response = requests.get(proxy_source_url, headers=headers, timeout=20)
+        if response.status_code == 304:
+            # 内容未变化 仅记录检查时间 本地文件不变 解析结果可继续使用缓存
+            cache_info["check_ts"] = time.time()
+        else:
+            with open(os.path.join(proxy_path, filename), "w") as f:
+                f.write(response.text)
+            cache_info = {
+                "etag": response.headers.get("ETag", ""),
+                "last_modified": response.headers.get("Last-Modified", ""),
+                "check_ts": time.time(),
+            }
+        _http_proxy_source_cache_dict[proxy_source_url] = cache_info
     return get_proxy_from_file(filename)
 
 
@@ -107,8 +141,15 @@ def get_proxy_from_file(filename, **kwargs):
     Returns:
 
     """
+    abs_filename = os.path.join(proxy_path, filename)
+    stat = os.stat(abs_filename)
+    cache = _proxy_file_parse_cache_dict.get(abs_filename)
+    if cache and cache[0] == stat.st_mtime_ns and cache[1] == stat.st_size:
+        # 复制一份 避免调用方修改缓存
+        return [dict(x) for x in cache[2]]
+
     proxies_list = []
-    with open(os.path.join(proxy_path, filename), "r") as f:
+    with open(abs_filename, "r") as f:
         lines = f.readlines()
 
     for line in lines:
@@ -138,7 +179,12 @@ def get_proxy_from_file(filename, **kwargs):
             proxies = {protocol[0]: "%s://%s:%s" % (protocol[0], ip, port)}
         proxies_list.append(proxies)
 
-    return proxies_list
+    _proxy_file_parse_cache_dict[abs_filename] = (
+        stat.st_mtime_ns,
+        stat.st_size,
+        proxies_list,
+    )
+    return [dict(x) for x in proxies_list]
 
 
 def get_proxy_from_redis(proxy_source_url, **kwargs):
@@ -295,6 +341,13 @@ class ProxyItem(object):
         self.use_interval = use_interval
         # 使用时间
         self._use_ts = 0
+        # 使用效果统计 指数加权移动平均 由 ProxyPool.report 更新
+        # 平均耗时 秒 未知时为None
+        self.latency = None
+        # 成功率 初始为1 使新代理有机会被选中
+        self.success_rate = 1.0
+        # 统计样本数
+        self.report_num = 0
 
         self.proxy_args = self.parse_proxies(self.proxies)
         self.proxy_ip = self.proxy_args["ip"]
@@ -336,10 +389,40 @@ class ProxyItem(object):
         self.use_num += 1
         return self.proxies
 
+    def report(self, success: bool, latency: float = None, alpha: float = 0.3):
+        """
+            记录一次使用结果
+        Args:
+            success: 是否成功
+            latency: 耗时 秒
+            alpha: 平滑系数 越大越看重最近的结果
+
+        Returns:
+
+        """
+        self.report_num += 1
+        self.success_rate += alpha * ((1.0 if success else 0.0) - self.success_rate)
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += alpha * (latency - self.latency)
+        return
+
+    @property
+    def score(self) -> float:
+        """
+            代理评分 成功率越高 耗时越短 评分越高
+        Returns:
+
+        """
+        latency = self.latency if self.latency is not None else 1.0
+        return self.success_rate * self.success_rate / max(latency, 0.05)
+
     def is_delay(self):
         return self.flag == 1
 
-    def is_valid(self, force=0, type=0):
+    def is_valid(self, force=0, type=0, check=1):
         """
         检测代理是否有效
             1 有效
@@ -348,6 +431,7 @@ class ProxyItem(object):
         Args:
             force:
             type:
+            check: 是否进行网络检测 0 时仅根据标记及使用限制判断 由 ProxyHealthChecker 负责检测
 
         Returns:
 
@@ -359,9 +443,9 @@ class ProxyItem(object):
             self.logger.debug("代理被标记 -1 丢弃 %s" % self.proxies)
             return 0
         if self.delay > 0 and self.flag == 1:
-            _delay = int(time.time() - self.flag_ts)
+            _delay = time.time() - self.flag_ts
             if _delay < self.delay:
-                self.logger.debug("代理被标记 1 延迟 {} {}".format(_delay, self.proxy_id))
+                self.logger.debug("代理被标记 1 延迟 {} {}".format(int(_delay), self.proxy_id))
                 return 2
             else:
                 self.flag = 0
@@ -369,6 +453,8 @@ class ProxyItem(object):
         if self.use_interval:
             if time.time() - self.use_ts < self.use_interval:
                 return 2
+        if not check:
+            return 1
         if not force:
             if time.time() - self.update_ts < self.check_interval:
                 return 1
@@ -424,8 +510,210 @@ class ProxyItem(object):
         }
 
 
+class RedisProxyStateStore(object):
+    """
+    RedisProxyItem 状态(flag flag_ts use_ts)的批量读写 多进程共享代理状态时使用
+        存储结构不变 每个字段一个 hash {代理id: 值}
+
+        读取: 同一代理的全部字段通过 pipeline 一次取回 本地缓存 cache_ttl 秒
+        写入: 先写本地缓存 再通过 pipeline 批量写入 待写入数量达到 max_pending 或距首次写入超过 flush_interval 秒时写入
+        sync: 一次往返 写入全部待写入的状态 并读取一批代理的全部状态 由 ProxyPool.maintain 定时调用
+
+        with store.batch():
+            ...  # 期间的写入不单独提交 退出时一次写入(期间若有读取访问redis 随读取一并写入)
+    """
+
+    # {字段名: (hash名后缀, 类型)}
+    field_dict = {
+        "use_ts": ("proxy_use_time", float),
+        "flag": ("proxy_flag", int),
+        "flag_ts": ("proxy_flag_ts", float),
+    }
+
+    def __init__(
+        self,
+        redis_conn: redis.StrictRedis,
+        namespace: str,
+        *,
+        cache_ttl: float = 1,
+        flush_interval: float = 0.5,
+        max_pending: int = 100,
+    ):
+        """
+
+        Args:
+            redis_conn:
+            namespace: key 前缀
+            cache_ttl: 本地缓存时间 秒 为0则每次读取都访问redis
+            flush_interval: 写入最长延迟 秒 为0则每次写入立即提交
+            max_pending: 待写入数量上限
+        """
+        self.redis_conn = redis_conn
+        self.namespace = namespace
+        self.cache_ttl = cache_ttl
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # {字段名: hash名}
+        self.key_dict = {
+            field: "{}:{}".format(namespace, suffix)
+            for field, (suffix, _) in self.field_dict.items()
+        }
+        # {代理id: (读取时间, {字段名: 值})}
+        self._state_dict = {}
+        # 待写入 {(字段名, 代理id): 值}
+        self._pending_dict = {}
+        self._first_pending_ts = 0
+        self._batch_depth = 0
+        self._lock = None
+
+    def _get_lock(self):
+        if not self._lock:
+            # 必须用时调用 否则 可能存在 gevent patch前 threading就已经被导入 导致的lock patch失效
+            import threading
+
+            self._lock = threading.RLock()
+        return self._lock
+
+    def get(self, proxy_id: str, field: str):
+        """
+            读取代理状态 缓存过期时一次取回该代理的全部字段
+        Args:
+            proxy_id:
+            field:
+
+        Returns:
+
+        """
+        state = self._state_dict.get(proxy_id)
+        if state is None or time.time() - state[0] >= self.cache_ttl:
+            state = self.load([proxy_id])[proxy_id]
+        return state[1][field]
+
+    def set(self, proxy_id: str, field: str, value):
+        """
+            写入代理状态 先更新本地缓存 再按策略批量写入redis
+        Args:
+            proxy_id:
+            field:
+            value:
+
+        Returns:
+
+        """
+        value = self.field_dict[field][1](value)
+        with self._get_lock():
+            state = self._state_dict.get(proxy_id)
+            if state is not None:
+                state[1][field] = value
+            if not self._pending_dict:
+                self._first_pending_ts = time.time()
+            self._pending_dict[(field, proxy_id)] = value
+            need_flush = not self._batch_depth and (
+                len(self._pending_dict) >= self.max_pending
+                or time.time() - self._first_pending_ts >= self.flush_interval
+            )
+        if need_flush:
+            self.flush()
+        return
+
+    def flush(self):
+        """
+            写入全部待写入的状态
+        Returns:
+
+        """
+        self.sync([])
+        return
+
+    def load(self, proxy_id_list: List[str]) -> Dict[str, tuple]:
+        """
+            一次往返读取一批代理的全部状态
+        Args:
+            proxy_id_list:
+
+        Returns:
+            {代理id: (读取时间, {字段名: 值})}
+        """
+        return self.sync(proxy_id_list)
+
+    def sync(self, proxy_id_list: List[str]) -> Dict[str, tuple]:
+        """
+            一次往返 写入全部待写入的状态 并读取一批代理的全部状态
+        Args:
+            proxy_id_list:
+
+        Returns:
+            {代理id: (读取时间, {字段名: 值})}
+        """
+        with self._get_lock():
+            pending_dict = self._pending_dict
+            self._pending_dict = {}
+        if not pending_dict and not proxy_id_list:
+            return {}
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for (field, proxy_id), value in pending_dict.items():
+            pipe.hset(self.key_dict[field], proxy_id, value)
+        if proxy_id_list:
+            for field in self.field_dict:
+                pipe.hmget(self.key_dict[field], proxy_id_list)
+        try:
+            result = pipe.execute()
+        except Exception:
+            # 写入失败 放回待写入 新写入的值优先
+            with self._get_lock():
+                pending_dict.update(self._pending_dict)
+                self._pending_dict = pending_dict
+            raise
+        if not proxy_id_list:
+            return {}
+        now_ts = time.time()
+        value_list_list = result[len(pending_dict) :]
+        state_dict = {}
+        with self._get_lock():
+            for i, proxy_id in enumerate(proxy_id_list):
+                values = {}
+                for (field, (_, _type)), value_list in zip(
+                    self.field_dict.items(), value_list_list
+                ):
+                    # 读取期间本地又有新的写入 以本地为准
+                    value = self._pending_dict.get((field, proxy_id), value_list[i])
+                    values[field] = _type(value) if value else 0
+                state_dict[proxy_id] = self._state_dict[proxy_id] = (now_ts, values)
+        return state_dict
+
+    @contextmanager
+    def batch(self):
+        """
+            期间的写入不单独提交 退出时一次写入
+        Returns:
+
+        """
+        with self._get_lock():
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._get_lock():
+                self._batch_depth -= 1
+                depth = self._batch_depth
+            if not depth:
+                self.flush()
+
+    def discard(self, proxy_id: str):
+        """
+            删除本地缓存
+        Args:
+            proxy_id:
+
+        Returns:
+
+        """
+        self._state_dict.pop(proxy_id, None)
+        return
+
+
 class RedisProxyItem(ProxyItem):
-    """单个代理对象"""
+    """单个代理对象 状态保存在redis中 多进程共享"""
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -433,43 +721,223 @@ class RedisProxyItem(ProxyItem):
         #
         self.redis_conn: redis.StrictRedis = kwargs["redis_conn"]
         self.key_namespace = kwargs["namespace"]
+        # 状态读写 由 ProxyPool 创建并共享 单独使用时每次写入立即提交
+        self.state_store: RedisProxyStateStore = kwargs.get(
+            "redis_state_store"
+        ) or RedisProxyStateStore(
+            self.redis_conn, self.key_namespace, flush_interval=0
+        )
         # 使用时间记录
-        self.use_time_key = f"{self.key_namespace}:proxy_use_time"
-        self.flag_key = f"{self.key_namespace}:proxy_flag"
-        self.flag_ts_key = f"{self.key_namespace}:proxy_flag_ts"
+        self.use_time_key = self.state_store.key_dict["use_ts"]
+        self.flag_key = self.state_store.key_dict["flag"]
+        self.flag_ts_key = self.state_store.key_dict["flag_ts"]
 
     @property
     def use_ts(self):
-        r = self.redis_conn.hget(self.use_time_key, self.proxy_id)
-        r = float(r) if r else 0
-        return r
+        return self.state_store.get(self.proxy_id, "use_ts")
 
     @use_ts.setter
     def use_ts(self, value):
-        value = float(value)
-        self.redis_conn.hset(self.use_time_key, self.proxy_id, value)
+        self.state_store.set(self.proxy_id, "use_ts", value)
 
     @property
     def flag(self):
-        r = self.redis_conn.hget(self.flag_key, self.proxy_id)
-        r = int(r) if r else 0
-        return r
+        return self.state_store.get(self.proxy_id, "flag")
 
     @flag.setter
     def flag(self, value):
-        value = int(value)
-        self.redis_conn.hset(self.flag_key, self.proxy_id, value)
+        self.state_store.set(self.proxy_id, "flag", value)
 
     @property
     def flag_ts(self):
-        r = self.redis_conn.hget(self.flag_ts_key, self.proxy_id)
-        r = float(r) if r else 0
-        return r
+        return self.state_store.get(self.proxy_id, "flag_ts")
 
     @flag_ts.setter
     def flag_ts(self, value):
-        value = float(value)
-        self.redis_conn.hset(self.flag_ts_key, self.proxy_id, value)
+        self.state_store.set(self.proxy_id, "flag_ts", value)
+
+
+class ProxyHealthChecker(object):
+    """
+    代理批量健康检查
+        使用 gevent socket 并发检测代理池中到期(距上次检测超过 check_interval)的代理
+        检测通过更新 update_ts 失败则从代理池丢弃 获取代理时不再同步检测
+
+        target_url 为空时仅检测端口连通
+        http 地址 通过代理发送 GET 请求 https 地址 通过代理发送 CONNECT 请求 响应状态码 2xx 3xx 视为可用
+        建议使用本地或内网地址 避免检测结果受目标网站影响
+    """
+
+    def __init__(
+        self,
+        proxy_pool: "ProxyPool",
+        *,
+        target_url: str = "",
+        concurrency: int = 100,
+        timeout: float = 5,
+        logger=None,
+    ):
+        """
+
+        Args:
+            proxy_pool: 代理池
+            target_url: 检测地址
+            concurrency: 并发数
+            timeout: 单个代理检测超时时间 秒
+            logger:
+        """
+        self.proxy_pool = proxy_pool
+        self.target_url = target_url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.logger = logger or log.get_logger(__file__)
+        # 检测统计 ok: 可用次数 fail: 不可用次数
+        self.stats = {"ok": 0, "fail": 0}
+
+        self._check_thread = None
+        self._closed = False
+
+    def get_due_proxy_items(self) -> List[ProxyItem]:
+        """
+            获取需要检测的代理
+        Returns:
+
+        """
+        now_ts = time.time()
+        return [
+            x
+            for x in list(self.proxy_pool.proxy_dict.values())
+            if now_ts - x.update_ts >= x.check_interval
+        ]
+
+    def check(self, proxy_item_list: List[ProxyItem] = None) -> int:
+        """
+            并发检测代理 并将结果写入代理池
+        Args:
+            proxy_item_list: 默认检测全部到期的代理
+
+        Returns:
+            可用代理数
+        """
+        import gevent.pool
+
+        if proxy_item_list is None:
+            proxy_item_list = self.get_due_proxy_items()
+        if not proxy_item_list or self._closed:
+            return 0
+        start_ts = time.time()
+        pool = gevent.pool.Pool(self.concurrency)
+        ok_count = fail_count = 0
+        try:
+            for proxy_item, ok in zip(
+                proxy_item_list, pool.imap(self.check_proxy_item, proxy_item_list)
+            ):
+                if self._closed:
+                    # 已关闭 不再写入结果
+                    return ok_count
+                if ok:
+                    proxy_item.update_ts = time.time()
+                    self.proxy_pool.proxy_item_update_ts_dict[
+                        proxy_item.proxy_id
+                    ] = proxy_item.update_ts
+                    ok_count += 1
+                else:
+                    fail_count += 1
+                    if self.proxy_pool.proxy_dict.get(proxy_item.proxy_id) is proxy_item:
+                        self.proxy_pool.discard_proxy_item(proxy_item)
+        finally:
+            pool.kill()
+            self.stats["ok"] += ok_count
+            self.stats["fail"] += fail_count
+        self.proxy_pool.rebuild_proxy_list()
+        self.logger.debug(
+            "代理检测完成: 检测{}, 可用{}, 耗时{:.2f}s".format(
+                len(proxy_item_list), ok_count, time.time() - start_ts
+            )
+        )
+        return ok_count
+
+    def check_async(self):
+        """
+            在后台检测到期的代理 已有检测在进行时直接返回
+        Returns:
+
+        """
+        if self._closed:
+            return
+        if self._check_thread is not None and self._check_thread.is_alive():
+            return
+        # 必须用时调用 否则 可能存在 gevent patch前 threading就已经被导入 导致的patch失效
+        import threading
+
+        self._check_thread = threading.Thread(target=self._safe_check, daemon=True)
+        self._check_thread.start()
+        return
+
+    def close(self):
+        """
+            停止后台检测 等待进行中的检测退出
+        Returns:
+
+        """
+        self._closed = True
+        if self._check_thread is not None and self._check_thread.is_alive():
+            self._check_thread.join(self.timeout + 1)
+        return
+
+    def _safe_check(self):
+        try:
+            self.check()
+        except Exception as e:
+            self.logger.exception(e)
+        return
+
+    def check_proxy_item(self, proxy_item: ProxyItem) -> int:
+        """
+            检测单个代理
+        Args:
+            proxy_item:
+
+        Returns:
+            1 可用 0 不可用
+        """
+        import gevent
+        import gevent.socket
+
+        args = proxy_item.proxy_args
+        try:
+            with gevent.Timeout(self.timeout):
+                with gevent.socket.create_connection(
+                    (args["ip"], int(args["port"])), timeout=self.timeout
+                ) as sk:
+                    if not self.target_url:
+                        return 1
+                    sk.sendall(self._build_request(args))
+                    with sk.makefile("rb") as f:
+                        status_line = f.readline()
+            status_code = int(status_line.split()[1])
+            return 1 if 200 <= status_code < 400 else 0
+        except (Exception, gevent.Timeout):
+            # gevent.Timeout 继承自 BaseException 需单独捕获
+            return 0
+
+    def _build_request(self, args: dict) -> bytes:
+        _url_parse = parse.urlsplit(self.target_url)
+        if _url_parse.scheme == "https":
+            host = _url_parse.netloc if _url_parse.port else _url_parse.netloc + ":443"
+            lines = ["CONNECT {} HTTP/1.1".format(host), "Host: {}".format(host)]
+        else:
+            lines = [
+                "GET {} HTTP/1.1".format(self.target_url),
+                "Host: {}".format(_url_parse.netloc),
+                "Connection: close",
+            ]
+        if args["user"]:
+            auth = "{}:{}".format(args["user"], args["password"]).encode()
+            lines.append(
+                "Proxy-Authorization: Basic {}".format(base64.b64encode(auth).decode())
+            )
+        return ("\r\n".join(lines) + "\r\n\r\n").encode()
 
 
 class ProxyPoolBase(object):
@@ -493,6 +961,20 @@ class ProxyPool(ProxyPoolBase):
             reset_interval_max:  代理池重置间隔 最大间隔 默认2分钟
             check_valid: 是否在获取代理时进行检测有效性
             local_proxy_file_cache_timeout: 本地缓存的代理文件超时时间
+            select_mode: 代理选择方式 queue: 先进先出轮流使用 p2c: 随机取两个选评分高的 weighted: 按评分加权随机
+                评分依据 report 记录的成功率及耗时
+            async_refresh: 是否在后台线程(gevent patch后为协程)中维护代理池 获取代理时不等待
+                维护包括 刷新代理池 释放到期的延迟代理 重建可选代理数组 关闭时在 get 中按 maintain_interval 同步维护
+                首次加载及代理池为空时仍同步刷新
+            maintain_interval: 维护间隔 秒
+            redis_conn: 指定时代理状态保存在redis中 多进程共享 使用 RedisProxyItem
+            namespace: redis key 前缀
+            redis_state_cache_ttl: redis代理状态本地缓存时间 秒
+            redis_state_flush_interval: redis代理状态写入最长延迟 秒
+            health_check: 是否启用 ProxyHealthChecker 后台批量检测代理 启用后仅选择检测通过的代理 获取代理时不再同步检测
+            health_check_url: 检测地址 为空则仅检测端口连通
+            health_check_concurrency: 检测并发数
+            health_check_timeout: 单个代理检测超时时间 秒
             logger: 日志处理器 默认 log.get_logger()
             **kwargs: 其他的参数
         """
@@ -521,13 +1003,49 @@ class ProxyPool(ProxyPoolBase):
         self.reset_interval_max = kwargs.get("reset_interval_max", 180)
         # 是否监测代理有效性
         self.check_valid = kwargs.get("check_valid", True)
+        # 代理选择方式
+        self.select_mode = kwargs.get("select_mode", "queue")
+        if self.select_mode not in ("queue", "p2c", "weighted"):
+            raise ValueError("unknown select_mode: {}".format(self.select_mode))
+        # 后台维护代理池
+        self.async_refresh = kwargs.get("async_refresh", True)
+        # 维护间隔
+        self.maintain_interval = kwargs.get("maintain_interval", 0.5)
+        self._refresh_thread = None
+        self._maintain_thread = None
+        self._maintain_exit_event = None
+        self._next_maintain_ts = 0
+        # 代理健康检查
+        self.health_checker = None
+        if kwargs.get("health_check", False):
+            self.health_checker = ProxyHealthChecker(
+                self,
+                target_url=kwargs.get("health_check_url", ""),
+                concurrency=kwargs.get("health_check_concurrency", 100),
+                timeout=kwargs.get("health_check_timeout", 5),
+                logger=self.logger,
+            )
 
-        # 代理队列
-        self.proxy_queue = None
+        # 可选代理数组 [ProxyItem, ...] 重建时整体替换 不原地修改 因此选择代理时无需加锁
+        self.proxy_list = None
+        # 轮询游标
+        self._proxy_list_cursor = itertools.count()
+        # (可选代理数组, 累计权重) 按评分加权选择时使用 同一次重建的结果放在一起 避免读到不一致的数据
+        self._proxy_list_weights = None
+        # 可选代理数组需要重建
+        self._proxy_list_dirty = False
         # {代理id: ProxyItem, ...}
         self.proxy_dict = {}
         # 失效代理队列
         self.invalid_proxy_dict = {}
+        # 延迟使用的代理 [(释放时间, 序号, ProxyItem), ...] 小顶堆 到期前不参与选择
+        self._delay_heap = []
+        self._delay_seq = itertools.count()
+        # 延迟堆中代理的 id(ProxyItem) 每个代理只入堆一次 选择时直接跳过
+        self._delay_id_set = set()
+        self._delay_lock = None
+        # {代理url: 代理id} 用于 report 时快速查找代理
+        self._proxy_url_id_dict = {}
         #
         self.kwargs = kwargs
 
@@ -543,9 +1061,6 @@ class ProxyPool(ProxyPoolBase):
         # 计数 获取代理重试3次仍然失败 次数
         self.no_valid_proxy_times = 0
 
-        # 上次获取代理时间
-        self.last_get_ts = time.time()
-
         # 记录ProxyItem的update_ts 防止由于重置太快导致重复检测有效性
         self.proxy_item_update_ts_dict = {}
 
@@ -555,10 +1070,19 @@ class ProxyPool(ProxyPoolBase):
         # 是否使用redis介入
         self.redis_conn = kwargs.get("redis_conn", "")
         self.namespace = kwargs.get("namespace", "")
+        self.redis_state_store = None
         if self.redis_conn:
             self.proxy_item_class = RedisProxyItem
             self.kwargs["redis_conn"] = self.redis_conn
             self.kwargs["namespace"] = self.namespace
+            # 代理状态批量读写 由全部 RedisProxyItem 共享 maintain 时一次同步全部代理状态
+            self.redis_state_store = RedisProxyStateStore(
+                self.redis_conn,
+                self.namespace,
+                cache_ttl=kwargs.get("redis_state_cache_ttl", 1),
+                flush_interval=kwargs.get("redis_state_flush_interval", 0.5),
+            )
+            self.kwargs["redis_state_store"] = self.redis_state_store
             # TODO 清理
         else:
             self.proxy_item_class = ProxyItem
@@ -574,11 +1098,20 @@ class ProxyPool(ProxyPoolBase):
     @property
     def queue_size(self):
         """
-            当前代理池中代理数量
+            当前可选代理数量
+        Returns:
+
+        """
+        return len(self.proxy_list) if self.proxy_list is not None else 0
+
+    @property
+    def pool_size(self):
+        """
+            当前代理池中有效代理数量 包括延迟使用的代理
         Returns:
 
         """
-        return self.proxy_queue.qsize() if self.proxy_queue is not None else 0
+        return len(self.proxy_dict)
 
     def clear(self):
         """
@@ -586,9 +1119,17 @@ class ProxyPool(ProxyPoolBase):
         Returns:
 
         """
-        self.proxy_queue = None
+        self.proxy_list = None
+        self._proxy_list_weights = None
         # {代理ip: ProxyItem, ...}
         self.proxy_dict = {}
+        self._delay_heap = []
+        self._delay_id_set = set()
+        self._proxy_url_id_dict = {}
+        self._clear_expired_records()
+        return
+
+    def _clear_expired_records(self):
         # 清理失效代理集合
         _limit = datetime.datetime.now() - datetime.timedelta(minutes=10)
         self.invalid_proxy_dict = {
@@ -604,101 +1145,116 @@ class ProxyPool(ProxyPoolBase):
     def get(self, retry: int = 0) -> dict:
         """
             从代理池中获取代理
+            选择代理无锁 维护工作由后台执行 不在此等待
         Args:
-            retry:
+            retry: 已重试次数 最多选择 3 - retry 次
 
         Returns:
 
         """
-        retry += 1
-        if retry > 3:
-            self.no_valid_proxy_times += 1
-            return None
         # 获取临时代理
         try:
             return self.proxy_temp_cache_list.pop()
-        except:
+        except IndexError:
             pass
-        #
-        if time.time() - self.last_get_ts > 3 * 60:
-            # 3分钟没有获取过 重置一下
-            try:
-                self.reset_proxy_pool()
-            except Exception as e:
-                self.logger.exception(e)
-        # 记录获取时间
-        self.last_get_ts = time.time()
-        #
+        if self.proxy_list is None:
+            # 首次获取 同步加载
+            self._safe_reset_proxy_pool()
+            if self.health_checker is not None:
+                self.health_checker.check()
+        if self.async_refresh:
+            if self._maintain_thread is None:
+                self._start_maintain_thread()
+        elif time.time() >= self._next_maintain_ts:
+            self.maintain()
         self.warn()
-        proxy_item = self.get_random_proxy()
-        if proxy_item:
+        proxies = self._select_proxies(3 - retry)
+        if proxies is None and self._proxy_list_dirty:
+            # 选中的代理均已失效或延迟使用 重建可选代理数组后再试
+            self.rebuild_proxy_list()
+            proxies = self._select_proxies(3 - retry)
+        if proxies is None:
+            self.no_valid_proxy_times += 1
+            if self.no_valid_proxy_times >= 5:
+                # 解决bug: 当爬虫仅剩一个任务时 由于只有一个线程检测代理 而不可用代理又刚好很多（时间越长越多） 可能出现一直获取不到代理的情况
+                # 导致爬虫烂尾
+                try:
+                    self.reset_proxy_pool_async()
+                except Exception as e:
+                    self.logger.exception(e)
+        return proxies
+
+    get_proxy = get
+
+    def _select_proxies(self, times: int) -> dict:
+        """
+            选择可用代理
+        Args:
+            times: 最多选择次数
+
+        Returns:
+
+        """
+        for _ in range(times):
+            proxy_item = self.get_random_proxy()
+            if proxy_item is None:
+                if self.proxy_dict:
+                    # 全部延迟使用 不在此刷新 由后台维护释放到期代理
+                    return None
+                # 代理池为空 同步刷新
+                self._safe_reset_proxy_pool()
+                continue
+            if self.proxy_dict.get(proxy_item.proxy_id) is not proxy_item:
+                # 已下线或已失效 重建可选代理数组后不再被选中
+                continue
             # 不检测
             if not self.check_valid:
-                # 塞回去
-                proxies = proxy_item.get_proxies()
-                self.put_proxy_item(proxy_item)
-                return proxies
+                return proxy_item.get_proxies()
+            is_valid = proxy_item.is_valid(check=0 if self.health_checker else 1)
+            if is_valid == 2:
+                # 延迟使用 到期前不再参与选择
+                self.delay_proxy_item(proxy_item)
+            elif is_valid:
+                # 记录update_ts
+                self.proxy_item_update_ts_dict[proxy_item.proxy_id] = proxy_item.update_ts
+                if proxy_item.use_interval:
+                    proxy_item.use_ts = time.time()
+                return proxy_item.get_proxies()
             else:
-                is_valid = proxy_item.is_valid()
-                if is_valid:
-                    # 记录update_ts
-                    self.proxy_item_update_ts_dict[
-                        proxy_item.proxy_id
-                    ] = proxy_item.update_ts
-                    # 塞回去
-                    proxies = proxy_item.get_proxies()
-                    self.put_proxy_item(proxy_item)
-                    if is_valid == 1:
-                        if proxy_item.use_interval:
-                            proxy_item.use_ts = time.time()
-                        return proxies
-                else:
-                    # 处理失效代理
-                    self.proxy_dict.pop(proxy_item.proxy_id, "")
-                    self.invalid_proxy_dict[
-                        proxy_item.proxy_id
-                    ] = datetime.datetime.now()
-        else:
-            try:
-                self.reset_proxy_pool()
-            except Exception as e:
-                self.logger.exception(e)
-        if self.no_valid_proxy_times >= 5:
-            # 解决bug: 当爬虫仅剩一个任务时 由于只有一个线程检测代理 而不可用代理又刚好很多（时间越长越多） 可能出现一直获取不到代理的情况
-            # 导致爬虫烂尾
-            try:
-                self.reset_proxy_pool()
-            except Exception as e:
-                self.logger.exception(e)
-        return self.get(retry)
-
-    get_proxy = get
+                # 处理失效代理
+                self.discard_proxy_item(proxy_item)
+        return None
 
     def get_random_proxy(self) -> ProxyItem:
         """
-            随机获取代理
+            从可选代理数组中选择代理 O(1) 无锁
+            queue: 轮询 p2c: 随机取两个选评分高的 weighted: 按评分加权随机
+            延迟使用中的代理在重建可选代理数组前仍在数组中 选中时跳过
         Returns:
 
         """
-        if self.proxy_queue is not None:
-            if random.random() < 0.5:
-                # 一半概率检查 这是个高频操作 优化一下
-                if time.time() - self.last_reset_time > self.reset_interval_max:
-                    self.reset_proxy_pool(force=True)
-                else:
-                    min_q_size = (
-                        min(self.max_queue_size / 2, self.real_max_proxy_count / 2)
-                        if self.max_queue_size > 0
-                        else self.real_max_proxy_count / 2
-                    )
-                    if self.proxy_queue.qsize() < min_q_size:
-                        self.reset_proxy_pool()
-            try:
-                return self.proxy_queue.get_nowait()
-            except Exception:
-                pass
+        proxy_list = self.proxy_list
+        if not proxy_list:
+            return None
+        for _ in range(len(proxy_list)):
+            proxy_item = self._choice_proxy(proxy_list)
+            if id(proxy_item) not in self._delay_id_set:
+                return proxy_item
         return None
 
+    def _choice_proxy(self, proxy_list: List[ProxyItem]) -> ProxyItem:
+        if self.select_mode == "queue":
+            return proxy_list[next(self._proxy_list_cursor) % len(proxy_list)]
+        if self.select_mode == "p2c":
+            size = len(proxy_list)
+            proxy_item = proxy_list[int(random.random() * size)]
+            other = proxy_list[int(random.random() * size)]
+            return other if other.score > proxy_item.score else proxy_item
+        proxy_list, cum_weights = self._proxy_list_weights or (proxy_list, None)
+        if not cum_weights:
+            return random.choice(proxy_list)
+        return random.choices(proxy_list, cum_weights=cum_weights)[0]
+
     def append_proxies(self, proxies_list: list) -> int:
         """
             添加代理到代理池
@@ -724,24 +1280,243 @@ class ProxyPool(ProxyPoolBase):
                             proxy_item.proxy_id, 0
                         )
                     self.put_proxy_item(proxy_item)
-                    self.proxy_dict[proxy_item.proxy_id] = proxy_item
                     count += 1
         return count
 
     def put_proxy_item(self, proxy_item: ProxyItem):
         """
-            添加 ProxyItem 到代理池
+            添加 ProxyItem 到代理池 重建可选代理数组后参与选择
         Args:
             proxy_item:
 
         Returns:
 
         """
-        return self.proxy_queue.put_nowait(proxy_item)
+        self.proxy_dict[proxy_item.proxy_id] = proxy_item
+        for _url in proxy_item.proxies.values():
+            self._proxy_url_id_dict[_url] = proxy_item.proxy_id
+        self._proxy_list_dirty = True
+        return
+
+    def discard_proxy_item(self, proxy_item: ProxyItem):
+        """
+            丢弃失效代理 一段时间内不再添加
+        Args:
+            proxy_item:
+
+        Returns:
+
+        """
+        self.proxy_dict.pop(proxy_item.proxy_id, "")
+        self.invalid_proxy_dict[proxy_item.proxy_id] = datetime.datetime.now()
+        self._proxy_list_dirty = True
+        if self.redis_state_store is not None:
+            self.redis_state_store.discard(proxy_item.proxy_id)
+        return
+
+    def delay_proxy_item(self, proxy_item: ProxyItem):
+        """
+            将代理放入延迟堆 到期前不参与选择 到期后由 release_delay_proxy_items 放回
+        Args:
+            proxy_item:
+
+        Returns:
+
+        """
+        release_ts = time.time()
+        if proxy_item.flag == 1:
+            release_ts = max(release_ts, proxy_item.flag_ts + proxy_item.delay)
+        if proxy_item.use_interval:
+            release_ts = max(release_ts, proxy_item.use_ts + proxy_item.use_interval)
+        with self._get_delay_lock():
+            if id(proxy_item) in self._delay_id_set:
+                # 已在延迟堆中
+                return
+            self._delay_id_set.add(id(proxy_item))
+            heapq.heappush(
+                self._delay_heap, (release_ts, next(self._delay_seq), proxy_item)
+            )
+        self._proxy_list_dirty = True
+        return
+
+    def release_delay_proxy_items(self) -> int:
+        """
+            将到期的延迟代理放回代理池
+        Returns:
+            释放的代理数
+        """
+        count = 0
+        now_ts = time.time()
+        with self._get_delay_lock():
+            while self._delay_heap and self._delay_heap[0][0] <= now_ts:
+                _, _, proxy_item = heapq.heappop(self._delay_heap)
+                self._delay_id_set.discard(id(proxy_item))
+                # 延迟期间已被丢弃或代理池已重置
+                if self.proxy_dict.get(proxy_item.proxy_id) is not proxy_item:
+                    continue
+                count += 1
+        if count:
+            self._proxy_list_dirty = True
+        return count
+
+    def rebuild_proxy_list(self):
+        """
+            重建可选代理数组 排除已失效 已下线 延迟使用中的代理 启用健康检查时排除尚未检测的代理
+            新数组整体替换旧数组 选择代理的一方无需加锁
+        Returns:
+
+        """
+        self._proxy_list_dirty = False
+        proxy_list = list(self.proxy_dict.values())
+        if self.health_checker is not None:
+            proxy_list = [x for x in proxy_list if x.update_ts]
+        if self._delay_id_set:
+            with self._get_delay_lock():
+                delay_id_set = set(self._delay_id_set)
+            proxy_list = [x for x in proxy_list if id(x) not in delay_id_set]
+        if self.select_mode == "weighted":
+            cum_weights = list(itertools.accumulate(x.score for x in proxy_list))
+            if not cum_weights or cum_weights[-1] <= 0:
+                cum_weights = None
+            self._proxy_list_weights = (proxy_list, cum_weights)
+        self.proxy_list = proxy_list
+        return
+
+    def maintain(self):
+        """
+            维护代理池 同步redis中的代理状态 释放到期的延迟代理 按需刷新代理池 检测到期的代理 重建可选代理数组
+        Returns:
+
+        """
+        self._next_maintain_ts = time.time() + self.maintain_interval
+        if self.redis_state_store is not None:
+            self.redis_state_store.sync(list(self.proxy_dict))
+        if self._delay_heap:
+            self.release_delay_proxy_items()
+        if time.time() - self.last_reset_time > self.reset_interval_max:
+            self.reset_proxy_pool_async(force=True)
+        else:
+            min_q_size = (
+                min(self.max_queue_size / 2, self.real_max_proxy_count / 2)
+                if self.max_queue_size > 0
+                else self.real_max_proxy_count / 2
+            )
+            if self.pool_size < min_q_size:
+                self.reset_proxy_pool_async()
+        if self.health_checker is not None:
+            if self.async_refresh:
+                self.health_checker.check_async()
+            else:
+                self.health_checker.check()
+        # 按评分加权时 评分随使用结果变化 每次都重建
+        if self._proxy_list_dirty or self.select_mode == "weighted":
+            self.rebuild_proxy_list()
+        return
+
+    def _start_maintain_thread(self):
+        # 必须用时调用 否则 可能存在 gevent patch前 threading就已经被导入 导致的patch失效
+        import threading
+
+        with self._get_delay_lock():
+            if self._maintain_thread is not None:
+                return
+            self._maintain_exit_event = threading.Event()
+            self._maintain_thread = threading.Thread(
+                target=self._maintain_worker, daemon=True
+            )
+            self._maintain_thread.start()
+        return
+
+    def _maintain_worker(self):
+        while not self._maintain_exit_event.wait(self.maintain_interval):
+            try:
+                self.maintain()
+            except Exception as e:
+                self.logger.exception(e)
+        return
+
+    def close(self):
+        """
+            停止后台维护及代理检测 写入尚未提交的redis代理状态
+        Returns:
+
+        """
+        if self._maintain_exit_event is not None:
+            self._maintain_exit_event.set()
+            self._maintain_thread.join()
+        if self.health_checker is not None:
+            self.health_checker.close()
+        if self.redis_state_store is not None:
+            # 之后的写入立即提交
+            self.redis_state_store.flush_interval = 0
+            self.redis_state_store.flush()
+        return
+
+    def _get_delay_lock(self):
+        if not self._delay_lock:
+            # 必须用时调用 否则 可能存在 gevent patch前 threading就已经被导入 导致的lock patch失效
+            import threading
+
+            self._delay_lock = threading.Lock()
+        return self._delay_lock
+
+    def report(self, proxies: dict, *, success: bool, latency: float = None) -> bool:
+        """
+            记录代理的使用结果 用于代理评分
+        Args:
+            proxies:
+            success: 是否成功
+            latency: 耗时 秒
+
+        Returns:
+            是否找到该代理
+        """
+        if not proxies:
+            return False
+        proxy_item = None
+        for _url in proxies.values():
+            proxy_id = self._proxy_url_id_dict.get(_url)
+            if proxy_id:
+                proxy_item = self.proxy_dict.get(proxy_id)
+                break
+        if proxy_item is None:
+            return False
+        proxy_item.report(success, latency)
+        return True
+
+    def reset_proxy_pool_async(self, force: bool = False):
+        """
+            在后台刷新代理池 已有刷新在进行时直接返回
+            未开启 async_refresh 或代理池尚未初始化时同步刷新
+        Args:
+            force: 是否强制刷新代理池
+
+        Returns:
+
+        """
+        if not self.async_refresh or self.proxy_list is None:
+            return self.reset_proxy_pool(force=force)
+        if self._refresh_thread is not None and self._refresh_thread.is_alive():
+            return
+        # 必须用时调用 否则 可能存在 gevent patch前 threading就已经被导入 导致的patch失效
+        import threading
+
+        self._refresh_thread = threading.Thread(
+            target=self._safe_reset_proxy_pool, args=(force,), daemon=True
+        )
+        self._refresh_thread.start()
+        return
+
+    def _safe_reset_proxy_pool(self, force: bool = False):
+        try:
+            self.reset_proxy_pool(force=force)
+        except Exception as e:
+            self.logger.exception(e)
+        return
 
     def reset_proxy_pool(self, force: bool = False):
         """
-            重置代理池
+            刷新代理池
         Args:
             force: 是否强制重置代理池
 
@@ -756,14 +1531,11 @@ class ProxyPool(ProxyPoolBase):
         with self.reset_lock:
             if (
                 force
-                or self.proxy_queue is None
-                or (
-                    self.max_queue_size > 0
-                    and self.proxy_queue.qsize() < self.max_queue_size / 2
-                )
+                or self.proxy_list is None
+                or (self.max_queue_size > 0 and self.pool_size < self.max_queue_size / 2)
                 or (
                     self.max_queue_size < 0
-                    and self.proxy_queue.qsize() < self.real_max_proxy_count / 2
+                    and self.pool_size < self.real_max_proxy_count / 2
                 )
                 or self.no_valid_proxy_times >= 5
             ):
@@ -775,29 +1547,66 @@ class ProxyPool(ProxyPoolBase):
                         )
                         time.sleep(1)
                 else:
-                    self.clear()
-                    if self.proxy_queue is None:
-                        import queue
-
-                        self.proxy_queue = queue.Queue()
-                    # TODO 这里获取到的可能重复
-                    proxies_list = get_proxy_from_url(**self.kwargs)
-                    self.real_max_proxy_count = len(proxies_list)
-                    if 0 < self.max_queue_size < self.real_max_proxy_count:
-                        proxies_list = random.sample(proxies_list, self.max_queue_size)
-                    _valid_count = self.append_proxies(proxies_list)
-                    self.last_reset_time = time.time()
-                    self.no_valid_proxy_times = 0
-                    self.logger.debug(
-                        "重置代理池成功: 获取{}, 成功添加{}, 失效{},  当前代理数{},".format(
-                            len(proxies_list),
-                            _valid_count,
-                            len(self.invalid_proxy_dict),
-                            len(self.proxy_dict),
-                        )
-                    )
+                    self.refresh_proxy_pool()
         return
 
+    def refresh_proxy_pool(self) -> int:
+        """
+            增量刷新代理池
+            对比代理源 仅添加新代理 下线已移除的代理 仍存在的代理保留 ProxyItem 及其评分等状态
+        Returns:
+            新添加的代理数
+        """
+        self._clear_expired_records()
+        # TODO 这里获取到的可能重复
+        proxies_list = get_proxy_from_url(**self.kwargs)
+        self.real_max_proxy_count = len(proxies_list)
+
+        # 区分已有代理与新代理 已有代理通过url快速查找 不再构造ProxyItem
+        alive_id_set = set()
+        new_proxies_list = []
+        for proxies in proxies_list:
+            if not proxies:
+                continue
+            proxy_id = None
+            for _url in proxies.values():
+                proxy_id = self._proxy_url_id_dict.get(_url)
+                break
+            if proxy_id is not None and proxy_id in self.proxy_dict:
+                alive_id_set.add(proxy_id)
+            else:
+                new_proxies_list.append(proxies)
+
+        # 下线已从代理源移除的代理
+        retired_count = 0
+        for proxy_id in [x for x in self.proxy_dict if x not in alive_id_set]:
+            proxy_item = self.proxy_dict.pop(proxy_id)
+            for _url in proxy_item.proxies.values():
+                if self._proxy_url_id_dict.get(_url) == proxy_id:
+                    self._proxy_url_id_dict.pop(_url)
+            if self.redis_state_store is not None:
+                self.redis_state_store.discard(proxy_id)
+            retired_count += 1
+
+        if self.max_queue_size > 0:
+            room = max(self.max_queue_size - len(self.proxy_dict), 0)
+            if len(new_proxies_list) > room:
+                new_proxies_list = random.sample(new_proxies_list, room)
+        _valid_count = self.append_proxies(new_proxies_list)
+        self.rebuild_proxy_list()
+        self.last_reset_time = time.time()
+        self.no_valid_proxy_times = 0
+        self.logger.debug(
+            "刷新代理池成功: 获取{}, 成功添加{}, 下线{}, 失效{},  当前代理数{},".format(
+                len(proxies_list),
+                _valid_count,
+                retired_count,
+                len(self.invalid_proxy_dict),
+                len(self.proxy_dict),
+            )
+        )
+        return _valid_count
+
     def tag_proxy(
         self, proxies_list: Union[List, Dict], flag: int, *, delay=30
     ) -> bool:
@@ -817,19 +1626,25 @@ class ProxyPool(ProxyPoolBase):
             return False
         if not isinstance(proxies_list, list):
             proxies_list = [proxies_list]
-        for proxies in proxies_list:
-            if not proxies:
-                continue
-            proxy_id = self.proxy_item_class(proxies, **self.kwargs).proxy_id
-            if proxy_id not in self.proxy_dict:
-                continue
-            self.proxy_dict[proxy_id].flag = flag
-            self.proxy_dict[proxy_id].flag_ts = time.time()
-            self.proxy_dict[proxy_id].delay = delay
-            if flag == -1:
-                # 处理失效代理
-                self.proxy_dict.pop(proxy_id, "")
-                self.invalid_proxy_dict[proxy_id] = datetime.datetime.now()
+        # 使用redis时 批量写入
+        batch = (
+            self.redis_state_store.batch()
+            if self.redis_state_store is not None
+            else nullcontext()
+        )
+        with batch:
+            for proxies in proxies_list:
+                if not proxies:
+                    continue
+                proxy_id = self.proxy_item_class(proxies, **self.kwargs).proxy_id
+                if proxy_id not in self.proxy_dict:
+                    continue
+                self.proxy_dict[proxy_id].flag = flag
+                self.proxy_dict[proxy_id].flag_ts = time.time()
+                self.proxy_dict[proxy_id].delay = delay
+                if flag == -1:
+                    # 处理失效代理
+                    self.discard_proxy_item(self.proxy_dict[proxy_id])
 
         return True
 
@@ -886,9 +1701,8 @@ class ProxyTunnelPool(ProxyPool):
         # 特殊处理
         proxies = self.get()
         proxy_obj = ProxyItem(proxies=proxies, **self.kwargs)
-        proxy_ip_port = ProxyItem.parse_proxies(proxies)["ip_port"]
-        self.proxy_queue.append(proxy_obj)
-        self.proxy_dict[proxy_ip_port] = proxy_obj
+        self.put_proxy_item(proxy_obj)
+        self.rebuild_proxy_list()
 
     def get(self, retry=0):
         raise NotImplementedError
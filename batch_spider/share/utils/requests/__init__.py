@@ -11,23 +11,25 @@ def response_to_file(
     file_obj,
     show_progress: bool = False,
     progress_config: dict = None,
+    chunk_size: int = CONTENT_CHUNK_SIZE,
 ):
     """
-
+        将响应内容写入文件
+        若响应内容尚未读取(stream=True) 则分块写入 不在内存中缓存完整内容
     Args:
         response:
-        file_obj:
+        file_obj: 需实现 write 方法
         show_progress:
         progress_config: 进度条配置项
             若无 则
+        chunk_size: 分块大小
 
 
     Returns:
 
     """
-    if not show_progress:
-        file_obj.write(response.content)
-    else:
+    t = None
+    if show_progress:
         #
         _progress_config = {
             "desc": "文件下载进度:",
@@ -35,15 +37,22 @@ def response_to_file(
         if progress_config:
             _progress_config.update(progress_config)
         #
-        content_length = response.headers["Content-Length"]
-        t = tqdm.tqdm(desc=progress_config["desc"], total=int(content_length))
-        _iter = response.iter_content(CONTENT_CHUNK_SIZE)
-        while 1:
-            try:
-                _content = next(_iter)
-            except StopIteration:
-                break
+        content_length = response.headers.get("Content-Length")
+        t = tqdm.tqdm(
+            desc=_progress_config["desc"],
+            total=int(content_length) if content_length else None,
+        )
+    try:
+        if response._content_consumed:
+            # 内容已在内存中
+            _iter = [response.content]
+        else:
+            _iter = response.iter_content(chunk_size)
+        for _content in _iter:
             file_obj.write(_content)
-            t.update(len(_content))
-        t.close()
+            if t is not None:
+                t.update(len(_content))
+    finally:
+        if t is not None:
+            t.close()
     return
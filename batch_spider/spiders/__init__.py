@@ -13,6 +13,8 @@ from batch_spider.network.sample_response import Response
 
 from .base import Spider
 from .batch_spider import BatchSpider, JsonTask, SingleBatchSpider  # noqa
+from .launcher import MultiProcessLauncher
+from .pipeline import Item
 
 __all__ = [
     "BatchSpider",
@@ -21,4 +23,6 @@ __all__ = [
     "Response",
     "SingleBatchSpider",
     "JsonTask",
+    "MultiProcessLauncher",
+    "Item",
 ]
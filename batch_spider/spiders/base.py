@@ -16,12 +16,17 @@ warnings.filterwarnings("ignore")  # isort:skip
 #
 import threading
 import time
+from collections import Counter
 from queue import Empty, Queue
 from typing import Callable, List, Optional, Tuple, Union, Dict
 
+import gevent
+from gevent.pool import Pool
+
 from batch_spider import util
 from batch_spider.network import downloader
 from batch_spider.spiders import Request, Response
+from batch_spider.spiders.pipeline import ItemPipeline
 from batch_spider.utils import log
 
 logger = log.get_logger(__file__)
@@ -41,8 +46,27 @@ class Spider(object):
         self.db = None
         # oss 入库
         self.oss_db = None
+        # 回调中 yield 的字典数据(Item) 经 item_pipeline 缓冲后由写入线程调用 self.db.add_many 批量入库
+        # 首次产生数据时创建 入库失败重试 item_max_retry 次后写入 item_dead_letter_file
+        self.item_pipeline: ItemPipeline = None
+        self.item_table_name = kwargs.get("item_table_name", "")
+        self.item_flush_size = kwargs.get("item_flush_size", 1000)
+        self.item_flush_interval = kwargs.get("item_flush_interval", 1)
+        self.item_writer_num = kwargs.get("item_writer_num", 2)
+        self.item_max_retry = kwargs.get("item_max_retry", 3)
+        self.item_dead_letter_file = kwargs.get("item_dead_letter_file", "")
+        self._item_pipeline_lock = threading.Lock()
         # 线程池
         self.pool_size = kwargs.get("pool_size", 100)
+        # 执行引擎 thread: 启动 pool_size 个常驻线程  gevent: 使用 gevent.pool.Pool 按需为每个请求启动协程
+        # gevent 模式下协程仅在请求处理期间存在 适合数千并发的场景
+        self.engine = kwargs.get("engine", "thread")
+        self._pool: Pool = None
+        # 下载与解析分离 大于0时开启 下载线程只负责下载 Response 放入 response_queue 由 parse_pool_size 个解析线程执行回调
+        # 两者可分别设置并发数 response_queue 满时下载线程阻塞等待
+        self.parse_pool_size = kwargs.get("parse_pool_size", 0)
+        self.parse_queue_size = kwargs.get("parse_queue_size", 100)
+        self.response_queue: Queue = None
         self.event_exit = threading.Event()
         self.request_queue = Queue()
 
@@ -50,6 +74,9 @@ class Spider(object):
         self._thread_status = {}
         # request重试次数限制
         self.max_request_retrys = 9999
+        # 运行统计 request: 处理请求数 download_error: 下载异常数 callback_error: 回调异常数 request_dropped: 超出重试丢弃数
+        # item_error: 无法放入入库管道而丢弃的数据数
+        self.stats = Counter()
 
         # 内存使用上限 比例 默认0.9 超过0.8则主动被kill
         self.memory_utilization_limit = 0.8
@@ -88,6 +115,12 @@ class Spider(object):
             self.close()
         except Exception as e:
             logger.exception(e)
+        # 写入缓冲的数据 须在关闭数据库连接之前
+        if self.item_pipeline:
+            try:
+                self.item_pipeline.close()
+            except Exception as e:
+                logger.exception(e)
         # 关闭默认的一些连接
         for _instince in [self.db, self.oss_db, self.downloader]:
             if _instince:
@@ -177,21 +210,13 @@ class Spider(object):
             try:
                 request_obj = self.request_queue.get(True, 1)
                 if not request_obj:
+                    self.request_queue.task_done()
+                    # 结束标记 由run在所有请求处理完成后放入 用于立即唤醒等待中的线程
+                    if self.event_exit.is_set():
+                        break
                     continue
                 # 重试次数限制
-                if request_obj.retry > self.max_request_retrys:
-                    put_retry = getattr(self.request_queue, "put_retry", None)
-                    if put_retry:
-                        # 重试置为0 然后丢入重试队列  只对RedisQueue有效
-                        request_obj.retry = 0
-                        put_retry(request_obj)
-                    # 重试次数超出限制 丢弃任务
-                    logger.warn(
-                        "retry times over limit {}, task delete: {}".format(
-                            self.max_request_retrys, request_obj
-                        )
-                    )
-                    self.request_queue.task_done()
+                if self._drop_over_retry_request(request_obj):
                     continue
             except Exception as e:
                 if not isinstance(e, Empty):
@@ -201,53 +226,257 @@ class Spider(object):
                 self._thread_status[thread_num] = 0
                 continue
             self._thread_status[thread_num] = 1
-            if not isinstance(request_obj, Request):
-                # todo 处理
+            handed_over = False
+            try:
+                if not isinstance(request_obj, Request):
+                    # todo 处理
+                    logger.error("Not a Request Object: {}".format(request_obj))
+                    continue
+                handed_over = self._handle_request(request_obj)
+            finally:
+                # 必须调用 否则 run 中的完成检测会一直等待
+                # 已交给解析线程的请求 由解析线程在回调结束后调用
+                if not handed_over:
+                    self.request_queue.task_done()
+                self._thread_status[thread_num] = 0
+        return
+
+    def handle_response(self, thread_num: int):
+        """
+            解析线程 从 response_queue 中取出 Response 执行回调
+        Args:
+            thread_num:
+
+        Returns:
+
+        """
+        while 1:
+            try:
+                item = self.response_queue.get(True, 1)
+            except Empty:
+                if self.event_exit.is_set():
+                    break
                 continue
+            if item is None:
+                # 结束标记
+                if self.event_exit.is_set():
+                    break
+                continue
+            try:
+                self._parse_response(*item)
+            finally:
+                self.request_queue.task_done()
+        return
 
-            _request = request_obj.request
-            if _request:
-                try:
-                    _response = self.download(
-                        _request,
-                        downloader=request_obj.downloader,
-                        request_obj=request_obj,
-                    )
-                except Exception as e:
-                    logger.exception(e)
-                    _response = None
-            else:
-                _response = None
-            # 记录下载次数
-            request_obj.retry += 1
-
-            # response
-            if isinstance(_response, tuple):
-                response = Response(_response[0], request_obj, exception=_response[1])
-            elif isinstance(_response, Response):
-                response = _response
-            else:
-                response = Response(_response, request_obj)
+    def _active_request_count(self) -> int:
+        """
+            正在处理中的请求数
+        Returns:
+
+        """
+        if self._pool is not None:
+            return len(self._pool)
+        return sum(self._thread_status.values())
+
+    def _dispatch_request(self):
+        """
+            gevent引擎 从 request_queue 中取出请求 交给协程池处理
+            协程池满时阻塞 以此控制并发数
+        Returns:
+
+        """
+        while 1:
+            try:
+                request_obj = self.request_queue.get(True, 1)
+            except Empty:
+                if self.event_exit.is_set():
+                    break
+                continue
+            if not request_obj:
+                self.request_queue.task_done()
+                if self.event_exit.is_set():
+                    break
+                continue
+            if self._drop_over_retry_request(request_obj):
+                continue
+            self._pool.spawn(self._handle_pool_request, request_obj)
+        self._pool.join()
+        return
+
+    def _drop_over_retry_request(self, request_obj: Request) -> bool:
+        """
+            重试次数超出限制时丢弃请求
+        Args:
+            request_obj:
+
+        Returns:
+            是否已丢弃
+        """
+        if getattr(request_obj, "retry", 0) <= self.max_request_retrys:
+            return False
+        put_retry = getattr(self.request_queue, "put_retry", None)
+        if put_retry:
+            # 重试置为0 然后丢入重试队列  只对RedisQueue有效
+            request_obj.retry = 0
+            put_retry(request_obj)
+        self.stats["request_dropped"] += 1
+        # 重试次数超出限制 丢弃任务
+        logger.warn(
+            "retry times over limit {}, task delete: {}".format(
+                self.max_request_retrys, request_obj
+            )
+        )
+        self.request_queue.task_done()
+        return True
 
+    def _handle_pool_request(self, request_obj: Request):
+        """
+            gevent引擎 协程中处理单个请求
+        Args:
+            request_obj:
+
+        Returns:
+
+        """
+        handed_over = False
+        try:
+            if not isinstance(request_obj, Request):
+                logger.error("Not a Request Object: {}".format(request_obj))
+                return
+            handed_over = self._handle_request(request_obj)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            if not handed_over:
+                self.request_queue.task_done()
+        return
+
+    def _handle_request(self, request_obj: Request) -> bool:
+        """
+            下载并回调处理单个请求
+        Args:
+            request_obj:
+
+        Returns:
+            是否已交给解析线程处理
+        """
+        response = self._download_request(request_obj)
+        if self.response_queue is not None:
+            # 队列满时阻塞 避免下载速度远超解析速度时内存暴涨
+            self.response_queue.put((request_obj, response))
+            return True
+        self._parse_response(request_obj, response)
+        return False
+
+    def _download_request(self, request_obj: Request) -> Response:
+        """
+            下载请求
+        Args:
+            request_obj:
+
+        Returns:
+
+        """
+        self.stats["request"] += 1
+        _request = request_obj.request
+        if _request:
             try:
-                _callback = request_obj.callback
-                if not _callback:
-                    _callback = self.parse
-                if isinstance(_callback, (str, bytes)):
-                    _callback = getattr(self, _callback)
-                result = _callback(response)
-                if result is not None:
-                    # 迭代
-                    for item in result:
-                        if isinstance(item, Request):
-                            self.request_queue.put(item)
-                        # todo  其他类型
-                        pass
+                _response = self.download(
+                    _request,
+                    downloader=request_obj.downloader,
+                    request_obj=request_obj,
+                )
             except Exception as e:
                 logger.exception(e)
-            self.request_queue.task_done()
+                self.stats["download_error"] += 1
+                _response = None
+        else:
+            _response = None
+        # 记录下载次数
+        request_obj.retry += 1
+
+        # response
+        if isinstance(_response, tuple):
+            response = Response(_response[0], request_obj, exception=_response[1])
+        elif isinstance(_response, Response):
+            response = _response
+        else:
+            response = Response(_response, request_obj)
+        return response
+
+    def _parse_response(self, request_obj: Request, response: Response):
+        """
+            执行请求的回调函数 回调中产生的新请求放回 request_queue
+        Args:
+            request_obj:
+            response:
+
+        Returns:
+
+        """
+        try:
+            _callback = request_obj.callback
+            if not _callback:
+                _callback = self.parse
+            if isinstance(_callback, (str, bytes)):
+                _callback = getattr(self, _callback)
+            result = _callback(response)
+            if result is not None:
+                # 迭代
+                for item in result:
+                    if isinstance(item, Request):
+                        self.request_queue.put(item)
+                    elif isinstance(item, dict):
+                        self._put_item(item)
+                    # todo  其他类型
+        except Exception as e:
+            logger.exception(e)
+            self.stats["callback_error"] += 1
+        return
+
+    def _put_item(self, item: dict):
+        """
+            数据放入入库管道 失败时记录日志并丢弃 不影响回调中后续产生的请求
+        Args:
+            item:
+
+        Returns:
+
+        """
+        try:
+            self.get_item_pipeline().put(item)
+        except Exception as e:
+            self.stats["item_error"] += 1
+            logger.error("数据入库失败 已丢弃: {} {}".format(e, item))
         return
 
+    def _join_request_queue(self, timeout: float = None) -> bool:
+        """
+            等待 request_queue 中所有请求处理完成(包括回调中产生的新请求)
+            基于 task_done 计数 最后一个回调结束后立即返回
+        Args:
+            timeout: 最长等待时间
+
+        Returns:
+            是否已全部完成
+        """
+        queue = self.request_queue
+        if not hasattr(queue, "unfinished_tasks"):
+            # 不支持 task_done 计数的队列 退回到轮询检测
+            if queue.qsize() <= 0 and self._active_request_count() == 0:
+                return True
+            time.sleep(timeout)
+            return False
+        all_tasks_done = getattr(queue, "all_tasks_done", None)
+        if all_tasks_done is not None:
+            # queue.Queue
+            with all_tasks_done:
+                if queue.unfinished_tasks:
+                    all_tasks_done.wait(timeout)
+                return not queue.unfinished_tasks
+        # gevent.queue.Queue
+        return bool(queue.join(timeout=timeout))
+
     def make_request(self, *args, **kwargs) -> Optional[Request]:
         """
             定义如何生成request
@@ -291,12 +520,24 @@ class Spider(object):
         return True
 
     def run(self, **kwargs):
+        # 开启解析线程
+        parse_thread_list = []
+        if self.parse_pool_size > 0:
+            self.response_queue = Queue(self.parse_queue_size)
+            for i in range(self.parse_pool_size):
+                t = threading.Thread(target=self.handle_response, args=(i,))
+                t.start()
+                parse_thread_list.append(t)
         # 开启处理线程池
         thread_list = []
-        for i in range(self.pool_size):
-            t = threading.Thread(target=self.handle_request, args=(i,))
-            t.start()
-            thread_list.append(t)
+        if self.engine == "gevent":
+            self._pool = Pool(self.pool_size)
+            thread_list.append(gevent.spawn(self._dispatch_request))
+        else:
+            for i in range(self.pool_size):
+                t = threading.Thread(target=self.handle_request, args=(i,))
+                t.start()
+                thread_list.append(t)
 
         max_queue_size = min(100, self.pool_size)
 
@@ -363,24 +604,26 @@ class Spider(object):
                 logger.debug("break spider")
         except Exception as e:
             raise_exception = e
-        while 1:
-            if self.request_queue.qsize() <= 0:
-                # 当所有线程都无任务时 停止爬虫
-                if sum(self._thread_status.values()) == 0:
-                    self.event_exit.set()
-                    break
+        # 等待所有请求处理完成
+        while not self._join_request_queue(timeout=5):
             if spider_break:
                 logger.debug(
                     "爬虫主线程已被终止...  等待子线程结束中... 剩余任务: {} 活动线程数: {} 终止原因: {}".format(
                         self.request_queue.qsize(),
-                        sum(self._thread_status.values()),
+                        self._active_request_count(),
                         self._close_reason,
                     )
                 )
-            time.sleep(5)
+        self.event_exit.set()
+        # 唤醒阻塞在 get 上的线程 使其立即退出
+        if hasattr(self.request_queue, "unfinished_tasks"):
+            for i in range(len(thread_list)):
+                self.request_queue.put(None)
+        for i in range(len(parse_thread_list)):
+            self.response_queue.put(None)
 
         # 2018/06/08 上边这几行代码 可以代替join  应该是这样的  出了问题再说啊
-        for t in thread_list:
+        for t in thread_list + parse_thread_list:
             t.join()
         logger.debug("子线程关闭成功")
 
@@ -436,6 +679,28 @@ class Spider(object):
         self._close_reason = "Killed(suicide)"
         return
 
+    def get_item_pipeline(self) -> ItemPipeline:
+        """
+            获取数据入库管道 首次调用时创建
+        Returns:
+
+        """
+        if self.item_pipeline is None:
+            with self._item_pipeline_lock:
+                if self.item_pipeline is None:
+                    if not self.db:
+                        raise ValueError("mysql入库失败: mysql_db is None")
+                    self.item_pipeline = ItemPipeline(
+                        self.db,
+                        flush_size=self.item_flush_size,
+                        flush_interval=self.item_flush_interval,
+                        writer_num=self.item_writer_num,
+                        max_retry=self.item_max_retry,
+                        dead_letter_file=self.item_dead_letter_file,
+                        table_name=self.item_table_name,
+                    )
+        return self.item_pipeline
+
     def store_data(
         self,
         data: Union[List, Dict],
@@ -443,6 +708,7 @@ class Spider(object):
         table_name: str = "",
         mysql: bool = True,
         mysql_db=None,
+        async_store: bool = False,
         **kwargs
     ):
         """
@@ -452,12 +718,18 @@ class Spider(object):
             table_name:
             mysql: 是否保存到mysql
             mysql_db: 是否使用指定的mysql入库连接  可能存在入库mysql与self.db不一致的情况
+            async_store: 是否放入 item_pipeline 异步批量入库 此时忽略 mysql_db 及 kwargs
             **kwargs:
 
         Returns:
 
         """
         resp = None
+        if mysql and async_store:
+            pipeline = self.get_item_pipeline()
+            for item in data if isinstance(data, list) else [data]:
+                pipeline.put(item, table_name=table_name)
+            return resp
         # mysql入库
         if mysql:
             mysql_db = mysql_db or self.db
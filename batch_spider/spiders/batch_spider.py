@@ -3,15 +3,18 @@ from batch_spider.spiders import Request, Response, Spider  # isort:skip
 import copy
 import datetime
 import json
+import threading
 import time
+from collections import deque
+from queue import Queue
 from typing import Union, AnyStr
 from concurrent.futures import ThreadPoolExecutor
-from queue import Empty, Full, Queue
 
 import redis
 
 from batch_spider import setting, util
 from batch_spider.db import DB
+from batch_spider.spiders import task_codec
 from batch_spider.utils import log
 
 logger = log.get_logger(__file__)
@@ -57,6 +60,10 @@ class JsonTask(object):
     {"name": "b", "age": 1, "page": 2}
     """
 
+    # _task: 任务字典  _encoded: to_json 缓存  _shared: 任务字典是否与其他对象共用(写时复制)
+    # 保留 __dict__ 以兼容给对象设置任务字段之外的属性
+    __slots__ = ("_task", "_encoded", "_shared", "__dict__")
+
     def __init__(self, task=None, **kwargs):
         """
 
@@ -65,30 +72,59 @@ class JsonTask(object):
             **kwargs:
         """
         super().__init__(**kwargs)
+        shared = False
         if isinstance(task, (str, bytes)):
-            task = json.loads(task)
-        if isinstance(task, JsonTask):
-            task = json.loads(task.to_json())
+            task = task_codec.decode_task(task)
+        elif isinstance(task, JsonTask):
+            # 与原对象共用任务字典 任意一方修改时再复制
+            task._shared = True
+            task = task._task
+            shared = True
+        elif isinstance(task, dict):
+            task = copy.deepcopy(task)
         if not isinstance(task, dict):
             raise TypeError("task is not a dict: {} but a {}".format(task, type(task)))
-        self._task = copy.deepcopy(task)
+        self._set_task(task, shared=shared)
 
     def __str__(self):
         return self.__repr__()
 
+    @classmethod
+    def from_dict(cls, task: dict) -> "JsonTask":
+        """
+            直接使用给定的字典创建对象 不做复制
+            用于刚解码出来的任务 调用方不应再修改此字典
+        Args:
+            task:
+
+        Returns:
+
+        """
+        if not isinstance(task, dict):
+            raise TypeError("task is not a dict: {} but a {}".format(task, type(task)))
+        task_obj = cls.__new__(cls)
+        task_obj._set_task(task)
+        return task_obj
+
     def __repr__(self):
         return self.to_json()
 
     def __getattr__(self, key):
+        if key in JsonTask.__slots__:
+            raise AttributeError(key)
         if key == "retry" and "retry" not in self._task:
             return 0
-        return self._task.get(key)
+        value = self._task.get(key)
+        if isinstance(value, (list, dict)):
+            # 可变对象可能被外部修改 共用时先复制 并使缓存失效
+            value = self._writable_task().get(key)
+        return value
 
     def __setattr__(self, key, value):
-        if key != "_task" and key in self._task:
-            self._task[key] = value
-        elif key == "retry":
-            self._task[key] = value
+        if key in JsonTask.__slots__:
+            super().__setattr__(key, value)
+        elif key in self._task or key == "retry":
+            self._writable_task()[key] = value
         else:
             super().__setattr__(key, value)
 
@@ -112,13 +148,19 @@ class JsonTask(object):
         Returns:
 
         """
+        if not update and (keep_retry or "retry" not in self._task):
+            # 无需修改 共用任务字典
+            self._shared = True
+            _obj = self.__class__.from_dict(self._task)
+            _obj._shared = True
+            _obj._encoded = self._encoded
+            return _obj
         _task = self._task.copy()
         if not keep_retry:
             _task.pop("retry", 0)
         if update:
             _task.update(update)
-        _obj = JsonTask(task=_task)
-        return _obj
+        return self.__class__.from_dict(copy.deepcopy(_task))
 
     def generate_tasks(
         self,
@@ -143,34 +185,42 @@ class JsonTask(object):
         Returns:
 
         """
+        base_task = self._task.copy()
+        if not keep_retry:
+            base_task.pop("retry", 0)
         task_list = []
         for i in range(start, end):
-            _task = self._task.copy()
+            _task = base_task.copy()
             _task[field] = i
-            if not keep_retry:
-                _task.pop("retry", 0)
             if json_dumps:
                 _task = json.dumps(_task)
             if is_obj:
-                _task = self.__class__(task=_task)
+                if json_dumps:
+                    _task = self.__class__(task=_task)
+                else:
+                    _task = self.__class__.from_dict(copy.deepcopy(_task))
             task_list.append(_task)
         return task_list
 
     def to_json(self):
         """
             转换为json字符串 主要为了存入redis
+            结果会被缓存 直到任务被修改
         Returns:
 
         """
-        return json.dumps(self._task, ensure_ascii=False)
+        if self._encoded is None:
+            self._encoded = json.dumps(self._task, ensure_ascii=False)
+        return self._encoded
 
     def to_dict(self):
         """
             返回字典 主要为了存入mysql
+            返回的字典可能被外部修改 因此会使缓存失效
         Returns:
 
         """
-        return self._task
+        return self._writable_task()
 
     def update(self, *args, **kwargs):
         """
@@ -182,7 +232,177 @@ class JsonTask(object):
         Returns:
 
         """
-        return self._task.update(*args, **kwargs)
+        return self._writable_task().update(*args, **kwargs)
+
+    def _set_task(self, task: dict, shared: bool = False):
+        self._task = task
+        self._encoded = None
+        self._shared = shared
+
+    def _writable_task(self) -> dict:
+        """
+            获取可修改的任务字典 共用时先深复制一份 避免修改嵌套的列表或字典时影响其他对象
+        Returns:
+
+        """
+        if self._shared:
+            self._task = copy.deepcopy(self._task)
+            self._shared = False
+        self._encoded = None
+        return self._task
+
+
+class TaskPusher(object):
+    """
+    批量写入任务到redis
+        每次 push 的任务列表使用 pipeline 按 chunk_size 分批 lpush 一次往返完成
+        async_push 为True时 由后台线程写入 生产者(如读取mysql)与写入redis可同时进行
+        两者之间使用有界队列 队列满时生产者阻塞 避免内存暴涨
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.StrictRedis,
+        *,
+        async_push: bool = True,
+        chunk_size: int = 1000,
+        maxsize: int = 2,
+    ):
+        self.redis_conn = redis_conn
+        self.async_push = async_push
+        self.chunk_size = chunk_size
+        # 已写入任务条数
+        self.count = 0
+
+        self._queue = Queue(maxsize)
+        self._error = None
+        self._thread = None
+        if self.async_push:
+            self._thread = threading.Thread(target=self._push_worker, daemon=True)
+            self._thread.start()
+
+    def push(self, task_key: str, task_list: list):
+        """
+            写入任务
+        Args:
+            task_key:
+            task_list:
+
+        Returns:
+
+        """
+        if not task_list:
+            return
+        if not self.async_push:
+            return self._push(task_key, task_list)
+        if self._error:
+            raise self._error
+        self._queue.put((task_key, task_list))
+        return
+
+    def join(self):
+        """
+            等待所有任务写入完成 写入出错时抛出异常
+        Returns:
+
+        """
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error:
+            raise self._error
+        return
+
+    def _push(self, task_key: str, task_list: list):
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for i in range(0, len(task_list), self.chunk_size):
+            pipe.lpush(task_key, *task_list[i : i + self.chunk_size])
+        pipe.execute()
+        self.count += len(task_list)
+        return
+
+    def _push_worker(self):
+        while 1:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error:
+                # 已出错 丢弃剩余任务 由 join 抛出异常
+                continue
+            try:
+                self._push(*item)
+            except Exception as e:
+                self._error = e
+        return
+
+
+class TaskPushBatcher(object):
+    """
+    合并多个协程的 lpush
+        第一个调用者作为leader 等待 interval 秒收集其他调用者的任务 然后使用一个 pipeline 统一写入
+        其他调用者等待写入完成后返回各自的结果
+    """
+
+    def __init__(self, redis_conn: redis.StrictRedis, interval: float = 0.005):
+        self.redis_conn = redis_conn
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._pending = []
+        self._has_leader = False
+
+    def lpush(self, task_key: str, task_list: list) -> int:
+        """
+            等同于 redis_conn.lpush(task_key, *task_list)
+        Args:
+            task_key:
+            task_list:
+
+        Returns:
+
+        """
+        # [事件, 结果, 异常]
+        waiter = [threading.Event(), None, None]
+        with self._lock:
+            self._pending.append((task_key, task_list, waiter))
+            is_leader = not self._has_leader
+            self._has_leader = True
+        if is_leader:
+            try:
+                time.sleep(self.interval)
+            finally:
+                # leader被中断(gevent.Timeout/kill)时也要交出leader身份并写入 否则后续调用者会一直等待
+                with self._lock:
+                    batch = self._pending
+                    self._pending = []
+                    self._has_leader = False
+                self._flush(batch)
+        waiter[0].wait()
+        if waiter[2]:
+            raise waiter[2]
+        return waiter[1]
+
+    def _flush(self, batch: list):
+        result_list = None
+        try:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for task_key, task_list, _ in batch:
+                pipe.lpush(task_key, *task_list)
+            result_list = pipe.execute(raise_on_error=False)
+        except Exception as e:
+            result_list = [e] * len(batch)
+        finally:
+            # 写入过程被中断 通知所有等待者写入失败
+            if result_list is None:
+                result_list = [RuntimeError("lpush interrupted")] * len(batch)
+            for (_, _, waiter), result in zip(batch, result_list):
+                if isinstance(result, Exception):
+                    waiter[2] = result
+                else:
+                    waiter[1] = result
+                waiter[0].set()
+        return
 
 
 class SingleBatchSpider(Spider):
@@ -201,7 +421,9 @@ class SingleBatchSpider(Spider):
         )
         self.redis_conn = redis.StrictRedis(connection_pool=connection_pool)
         default_mysql_uri = kwargs.get("default_mysql_uri", setting.default_mysql_uri)
-        self.db = DB().create(default_mysql_uri)
+        # mysql连接池大小 多个协程同时操作数据库时从连接池中获取连接
+        mysql_pool_size = kwargs.get("mysql_pool_size", 10)
+        self.db = DB().create(default_mysql_uri, pool_size=mysql_pool_size)
 
         # redis集群地址
         self._simple_redis_cluster_conn: redis.StrictRedis = None
@@ -232,6 +454,19 @@ class SingleBatchSpider(Spider):
         # 每次从mysql获取任务数
         self.task_mysql_limit = 10000
         self.task_mysql_limit_step = 100_000
+        # 是否使用id游标(keyset)方式从mysql获取任务 游标保存在redis中 多进程共享
+        # 避免每次 where state=0 limit N 都重复扫描已被置为2的记录 适用于大任务表
+        self.task_mysql_keyset = False
+        # id分段大小 大于0时 将id空间按此大小切分 各进程从redis中领取不同的id段并行获取任务 无需加锁
+        self.task_mysql_id_range_size = 0
+        # redis中任务的存储格式 json or msgpack(二进制 体积更小 需安装msgpack) 解码时自动识别格式
+        self.task_codec = "json"
+        self._task_codec_obj = None
+        # 是否使用服务端游标流式读取mysql任务 适用于 task_mysql_limit_step 较大时 限制内存峰值
+        self.task_mysql_stream = False
+        self.task_mysql_stream_chunk_size = 10000
+        # 是否使用后台线程将从mysql获取的任务写入redis 写入当前页的同时读取下一页
+        self.task_mysql_async_push = True
         # 将多少条mysql任务组合为一个任务 适用于批量接口 默认1 # 大于1时 任务示例：task = {"group": [{"item_id": 1}, {"item_id": 2}]} # 固定属性 group
         self.task_group_limit = 1
 
@@ -254,9 +489,45 @@ class SingleBatchSpider(Spider):
         # redis任务缓存
         # 是否将redis任务临时使用内存缓存
         self.cache_task = False
-        self._cache_redis_task_list = Queue(120)
+        # put_task 时最多缓存的任务数
+        self.cache_task_size = 120
+        self._cache_redis_task_list = deque()
+        # 是否从redis批量预取任务到内存缓存 减少每个任务一次的redis往返
+        # 预取数量根据任务消耗速度自动调整 上限为 min(prefetch_task_max_size, pool_size)
+        # 爬虫结束或被kill时 未消耗的任务会放回redis
+        self.prefetch_task = False
+        self.prefetch_task_max_size = 1000
+        # 期望每批预取的任务在多少秒内被消耗完
+        self.prefetch_task_interval = 1
+        self._prefetch_task_size = 0
+        self._last_prefetch_ts = 0
+        self._last_prefetch_count = 0
+        # 是否合并多个协程的 put_task 使用 pipeline 批量写入redis
+        # 适用于大量协程频繁 put_task 的场景 每次调用最多增加 put_task_batch_interval 秒延迟
+        self.put_task_batch = False
+        self.put_task_batch_interval = 0.005
+        self._task_push_batcher: TaskPushBatcher = None
         # 是否使用线程池在获取任务时加速任务状态修改
         self.multi_update_cache_task = False
+        # 任务状态写缓冲
+        # 开启后 set_task_state 中仅按单个字段条件(如 {"id": 1})且无 where_sql 的更新会先缓存在内存
+        # 每 task_state_flush_interval 秒 或 缓存达到 task_state_flush_size 条时 按状态合并为 update ... where id in (...) 写入
+        # 写入失败的状态会放回缓冲重试 爬虫结束时写入剩余状态 保证至少写入一次
+        self.task_state_write_behind = False
+        self.task_state_flush_interval = 1
+        self.task_state_flush_size = 1000
+        self._task_state_buffer = {}
+        self._task_state_lock = threading.Lock()
+        # 同一时间只允许一个写入 保证同一任务的新状态不会被旧状态覆盖
+        self._task_state_flush_lock = threading.Lock()
+        self._task_state_flush_event = threading.Event()
+        self._task_state_flush_thread: threading.Thread = None
+        # 是否使用阻塞方式(BLMPOP/BRPOP)从redis获取任务 代替 rpop + sleep(1) 轮询
+        # tips: 阻塞期间会占用一个redis连接
+        self.task_redis_block_pop = False
+        # redis服务是否支持 RPOP count(>=6.2) BLMPOP(>=7.0) 不支持时自动降级
+        self._redis_rpop_count = True
+        self._redis_blmpop = True
 
         # 是否开启急速模式 会将各种主动的sleep调低到极限
         # tips: 必须开启debug
@@ -266,6 +537,19 @@ class SingleBatchSpider(Spider):
         # 调试模式
         self.debug = False
 
+    def _close(self, **kwargs):
+        # 爬虫结束或被kill时 归还未消耗的缓存任务
+        try:
+            self._release_cache_task()
+        except Exception as e:
+            logger.exception(e)
+        # 写入缓存的任务状态 须在关闭数据库连接之前
+        try:
+            self._stop_task_state_flush()
+        except Exception as e:
+            logger.exception(e)
+        return super()._close(**kwargs)
+
     def add_task(self):
         """
         添加任务
@@ -328,9 +612,11 @@ class SingleBatchSpider(Spider):
                     set {self.state_field_name}={self.state_dict['wait']} 
                     where {self.state_field_name}={self.state_dict['run']} 
                     limit {self.lost_task_reset_limit}"""
-        loss_count = _db.cursor.execute(sql)
+        try:
+            loss_count = _db.cursor.execute(sql)
+        finally:
+            _db.close()
         logger.debug("重置丢失任务数量: {}".format(loss_count))
-        _db.close()
         return
 
     def delete_task(self, *, condition: dict = None):
@@ -347,7 +633,12 @@ class SingleBatchSpider(Spider):
         return self.db.delete(condition=condition, table_name=self.task_table_name)
 
     def get_task(
-        self, obj: bool = False, group: bool = False, redis_delay: int = None, **kwargs
+        self,
+        obj: bool = False,
+        group: bool = False,
+        redis_delay: int = None,
+        raw: bool = False,
+        **kwargs,
     ) -> Union[str, JsonTask]:
         """
         获取任务执行
@@ -355,6 +646,7 @@ class SingleBatchSpider(Spider):
             obj:
             group:
             redis_delay: 从redis中获取任务的重试时间
+            raw: 是否直接返回redis中的原始数据 不做格式转换
             **kwargs:
 
         Returns:
@@ -382,14 +674,13 @@ class SingleBatchSpider(Spider):
         if not task:
             self._check_lost_task()
             task = self._get_task_from_redis(delay=redis_delay)
-        # 兼容 "{'a':1}"
+        if raw or not task:
+            return task
+        # 兼容 "{'a':1}" 及msgpack格式 统一转换为json字符串
         try:
-            _task = eval(task)
-            if isinstance(_task, dict):
-                _task = json.dumps(_task)
-                task = _task
-        except:
-            pass
+            task = task_codec.task_to_json(task)
+        except Exception as e:
+            logger.warning("任务格式转换失败: {} {}".format(task, e))
         return task
 
     def get_task_from_mysql(self, redis_lock=None, **kwargs) -> int:
@@ -405,99 +696,109 @@ class SingleBatchSpider(Spider):
         """
         if not self.task_field_list:
             raise NotImplemented
-        _db = self.db.copy()
         task_mysql_limit = self.task_mysql_limit
         # 本次获取到的任务数记录
         current_get_task_count = 0
-        while task_mysql_limit > 0:
-            # 从mysql读取任务数据
-            task_field_str = ", ".join(["`{}`".format(x) for x in self.task_field_list])
-            step_limit = min(task_mysql_limit, self.task_mysql_limit_step)
-            sql = f"""select `id`, {task_field_str} 
-                      from {self.task_table_name} 
-                      where {self.state_field_name}={self.state_dict["wait"]} limit {step_limit};
-                    """
-            # 某些情况 比如京东这里会很慢 所以做一个增加锁超时时间的操作 防止由于锁超时导致并发查询
-            _query_start = time.time()
-            sql_result = _db.query_all(sql)
-            _query_use_time = time.time() - _query_start
-            if redis_lock and _query_use_time > 10:
-                redis_lock.prolong_life(int(_query_use_time))
-            #
-
-            logger.info(
-                "查询到未做任务记录 {} 条,耗时 {} s".format(len(sql_result), _query_use_time)
-            )
-            if not sql_result:
-                break
-
-            # 20191101 先更新mysql状态 然后放入redis
-            # 1、如果任务消耗特别快 比如京东  则大概率将已完成任务重置为2 导致任务重复执行且极大重复率
-            # 2、先更新状态的情况下 除非挂了 否则没啥影响 就算挂了 也只是重置了 但任务不会重复执行
-            condition_list = [str(x[0]) for x in sql_result]
-            _cache_update_sql = []
-            while condition_list:
-                sql = "update {} set {}={} where id in ({}) and {}={}".format(
-                    self.task_table_name,
-                    self.state_field_name,
-                    self.state_dict["run"],
-                    ",".join(condition_list[:10000]),
-                    self.state_field_name,
-                    self.state_dict["wait"],
-                )
-                if self.multi_update_cache_task:
-                    _cache_update_sql.append(sql)
+        # id游标 仅 keyset 或 id分段 模式下使用
+        last_id = self._get_task_mysql_cursor() if self.task_mysql_keyset else 0
+        # 当前领取到的id段 (start, end]
+        id_range = None
+        # 任务表最大id 仅 id分段 模式下使用
+        max_id = None
+        # 游标是否已经回绕到开头 每次调用最多回绕一次
+        wrapped = False
+        # 写入redis 异步写入时 写入当前页的同时读取下一页
+        pusher = TaskPusher(self.redis_conn, async_push=self.task_mysql_async_push)
+        _db = self.db.copy()
+        try:
+            while task_mysql_limit > 0:
+                # 从mysql读取任务数据
+                task_field_str = ", ".join(["`{}`".format(x) for x in self.task_field_list])
+                step_limit = min(task_mysql_limit, self.task_mysql_limit_step)
+                where_sql = f"{self.state_field_name}={self.state_dict['wait']}"
+                if self.task_mysql_id_range_size > 0:
+                    if not id_range:
+                        if max_id is None:
+                            max_id = _db.query_all(
+                                f"select max(`id`) from {self.task_table_name};"
+                            )[0][0] or 0
+                        id_range = self._claim_task_id_range(max_id)
+                        if not id_range:
+                            # id段已领取完毕 回绕一次 以便获取到被重置的丢失任务
+                            if wrapped:
+                                break
+                            wrapped = True
+                            continue
+                        last_id = id_range[0]
+                    where_sql = f"`id` > {last_id} and `id` <= {id_range[1]} and {where_sql} order by `id`"
+                elif self.task_mysql_keyset:
+                    where_sql = f"`id` > {last_id} and {where_sql} order by `id`"
+                sql = f"""select `id`, {task_field_str}
+                          from {self.task_table_name}
+                          where {where_sql} limit {step_limit};
+                        """
+                # 某些情况 比如京东这里会很慢 所以做一个增加锁超时时间的操作 防止由于锁超时导致并发查询
+                _query_start = time.time()
+                if self.task_mysql_stream:
+                    # 流式读取 每读取一块即写入redis 内存占用只与 task_mysql_stream_chunk_size 有关
+                    row_count, last_row_id = 0, None
+                    for rows in _db.query_iter(
+                        sql, chunk_size=self.task_mysql_stream_chunk_size
+                    ):
+                        row_count += len(rows)
+                        last_row_id = rows[-1][0]
+                        current_get_task_count += self._put_mysql_tasks(
+                            _db, rows, pusher
+                        )
+                        if redis_lock and time.time() - _query_start > 10:
+                            redis_lock.prolong_life(int(time.time() - _query_start))
+                    sql_result = None
                 else:
-                    _db.cursor.execute(sql)
-                condition_list = condition_list[10000:]
-            #
-            if _cache_update_sql:
-                # 批量更新
-                _update_thread_pool = ThreadPoolExecutor(10)
+                    sql_result = _db.query_all(sql)
+                    row_count = len(sql_result)
+                    last_row_id = sql_result[-1][0] if sql_result else None
+                _query_use_time = time.time() - _query_start
+                if redis_lock and _query_use_time > 10:
+                    redis_lock.prolong_life(int(_query_use_time))
+                #
 
-                def _update_work(sql):
-                    # 此处新建连接  多线程中不能共用  #todo 协程也不行
-                    __db = _db.copy(protocol="mysql+pymysql")
-                    r = __db.cursor.execute(sql)
-                    __db.close()
-                    return r
+                logger.info(
+                    "查询到未做任务记录 {} 条,耗时 {} s".format(row_count, _query_use_time)
+                )
+                if self.task_mysql_id_range_size > 0:
+                    if row_count < step_limit:
+                        # 当前id段已取完 下次领取新的id段
+                        id_range = None
+                    if not row_count:
+                        continue
+                    last_id = last_row_id
+                elif self.task_mysql_keyset:
+                    if row_count:
+                        last_id = last_row_id
+                        self._set_task_mysql_cursor(last_id)
+                    elif last_id and not wrapped:
+                        # 游标已到末尾 从头再扫一遍 以便获取到被重置的丢失任务
+                        last_id = 0
+                        wrapped = True
+                        self._set_task_mysql_cursor(last_id)
+                        continue
+                if not row_count:
+                    break
 
-                for r in _update_thread_pool.map(_update_work, _cache_update_sql):
-                    pass
-                _update_thread_pool.shutdown()
+                #
+                task_mysql_limit -= self.task_mysql_limit_step
 
-            #
-            task_mysql_limit -= self.task_mysql_limit_step
-
-            _cache_group_task_list = []
-            task_list = []
-            for _, *field in sql_result:
-                # 强转datetime
-                _task = {
-                    _k: "'{}'".format(_v) if isinstance(_v, datetime.date) else _v
-                    for _k, _v in zip(self.task_field_list, field)
-                }
-                if self.task_group_limit > 1:
-                    _cache_group_task_list.append(_task)
-                    if len(_cache_group_task_list) >= self.task_group_limit:
-                        task_list.append(json.dumps({"group": _cache_group_task_list}))
-                        _cache_group_task_list = []
-                else:
-                    task_list.append(json.dumps(_task))
-                _task_count = len(task_list) * self.task_group_limit
-                if _task_count > 1000:
-                    current_get_task_count += _task_count
-                    self.redis_conn.lpush(self.task_key, *task_list)
-                    task_list = []
-            del sql_result
-            if _cache_group_task_list:
-                task_list.append(json.dumps({"group": _cache_group_task_list}))
-                del _cache_group_task_list
-            if task_list:
-                current_get_task_count += len(task_list) * self.task_group_limit
-                self.redis_conn.lpush(self.task_key, *task_list)
-                del task_list
-        _db.close()
+                if sql_result:
+                    current_get_task_count += self._put_mysql_tasks(
+                        _db, sql_result, pusher
+                    )
+                    del sql_result
+        finally:
+            # 任务状态已修改为2 因此无论是否出错都必须等待已读取的任务写入redis
+            try:
+                pusher.join()
+            finally:
+                _db.close()
         logger.info("本次从mysql获取到任务共 {} 条".format(current_get_task_count))
         return current_get_task_count
 
@@ -533,11 +834,7 @@ class SingleBatchSpider(Spider):
         #
         task_list = task if isinstance(task, list) else [task]
         task_list = [
-            x if not isinstance(x, JsonTask) else x.to_json() for x in task_list
-        ]
-
-        task_list = [
-            json.dumps(x, ensure_ascii=False) if not isinstance(x, str) else x
+            x if isinstance(x, (str, bytes)) else self._encode_task(x)
             for x in task_list
         ]
         task_list_len = len(task_list)
@@ -546,18 +843,21 @@ class SingleBatchSpider(Spider):
             message = message or ("任务重试" if retry else "任务新增")
             logger.debug(f"{message}: {task_list_len} {example_task}")
         #
-        if self.cache_task:
-            while task_list:
-                try:
-                    self._cache_redis_task_list.put_nowait(task_list[-1])
-                    task_list.pop()
-                except Full:
-                    break
+        if self.cache_task and (not task_key or task_key == self.task_key):
+            while task_list and len(self._cache_redis_task_list) < self.cache_task_size:
+                self._cache_redis_task_list.append(task_list.pop())
             if not task_list:
                 r = 1
         if task_list:
             task_key = task_key or self.task_key
-            r = self.redis_conn.lpush(task_key, *task_list)
+            if self.put_task_batch:
+                if not self._task_push_batcher:
+                    self._task_push_batcher = TaskPushBatcher(
+                        self.redis_conn, interval=self.put_task_batch_interval
+                    )
+                r = self._task_push_batcher.lpush(task_key, task_list)
+            else:
+                r = self.redis_conn.lpush(task_key, *task_list)
         return r
 
     def set_task_state(
@@ -582,6 +882,15 @@ class SingleBatchSpider(Spider):
         data = {self.state_field_name: state}
         assert isinstance(state, int), "任务状态必须为整型"
         data.update(extra or {})
+        if (
+            self.task_state_write_behind
+            and not where_sql
+            and len(condition) == 1
+            and isinstance(list(condition.values())[0], (int, str))
+        ):
+            # 写缓冲模式 延迟批量写入
+            self._buffer_task_state(condition, data)
+            return 0
         r = self.db.update(
             data,
             condition=condition,
@@ -590,6 +899,54 @@ class SingleBatchSpider(Spider):
         )
         return r
 
+    def flush_task_state(self) -> int:
+        """
+            将缓存的任务状态写入mysql
+            相同状态(及extra)的任务合并为一条 update ... where id in (...)
+            写入失败的部分放回缓冲 等待下次写入
+        Returns:
+            写入的任务数
+        """
+        with self._task_state_flush_lock:
+            return self._flush_task_state()
+
+    def _flush_task_state(self) -> int:
+        with self._task_state_lock:
+            buffer = self._task_state_buffer
+            self._task_state_buffer = {}
+        if not buffer:
+            return 0
+        # 同一任务只保留最后一次的状态 因此各分组之间的执行顺序无关
+        group_dict = {}
+        for (field, value), data in buffer.items():
+            group_key = (field, json.dumps(data, sort_keys=True, default=str))
+            group_dict.setdefault(group_key, (data, []))[1].append(value)
+        count = 0
+        try:
+            for (field, _), (data, value_list) in group_dict.items():
+                while value_list:
+                    _value_list = value_list[:10000]
+                    values = self.db.handle_values(
+                        dict(enumerate(_value_list)), strip=False
+                    ).values()
+                    self.db.update(
+                        data,
+                        table_name=self.task_table_name,
+                        where_sql="`{}` in ({})".format(field, ",".join(values)),
+                    )
+                    value_list = value_list[10000:]
+                    for value in _value_list:
+                        buffer.pop((field, value), None)
+                    count += len(_value_list)
+        except Exception:
+            # 放回缓冲 写入期间持有写入锁 缓冲中已有的状态必然更新 以新状态为准
+            with self._task_state_lock:
+                for key, data in buffer.items():
+                    self._task_state_buffer.setdefault(key, data)
+            raise
+        logger.debug("批量写入任务状态 {} 条".format(count))
+        return count
+
     def send_message(self, message):
         """发送消息"""
         message = "{}\n{}".format(self.task_tag_name, message)
@@ -709,6 +1066,31 @@ class SingleBatchSpider(Spider):
                 time.sleep(_sleep_time)
         return self._get_task_from_mysql()
 
+    def _claim_task_id_range(self, max_id: int):
+        """
+            id分段模式下 从redis中领取一个id段
+        Args:
+            max_id: 任务表当前最大id
+
+        Returns:
+            (start, end] 若id段已领取完毕则返回None 并重置领取游标
+        """
+        key = "{}:task_mysql_id_range".format(self.task_key)
+        size = self.task_mysql_id_range_size
+        end = self.redis_conn.incrby(key, size)
+        if end - size < max_id:
+            return end - size, end
+
+        # 已超出最大id 重置游标 若已被其他进程重置则忽略
+        def _reset(pipe):
+            value = pipe.get(key)
+            pipe.multi()
+            if value and int(value) >= end:
+                pipe.delete(key)
+
+        self.redis_conn.transaction(_reset, key)
+        return None
+
     def _get_task_from_mysql(self):
         """
             由于 get_task_from_mysql 会被重写 所以在这里加锁
@@ -728,6 +1110,10 @@ class SingleBatchSpider(Spider):
             # 没获取到则一直等 等到超时
             # 注意不能把获取任务放到此锁中间来 可能会造成释放两次锁的bug
             pass
+        if self.task_mysql_id_range_size > 0:
+            # id分段模式下 各进程领取不同的id段 无需加锁
+            self._call_get_task_from_mysql()
+            return
         get_task_from_mysql_key = "{}:get_task_from_mysql".format(self.task_key)
         # 这个锁的超时时间一般也要改
         with util.RedisLock(
@@ -737,20 +1123,77 @@ class SingleBatchSpider(Spider):
             break_wait=self.break_wait_get_task_from_mysql,
         ) as _lock:
             if _lock.locked:
-                # 检查内存
-                if self.container_memory_utilization > 0.6:
-                    self.suicide()
-                else:
-                    # 兼容无参数函数
-                    try:
-                        self.get_task_from_mysql(redis_lock=_lock)
-                    except TypeError as e:
-                        if "argument" in str(e):
-                            self.get_task_from_mysql()
-                        else:
-                            raise e
+                self._call_get_task_from_mysql(redis_lock=_lock)
+        return
+
+    def _buffer_task_state(self, condition: dict, data: dict):
+        """
+            缓存任务状态 等待批量写入
+        Args:
+            condition: 单字段条件
+            data: 待更新字段
+
+        Returns:
+
+        """
+        ((field, value),) = condition.items()
+        with self._task_state_lock:
+            # 保证同一任务的最新状态排在最后
+            self._task_state_buffer.pop((field, value), None)
+            self._task_state_buffer[(field, value)] = data
+            buffer_size = len(self._task_state_buffer)
+            if not self._task_state_flush_thread:
+                self._task_state_flush_event.clear()
+                self._task_state_flush_thread = threading.Thread(
+                    target=self._task_state_flush_worker, daemon=True
+                )
+                self._task_state_flush_thread.start()
+        if buffer_size >= self.task_state_flush_size:
+            self.flush_task_state()
+        return
+
+    def _call_get_task_from_mysql(self, redis_lock=None):
+        """
+            调用 get_task_from_mysql 前检查内存
+        Args:
+            redis_lock:
+
+        Returns:
+
+        """
+        # 检查内存
+        if self.container_memory_utilization > 0.6:
+            self.suicide()
+            return
+        # 兼容无参数函数
+        try:
+            self.get_task_from_mysql(redis_lock=redis_lock)
+        except TypeError as e:
+            if "argument" in str(e):
+                self.get_task_from_mysql()
+            else:
+                raise e
         return
 
+    def _encode_task(self, task: Union[dict, JsonTask]) -> Union[str, bytes]:
+        """
+            按 task_codec 编码任务
+        Args:
+            task:
+
+        Returns:
+
+        """
+        codec = self._task_codec_obj
+        if codec is None or codec.name != self.task_codec:
+            codec = self._task_codec_obj = task_codec.get_task_codec(self.task_codec)
+        if isinstance(task, JsonTask):
+            if codec.name == "json":
+                # 使用缓存的序列化结果
+                return task.to_json()
+            task = task._task
+        return codec.encode(task)
+
     def _get_task_from_redis(self, delay: int = None, task_key: str = None):
         """
         从redis中获取任务
@@ -761,31 +1204,151 @@ class SingleBatchSpider(Spider):
 
         Returns:
 
+        """
+        # 尝试从缓存中拿 缓存中仅有默认任务队列的任务
+        task = None
+        is_default_key = not task_key or task_key == self.task_key
+        if is_default_key:
+            try:
+                task = self._cache_redis_task_list.popleft()
+            except IndexError:
+                pass
+        if not task:
+            if self.prefetch_task and is_default_key:
+                task_list = self._get_tasks_from_redis(
+                    self._get_prefetch_task_size(), delay=delay
+                )
+                self._last_prefetch_ts = time.time()
+                self._last_prefetch_count = len(task_list)
+                if task_list:
+                    task = task_list[0]
+                    self._cache_redis_task_list.extend(task_list[1:])
+            else:
+                task_list = self._get_tasks_from_redis(
+                    1, delay=delay, task_key=task_key
+                )
+                task = task_list[0] if task_list else None
+        return task
+
+    def _get_tasks_from_redis(
+        self, count: int, delay: int = None, task_key: str = None
+    ) -> list:
+        """
+        从redis中一次获取多个任务
+        Args:
+            count: 最多获取任务数
+            delay: 队列为空时的等待时间
+            task_key: 可指定任务队列
+
+        Returns:
+            任务列表 可能为空
         """
         if delay is None:
             delay = 30 if not self.debug else 5
+        task_key = task_key or self.task_key
+
+        task_list = self._rpop_tasks(task_key, count)
+        if task_list or delay < 1:
+            return task_list
+        # 这里之所以等待一段时间 是为了应对一种特殊情况 比如
+        # 任务表是需要翻页采集的  然后其中某个任务翻页页码特别大  到最后只剩下这个任务在翻页了
+        # 由于redis中仅有一个任务 所以这里如果不等待的话 就会一直去mysql中获取  然后 在_get_task_from_mysql 会耽搁1分钟
+        # 于是每翻一页都需要1分钟。。。。。  xdf的翻页4000多页 我草  翻了好几天
+        # 暂停一会  然后从redis中获取翻页新发的任务  减少间隔
+        if self.task_redis_block_pop:
+            return self._block_pop_tasks(task_key, count, int(delay))
+        i = 0
+        while not task_list and (i < delay // 1):
+            time.sleep(1)
+            task_list = self._rpop_tasks(task_key, count)
+            i += 1
+        return task_list
 
-        # 尝试从缓存中拿
-        task = None
-        try:
-            if self.cache_task:
-                task = self._cache_redis_task_list.get_nowait()
-        except Empty:
-            pass
-        if not task:
-            task_key = task_key or self.task_key
-            i = 0
+    def _block_pop_tasks(self, task_key: str, count: int, timeout: int) -> list:
+        """
+            阻塞方式获取任务 新任务到达时立刻返回
+                优先使用 BLMPOP 一次获取多个 不支持时使用 BRPOP + RPOP count
+        Args:
+            task_key:
+            count:
+            timeout: 阻塞超时时间 秒
+
+        Returns:
+
+        """
+        if self._redis_blmpop:
+            try:
+                r = self.redis_conn.execute_command(
+                    "BLMPOP", timeout, 1, task_key, "RIGHT", "COUNT", count
+                )
+                return list(r[1]) if r else []
+            except redis.ResponseError:
+                # redis < 7.0
+                self._redis_blmpop = False
+        r = self.redis_conn.brpop(task_key, timeout=timeout)
+        if not r:
+            return []
+        task_list = [r[1]]
+        if count > 1:
+            task_list.extend(self._rpop_tasks(task_key, count - 1))
+        return task_list
+
+    def _rpop_tasks(self, task_key: str, count: int) -> list:
+        """
+            非阻塞方式获取最多count个任务 一次网络往返
+        Args:
+            task_key:
+            count:
+
+        Returns:
+
+        """
+        if count <= 1:
             task = self.redis_conn.rpop(task_key)
-            while not task and (i < delay // 1):
-                # 这里之所以重复n次获取 是为了应对一种特殊情况 比如
-                # 任务表是需要翻页采集的  然后其中某个任务翻页页码特别大  到最后只剩下这个任务在翻页了
-                # 由于redis中仅有一个任务 所以这里如果不等待的话 就会一直去mysql中获取  然后 在_get_task_from_mysql 会耽搁1分钟
-                # 于是每翻一页都需要1分钟。。。。。  xdf的翻页4000多页 我草  翻了好几天
-                # 暂停一会  然后从redis中获取翻页新发的任务  减少间隔
-                time.sleep(1)
-                task = self.redis_conn.rpop(task_key)
-                i += 1
-        return task
+            return [task] if task else []
+        if self._redis_rpop_count:
+            try:
+                return list(
+                    self.redis_conn.execute_command("RPOP", task_key, count) or []
+                )
+            except redis.ResponseError:
+                # redis < 6.2
+                self._redis_rpop_count = False
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for _ in range(count):
+            pipe.rpop(task_key)
+        return [x for x in pipe.execute() if x]
+
+    def _get_prefetch_task_size(self) -> int:
+        """
+            计算本次预取任务数
+                根据上批预取任务的消耗速度估算 prefetch_task_interval 秒内会消耗的任务数
+                范围 [1, min(prefetch_task_max_size, pool_size)]
+        Returns:
+
+        """
+        max_size = max(1, min(self.prefetch_task_max_size, self.pool_size))
+        if not self._prefetch_task_size:
+            # 初始值 慢慢增长 防止任务较少时被单个进程全部取走
+            size = 10
+        elif self._last_prefetch_count:
+            _use_time = max(time.time() - self._last_prefetch_ts, 0.001)
+            size = self._last_prefetch_count / _use_time * self.prefetch_task_interval
+            # 平滑一下 防止抖动
+            size = (self._prefetch_task_size + size) / 2
+        else:
+            size = self._prefetch_task_size
+        self._prefetch_task_size = max(1, min(int(size), max_size))
+        return self._prefetch_task_size
+
+    def _get_task_mysql_cursor(self) -> int:
+        """
+            获取keyset模式下的id游标
+        Returns:
+
+        """
+        last_id = self.redis_conn.get("{}:task_mysql_cursor".format(self.task_key))
+        return int(last_id) if last_id else 0
 
     def _get_task_obj(
         self, max_retry: int = 10, group: bool = False, **kwargs
@@ -801,10 +1364,12 @@ class SingleBatchSpider(Spider):
             JsonTask
         """
         kwargs["group"] = group
+        kwargs["raw"] = True
         while 1:
             task = self.get_task(**kwargs)
             if task:
-                task_obj = JsonTask(task=task)
+                # 仅解码一次 不做复制
+                task_obj = JsonTask.from_dict(task_codec.decode_task(task))
                 task_obj.retry += 1
                 if task_obj.retry >= max_retry:
                     logger.warn("任务重试次数超限: {}".format(task_obj))
@@ -813,7 +1378,7 @@ class SingleBatchSpider(Spider):
                 if group and isinstance(task_obj.group, list):
                     self.cache_task = True
                     # 切分任务并放入缓存
-                    task_list = [JsonTask(x) for x in task_obj.group]
+                    task_list = [JsonTask.from_dict(x) for x in task_obj.group]
                     task_obj = task_list[0]
                     self.put_task(task_list[1:], retry=False, show_log=False)
             else:
@@ -831,6 +1396,114 @@ class SingleBatchSpider(Spider):
         self._simple_redis_cluster_conn = redis.StrictRedis.from_url(redis_uri)
         return
 
+    def _put_mysql_tasks(self, _db, sql_result, pusher: TaskPusher) -> int:
+        """
+            将从mysql读取的任务状态修改为run 然后写入redis
+        Args:
+            _db: 任务表连接
+            sql_result: 查询结果 [(id, *task_field_list), ...]
+            pusher:
+
+        Returns:
+            写入的任务数
+        """
+        task_count = 0
+        # 20191101 先更新mysql状态 然后放入redis
+        # 1、如果任务消耗特别快 比如京东  则大概率将已完成任务重置为2 导致任务重复执行且极大重复率
+        # 2、先更新状态的情况下 除非挂了 否则没啥影响 就算挂了 也只是重置了 但任务不会重复执行
+        condition_list = [str(x[0]) for x in sql_result]
+        _cache_update_sql = []
+        while condition_list:
+            sql = "update {} set {}={} where id in ({}) and {}={}".format(
+                self.task_table_name,
+                self.state_field_name,
+                self.state_dict["run"],
+                ",".join(condition_list[:10000]),
+                self.state_field_name,
+                self.state_dict["wait"],
+            )
+            if self.multi_update_cache_task:
+                _cache_update_sql.append(sql)
+            else:
+                _db.cursor.execute(sql)
+            condition_list = condition_list[10000:]
+        #
+        if _cache_update_sql:
+            # 批量更新
+            _update_thread_pool = ThreadPoolExecutor(10)
+
+            def _update_work(sql):
+                # 此处新建连接  多线程中不能共用  #todo 协程也不行
+                __db = _db.copy(protocol="mysql+pymysql")
+                r = __db.cursor.execute(sql)
+                __db.close()
+                return r
+
+            for r in _update_thread_pool.map(_update_work, _cache_update_sql):
+                pass
+            _update_thread_pool.shutdown()
+
+        _cache_group_task_list = []
+        task_list = []
+        for _, *field in sql_result:
+            # 强转datetime
+            _task = {
+                _k: "'{}'".format(_v) if isinstance(_v, datetime.date) else _v
+                for _k, _v in zip(self.task_field_list, field)
+            }
+            if self.task_group_limit > 1:
+                _cache_group_task_list.append(_task)
+                if len(_cache_group_task_list) >= self.task_group_limit:
+                    task_list.append(
+                        self._encode_task({"group": _cache_group_task_list})
+                    )
+                    _cache_group_task_list = []
+            else:
+                task_list.append(self._encode_task(_task))
+            _task_count = len(task_list) * self.task_group_limit
+            # 异步写入时整页写入
+            if not self.task_mysql_async_push and _task_count > 1000:
+                task_count += _task_count
+                pusher.push(self.task_key, task_list)
+                task_list = []
+        if _cache_group_task_list:
+            task_list.append(self._encode_task({"group": _cache_group_task_list}))
+            del _cache_group_task_list
+        if task_list:
+            task_count += len(task_list) * self.task_group_limit
+            pusher.push(self.task_key, task_list)
+            del task_list
+        return task_count
+
+    def _release_cache_task(self) -> int:
+        """
+            将内存缓存中未消耗的任务放回redis 防止任务丢失
+        Returns:
+            放回的任务数
+        """
+        task_list = []
+        while 1:
+            try:
+                task_list.append(self._cache_redis_task_list.popleft())
+            except IndexError:
+                break
+        if task_list:
+            # 放回rpop的一端 保证下次优先被获取 且保持原有顺序
+            self.redis_conn.rpush(self.task_key, *reversed(task_list))
+            logger.debug("缓存任务放回redis: {}".format(len(task_list)))
+        return len(task_list)
+
+    def _reset_task_mysql_cursor(self):
+        """
+            重置 keyset 及 id分段 模式下的id游标 新批次开始时调用
+        Returns:
+
+        """
+        return self.redis_conn.delete(
+            "{}:task_mysql_cursor".format(self.task_key),
+            "{}:task_mysql_id_range".format(self.task_key),
+        )
+
     def _send_spider_start_signal(self):
         """
         发送爬虫启动信号
@@ -863,6 +1536,56 @@ class SingleBatchSpider(Spider):
                 self.other_spider_stoped = 1
         return
 
+    def _set_task_mysql_cursor(self, last_id: int):
+        """
+            保存keyset模式下的id游标
+        Args:
+            last_id:
+
+        Returns:
+
+        """
+        return self.redis_conn.set(
+            "{}:task_mysql_cursor".format(self.task_key), last_id
+        )
+
+    def _stop_task_state_flush(self, retry: int = 3):
+        """
+            停止后台写入线程 并写入剩余的任务状态
+        Args:
+            retry: 写入失败重试次数
+
+        Returns:
+
+        """
+        self._task_state_flush_event.set()
+        if self._task_state_flush_thread:
+            self._task_state_flush_thread.join()
+            self._task_state_flush_thread = None
+        for i in range(retry + 1):
+            try:
+                self.flush_task_state()
+                break
+            except Exception as e:
+                logger.exception(e)
+                time.sleep(i + 1)
+        if self._task_state_buffer:
+            logger.error("任务状态写入失败 {} 条".format(len(self._task_state_buffer)))
+        return
+
+    def _task_state_flush_worker(self):
+        """
+            后台定时写入任务状态
+        Returns:
+
+        """
+        while not self._task_state_flush_event.wait(self.task_state_flush_interval):
+            try:
+                self.flush_task_state()
+            except Exception as e:
+                logger.exception(e)
+        return
+
 
 class BatchSpider(SingleBatchSpider):
     def __init__(self, **kwargs):
@@ -958,8 +1681,10 @@ class BatchSpider(SingleBatchSpider):
             sql = "select batch_date, done_count, total_count from {} order by id desc limit 1;".format(
                 self.task_batch_table_name
             )
-            last_batch_infos = _db.query_all(sql)
-            _db.close()
+            try:
+                last_batch_infos = _db.query_all(sql)
+            finally:
+                _db.close()
             if last_batch_infos:
                 batch_date_str, done_count, total_count = last_batch_infos[0]
                 # 格式转换
@@ -1070,6 +1795,8 @@ class BatchSpider(SingleBatchSpider):
         self.is_reset_task = 1
         try:
             resp = self.reset_task_table()
+            # 任务表已重置 id游标从头开始
+            self._reset_task_mysql_cursor()
         except Exception as e:
             raise e
         finally:
@@ -1126,8 +1853,10 @@ class BatchSpider(SingleBatchSpider):
         sql = "select done_count, total_count, fail_count from {} where batch_date='{}'".format(
             self.task_batch_table_name, batch_date
         )
-        sql_result = _db.query_all(sql)
-        _db.close()
+        try:
+            sql_result = _db.query_all(sql)
+        finally:
+            _db.close()
         if sql_result:
             done_count, total_count, fail_count = sql_result[0]
             batch_info = {
@@ -1162,8 +1891,10 @@ class BatchSpider(SingleBatchSpider):
                 self.task_batch_table_name, last_n
             )
             _db = self.db.copy()
-            sql_result = _db.query_all(sql)
-            _db.close()
+            try:
+                sql_result = _db.query_all(sql)
+            finally:
+                _db.close()
             for done_count, total_count, fail_count, batch_date in sql_result:
                 batch_list.append(
                     {
@@ -1407,11 +2138,10 @@ class BatchSpider(SingleBatchSpider):
 
         """
         total, done = -1, -1
+        _db = self.db.copy()
         try:
             state_dict = self.state_dict
             #
-            _db = self.db.copy()
-            #
             sql = "select {field}, count({field}) from {table} group by {field}".format(
                 field=self.state_field_name, table=self.task_table_name
             )
@@ -1446,9 +2176,10 @@ class BatchSpider(SingleBatchSpider):
             r = _db.update(
                 update_data, where_sql=where_sql, table_name=self.task_batch_table_name
             )
-            _db.close()
         except Exception as e:
             logger.exception(e)
+        finally:
+            _db.close()
         return total, done
 
     def _get_task_from_mysql(self):
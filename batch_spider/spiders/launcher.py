@@ -0,0 +1,188 @@
+# coding:utf8
+"""
+多进程启动器
+
+    一个爬虫进程只能跑满一个cpu核心 解析较重(BeautifulSoup 正则等)时下载会处于空闲状态
+    使用 MultiProcessLauncher 可以在一个容器内启动多个相同的爬虫进程
+
+    from batch_spider.spiders import MultiProcessLauncher
+
+    if __name__ == "__main__":
+        MultiProcessLauncher(MySpider, process_num=4, spider_kwargs={"pool_size": 50}).run()
+
+    tips:
+        1、各进程使用相同的 task_key 因此天然共享redis任务队列及 other_spider_stoped 停止信号
+        2、默认使用 spawn 方式启动子进程 避免 fork 后共用 gevent hub 及 redis/mysql 连接
+           所以爬虫类必须定义在可被导入的模块中 且启动代码需放在 if __name__ == "__main__": 下
+"""
+import multiprocessing
+import os
+import time
+from collections import Counter
+from multiprocessing.connection import wait
+
+from batch_spider.utils import log
+
+logger = log.get_logger(__file__)
+
+# util.oom_killed_exit 使用的退出码
+OOM_KILLED_EXIT_CODE = 137
+
+
+def _run_spider(spider_cls, spider_kwargs: dict, conn):
+    """
+        子进程入口 运行爬虫并将统计信息发送给主进程
+    Args:
+        spider_cls:
+        spider_kwargs:
+        conn: Pipe 子进程端
+
+    Returns:
+
+    """
+    spider = None
+    try:
+        spider = spider_cls(**spider_kwargs)
+        spider.run()
+    finally:
+        try:
+            conn.send(dict(getattr(spider, "stats", None) or {}))
+            conn.close()
+        except Exception as e:
+            logger.exception(e)
+    return
+
+
+class MultiProcessLauncher(object):
+    def __init__(
+        self,
+        spider_cls,
+        process_num: int = None,
+        *,
+        spider_kwargs: dict = None,
+        max_restart: int = 10,
+        start_method: str = "spawn",
+    ):
+        """
+            多进程启动爬虫
+        Args:
+            spider_cls: 爬虫类
+            process_num: 进程数 默认为cpu核数
+            spider_kwargs: 实例化爬虫时的参数
+            max_restart: 进程因内存超限(退出码137)退出时 最多重启次数(所有进程累计)
+            start_method: 子进程启动方式 spawn/forkserver/fork
+        """
+        self.spider_cls = spider_cls
+        self.process_num = process_num or os.cpu_count() or 1
+        self.spider_kwargs = spider_kwargs or {}
+        self.max_restart = max_restart
+        self.start_method = start_method
+
+        # 所有进程汇总的统计信息
+        self.stats = Counter()
+        self.restart_count = 0
+
+        self._context = multiprocessing.get_context(self.start_method)
+        # 进程编号 => (process, conn)
+        self._processes = {}
+
+    def run(self) -> Counter:
+        """
+            启动所有进程 并等待全部结束
+        Returns:
+            汇总的统计信息
+        """
+        for i in range(self.process_num):
+            self._start_process(i)
+        try:
+            while self._processes:
+                sentinel_dict = {
+                    process.sentinel: i for i, (process, _) in self._processes.items()
+                }
+                for sentinel in wait(list(sentinel_dict.keys())):
+                    self._handle_process_exit(sentinel_dict[sentinel])
+        except KeyboardInterrupt:
+            logger.debug("收到中断信号 停止所有子进程")
+            self.terminate()
+            raise
+        logger.debug("所有进程结束 统计信息: {}".format(dict(self.stats)))
+        return self.stats
+
+    def terminate(self):
+        """
+            停止所有子进程
+        Returns:
+
+        """
+        for i in list(self._processes.keys()):
+            process, conn = self._processes.pop(i)
+            process.terminate()
+            process.join()
+            self._recv_stats(conn)
+        return
+
+    def _handle_process_exit(self, index: int):
+        """
+            处理结束的子进程 汇总统计信息 必要时重启
+        Args:
+            index: 进程编号
+
+        Returns:
+
+        """
+        process, conn = self._processes.pop(index)
+        process.join()
+        self._recv_stats(conn)
+        exitcode = process.exitcode
+        logger.debug("进程 {} 结束 pid: {} 退出码: {}".format(index, process.pid, exitcode))
+        if exitcode == OOM_KILLED_EXIT_CODE:
+            if self.restart_count < self.max_restart:
+                self.restart_count += 1
+                logger.debug(
+                    "进程 {} 因内存超限退出 重启中... 已重启次数: {}".format(index, self.restart_count)
+                )
+                time.sleep(1)
+                self._start_process(index)
+            else:
+                logger.error("进程重启次数超出限制 {}".format(self.max_restart))
+        return
+
+    def _recv_stats(self, conn):
+        """
+            接收子进程发送的统计信息
+        Args:
+            conn:
+
+        Returns:
+
+        """
+        try:
+            if conn.poll():
+                self.stats.update(conn.recv())
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+        return
+
+    def _start_process(self, index: int):
+        """
+            启动一个爬虫进程
+        Args:
+            index: 进程编号
+
+        Returns:
+
+        """
+        parent_conn, child_conn = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_run_spider,
+            args=(self.spider_cls, self.spider_kwargs, child_conn),
+            name="{}-{}".format(self.spider_cls.__name__, index),
+        )
+        process.start()
+        # 子进程端由子进程持有 主进程关闭 否则子进程异常退出时无法感知EOF
+        child_conn.close()
+        self._processes[index] = (process, parent_conn)
+        logger.debug("进程 {} 启动 pid: {}".format(index, process.pid))
+        return process
@@ -0,0 +1,249 @@
+# coding:utf8
+"""
+数据入库管道
+
+    回调函数中 yield 的字典数据(Item)进入按表划分的缓冲区
+    缓冲达到 flush_size 条或距上次写入超过 flush_interval 秒时 交由写入线程调用 add_many 批量入库
+    入库耗时不再阻塞下载/解析线程
+
+    def parse(self, response):
+        yield Item({"id": 1, "title": "..."}, table_name="t_news")
+
+    tips:
+        1、同一批数据允许字段不一致 按字段分组后入库
+        2、入库失败重试 max_retry 次后写入 dead_letter_file (jsonl) 每行 {"table_name": "", "data": {}, "error": ""}
+        3、写入线程数 writer_num 个 待写入批次队列满时 put 阻塞等待 避免数据无限堆积
+        4、db 启用有界连接池(pool_size>0)时 每次写入从连接池取连接
+           否则每个写入线程通过 db.copy() 使用独立的连接 db 不支持 copy 时只使用一个写入线程
+"""
+import json
+import threading
+import time
+from queue import Queue
+from typing import Dict, List
+
+from batch_spider.utils import log
+
+logger = log.get_logger(__file__)
+
+
+class Item(dict):
+    """
+    待入库的数据
+        Item({"id": 1}, table_name="t_news")
+    """
+
+    def __init__(self, *args, table_name: str = "", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.table_name = table_name
+
+
+class ItemPipeline(object):
+    def __init__(
+        self,
+        db,
+        *,
+        flush_size: int = 1000,
+        flush_interval: float = 1,
+        writer_num: int = 2,
+        max_retry: int = 3,
+        dead_letter_file: str = "",
+        table_name: str = "",
+        **kwargs,
+    ):
+        """
+
+        Args:
+            db: 入库连接 需实现 add_many 实现 copy 时每个写入线程使用一个副本
+            flush_size: 单表缓冲达到此数量时写入
+            flush_interval: 最长缓冲时间
+            writer_num: 写入线程数
+            max_retry: 写入失败重试次数
+            dead_letter_file: 重试仍失败的数据写入此文件 为空则仅记录日志
+            table_name: 默认表名 Item 未指定表名时使用
+            **kwargs: 透传给 add_many 的参数
+        """
+        self.db = db
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        if writer_num > 1 and not self._is_pooled_db() and not hasattr(db, "copy"):
+            # 多个写入线程共用一个连接会交错执行sql
+            logger.warning("db 不支持 copy 写入线程数改为1")
+            writer_num = 1
+        self.writer_num = writer_num
+        self.max_retry = max_retry
+        self.dead_letter_file = dead_letter_file
+        self.table_name = table_name
+        self.add_many_kwargs = kwargs
+        # 运行统计 item: 接收数 stored: 入库数 retry: 重试次数 dead: 写入死信数
+        self.stats = {"item": 0, "stored": 0, "retry": 0, "dead": 0}
+
+        self._buffer: Dict[str, List[dict]] = {}
+        self._lock = threading.Lock()
+        self._dead_letter_lock = threading.Lock()
+        # 待写入批次 (table_name, data_list)  None 为写入线程退出信号
+        self._batch_queue = Queue(maxsize=writer_num * 2)
+        self._event_exit = threading.Event()
+        self._flush_thread = None
+        self._writer_threads = []
+        self._closed = False
+        self._start()
+
+    def _start(self):
+        for i in range(self.writer_num):
+            t = threading.Thread(target=self._writer_worker, daemon=True)
+            t.start()
+            self._writer_threads.append(t)
+        self._flush_thread = threading.Thread(target=self._flush_worker, daemon=True)
+        self._flush_thread.start()
+        return
+
+    def put(self, item: dict, *, table_name: str = ""):
+        """
+            添加待入库数据
+        Args:
+            item:
+            table_name: 表名 默认取 item.table_name 或 self.table_name 均为空时抛出 ValueError
+
+        Returns:
+
+        """
+        if self._closed:
+            raise RuntimeError("item pipeline is closed")
+        table_name = table_name or getattr(item, "table_name", "") or self.table_name
+        if not table_name:
+            raise ValueError("table_name is empty: {}".format(item))
+        batch = None
+        with self._lock:
+            buffer = self._buffer.setdefault(table_name, [])
+            buffer.append(dict(item))
+            self.stats["item"] += 1
+            if len(buffer) >= self.flush_size:
+                batch = self._buffer.pop(table_name)
+        if batch:
+            self._batch_queue.put((table_name, batch))
+        return
+
+    def flush(self):
+        """
+            将所有缓冲数据交给写入线程
+        Returns:
+
+        """
+        with self._lock:
+            buffer = self._buffer
+            self._buffer = {}
+        for table_name, batch in buffer.items():
+            if batch:
+                self._batch_queue.put((table_name, batch))
+        return
+
+    def join(self):
+        """
+            等待已提交的数据全部写入完成
+        Returns:
+
+        """
+        self.flush()
+        self._batch_queue.join()
+        return
+
+    def close(self):
+        """
+            写入剩余数据并停止写入线程
+        Returns:
+
+        """
+        if self._closed:
+            return
+        self._event_exit.set()
+        self._flush_thread.join()
+        self.flush()
+        self._closed = True
+        for _ in self._writer_threads:
+            self._batch_queue.put(None)
+        for t in self._writer_threads:
+            t.join()
+        logger.debug("item pipeline closed: {}".format(self.stats))
+        return
+
+    def _flush_worker(self):
+        while not self._event_exit.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+        return
+
+    def _is_pooled_db(self) -> bool:
+        # 连接池模式的共用对象 每次操作从连接池取连接 可以多线程共用
+        return getattr(self.db, "pool_size", 0) > 0 and getattr(self.db, "is_pool", False)
+
+    def _writer_worker(self):
+        # 每个写入线程使用独立的连接
+        db = self.db
+        if not self._is_pooled_db() and hasattr(self.db, "copy"):
+            db = self.db.copy()
+        try:
+            while 1:
+                batch = self._batch_queue.get()
+                try:
+                    if batch is None:
+                        break
+                    table_name, data = batch
+                    self._write(db, table_name, data)
+                except Exception as e:
+                    logger.exception(e)
+                finally:
+                    self._batch_queue.task_done()
+        finally:
+            if db is not self.db:
+                db.close()
+        return
+
+    def _write(self, db, table_name: str, data: List[dict]):
+        """
+            批量入库 失败重试 仍失败则写入死信文件
+        Args:
+            db: 当前写入线程使用的连接
+            table_name:
+            data:
+
+        Returns:
+
+        """
+        for i in range(self.max_retry + 1):
+            try:
+                db.add_many(
+                    data,
+                    table_name=table_name,
+                    group_by_keys=True,
+                    **self.add_many_kwargs
+                )
+                self.stats["stored"] += len(data)
+                return
+            except Exception as e:
+                error = e
+                if i < self.max_retry:
+                    self.stats["retry"] += 1
+                    logger.warning(
+                        "入库失败 {}s后重试 table: {} error: {}".format(i + 1, table_name, e)
+                    )
+                    time.sleep(i + 1)
+        logger.error("入库失败 table: {} 数据量: {} error: {}".format(table_name, len(data), error))
+        self._write_dead_letter(table_name, data, error)
+        return
+
+    def _write_dead_letter(self, table_name: str, data: List[dict], error: Exception):
+        self.stats["dead"] += len(data)
+        if not self.dead_letter_file:
+            return
+        try:
+            with self._dead_letter_lock:
+                with open(self.dead_letter_file, "a", encoding="utf8") as f:
+                    for item in data:
+                        line = {"table_name": table_name, "data": item, "error": str(error)}
+                        f.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+        except Exception as e:
+            logger.exception(e)
+        return
@@ -0,0 +1,141 @@
+# coding:utf8
+"""
+任务编解码
+
+    redis中的任务默认为json字符串 可选msgpack二进制格式 体积更小 解析更快
+    解码时根据首字节自动识别格式 因此切换格式时新旧任务可以共存于同一队列
+
+    codec = get_task_codec("msgpack")
+    data = codec.encode({"id": 1})
+    task = codec.decode(data)
+
+    tips:
+        1、安装 orjson 后json编解码自动使用 orjson
+        2、msgpack 格式需安装 msgpack
+"""
+import ast
+import json
+from typing import Union
+
+try:
+    import orjson
+except:
+    orjson = None
+
+try:
+    import msgpack
+except:
+    msgpack = None
+
+# msgpack map类型的首字节 fixmap(0x80-0x8f) map16(0xde) map32(0xdf)
+# json对象以 { 或空白字符开头 不会与之冲突
+_msgpack_map_first_bytes = frozenset(list(range(0x80, 0x90)) + [0xDE, 0xDF])
+
+
+def is_msgpack(data: Union[str, bytes]) -> bool:
+    """
+        是否为msgpack格式的任务
+    Args:
+        data:
+
+    Returns:
+
+    """
+    return isinstance(data, bytes) and data[:1] != b"" and data[0] in _msgpack_map_first_bytes
+
+
+def json_loads(data: Union[str, bytes]):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_task(data: Union[str, bytes]) -> dict:
+    """
+        解码任务 自动识别 msgpack/json 格式
+        兼容python字典格式的字符串 "{'a': 1}"
+    Args:
+        data:
+
+    Returns:
+
+    """
+    if is_msgpack(data):
+        if msgpack is None:
+            raise ImportError("decode msgpack task need: pip install msgpack")
+        return msgpack.unpackb(data, raw=False)
+    try:
+        return json_loads(data)
+    except ValueError:
+        # 兼容 "{'a':1}"
+        if isinstance(data, bytes):
+            data = data.decode()
+        task = ast.literal_eval(data)
+        if not isinstance(task, dict):
+            raise
+        return task
+
+
+def task_to_json(data: Union[str, bytes]) -> str:
+    """
+        将redis中取出的任务统一转换为json字符串
+    Args:
+        data:
+
+    Returns:
+
+    """
+    if not is_msgpack(data):
+        try:
+            json_loads(data)
+            return data.decode() if isinstance(data, bytes) else data
+        except ValueError:
+            pass
+    return json.dumps(decode_task(data), ensure_ascii=False)
+
+
+class JsonTaskCodec(object):
+    name = "json"
+
+    def encode(self, task: dict) -> Union[str, bytes]:
+        if orjson is not None:
+            try:
+                return orjson.dumps(task)
+            except TypeError:
+                # orjson 不支持非字符串key等情况
+                pass
+        return json.dumps(task, ensure_ascii=False)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        return decode_task(data)
+
+
+class MsgpackTaskCodec(object):
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("msgpack task codec need: pip install msgpack")
+
+    def encode(self, task: dict) -> bytes:
+        return msgpack.packb(task, use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        return decode_task(data)
+
+
+_task_codec_dict = {"json": JsonTaskCodec, "msgpack": MsgpackTaskCodec}
+
+
+def get_task_codec(name: str = "json"):
+    """
+        获取任务编解码器
+    Args:
+        name: json or msgpack
+
+    Returns:
+
+    """
+    if name not in _task_codec_dict:
+        raise ValueError("unknown task codec: {}".format(name))
+    return _task_codec_dict[name]()
@@ -1,5 +1,6 @@
 # coding:utf8
 import datetime
+import functools
 import html
 import json
 import os
@@ -174,25 +175,104 @@ def find_groups(text: str, flag: str = "()", error: str = "strict") -> List[Tupl
     return brackets
 
 
-def local_datetime(data):
+# local_datetime 识别的格式 按顺序匹配 (正则, 时间格式, 标记)
+_local_datetime_regex_format_list = [
+    # 2013年8月15日 22:46:21
+    (r"(\w+ \w+ \d+ \d+:\d+:\d+ \+\d+ \d+)", "%a %b %d %H:%M:%S +0800 %Y", ""),
+    # Wed Sep  5 12:37:25 2018
+    (r"(\w+ \w+ \d+ \d+:\d+:\d+ \d+)", "%a %b %d %H:%M:%S %Y", ""),
+    # 2013年8月15日 22:46:21
+    (r"(\d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M:%S", ""),
+    # "2013年8月15日 22:46"
+    (r"(\d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M", ""),
+    # "2014年5月11日"
+    (r"(\d{4}-\d{1,2}-\d{1,2})", "%Y-%m-%d", ""),
+    # "2014年5月"
+    (r"(\d{4}-\d{1,2})", "%Y-%m", ""),
+    # "13年8月15日 22:46:21",
+    (r"(\d{2}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2}:\d{1,2})", "%y-%m-%d %H:%M:%S", ""),
+    # "13年8月15日 22:46",
+    (r"(\d{2}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2})", "%y-%m-%d %H:%M", ""),
+    # "8月15日 22:46:21",
+    (r"(\d{1,2}-\d{1,2} \d{1,2}:\d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M:%S", "+year"),
+    # "8月15日 22:46",
+    (r"(\d{1,2}-\d{1,2} \d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M", "+year"),
+    # "8月15日",
+    (r"(\d{1,2}-\d{1,2})", "%Y-%m-%d", "+year"),
+    # "3 秒前",
+    (r"(\d+)\s*秒前", "", "-seconds"),
+    # "3 分钟前",
+    (r"(\d+)\s*分钟前", "", "-minutes"),
+    # "3 小时前",
+    (r"(\d+)\s*小时前", "", "-hours"),
+    # "3 天前",
+    (r"(\d+)\s*天前", "", "-days"),
+    # 今天 15:42:21
+    (r"今天\s*(\d{1,2}:\d{1,2}:\d{1,2})", "%H:%M:%S", "date-0"),
+    # 昨天 15:42:21
+    (r"昨天\s*(\d{1,2}:\d{1,2}:\d{1,2})", "%H:%M:%S", "date-1"),
+    # 前天 15:42:21
+    (r"前天\s*(\d{1,2}:\d{1,2}:\d{1,2})", "%H:%M:%S", "date-2"),
+    # 今天 15:42
+    (r"今天\s*(\d{1,2}:\d{1,2})", "%H:%M", "date-0"),
+    # 昨天 15:42
+    (r"昨天\s*(\d{1,2}:\d{1,2})", "%H:%M", "date-1"),
+    # 前天 15:42
+    (r"前天\s*(\d{1,2}:\d{1,2})", "%H:%M", "date-2"),
+]
+
+# 预编译 并记录每个正则必须包含的字符(: - 及中文) 不含这些字符的数据直接跳过该正则 不改变匹配顺序
+_local_datetime_matcher_list = [
+    (
+        re.compile(regex),
+        frozenset(c for c in regex if c in ":-" or ord(c) > 127),
+        dt_format,
+        flag,
+    )
+    for regex, dt_format, flag in _local_datetime_regex_format_list
+]
+
+_whitespace_regex = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=100000)
+def _parse_local_datetime(data: str, year: int) -> Tuple:
     """
-        把data转换为日期时间，时区为东八区北京时间，能够识别：今天、昨天、5分钟前等等，如果不能成功识别，则返回datetime.datetime.now()
+        解析时间字符串 结果与当前时间无关 可缓存
     Args:
         data:
+        year: 当前年份 用于补全缺少年份的日期
 
     Returns:
-
+        ("", datetime)  绝对时间
+        ("delta", timedelta)  相对当前时间
+        ("date", 天数, time)  相对当前日期
+        None 无法识别
     """
-    dt = datetime.datetime.now()
+    data = _normalize_local_datetime(data)
+    for regex, required_chars, dt_format, flag in _local_datetime_matcher_list:
+        if required_chars and not all(c in data for c in required_chars):
+            continue
+        m = regex.search(data)
+        if not m:
+            continue
+        if not flag:
+            return "", datetime.datetime.strptime(m.group(1), dt_format)
+        elif flag == "+year":
+            # 需要增加年份
+            return "", datetime.datetime.strptime("%s-%s" % (year, m.group(1)), dt_format)
+        elif flag.startswith("date"):
+            del_days = int(flag.split("-")[1])
+            return "date", del_days, datetime.datetime.strptime(m.group(1), dt_format).time()
+        else:
+            # -seconds -minutes -hours -days
+            return "delta", datetime.timedelta(**{flag.strip("-"): int(m.group(1))})
+    return None
+
+
+def _normalize_local_datetime(data: str) -> str:
     # html实体字符转义
     data = html.unescape(data)
-    data = data.strip()
-    try:
-        if isinstance(data, bytes):
-            data = data.decode()
-    except Exception as e:
-        logger.error("local_datetime() error: data is not utf8 or unicode : %s" % data)
-
     # 归一化
     data = (
         data.replace("年", "-")
@@ -201,80 +281,51 @@ def local_datetime(data):
         .replace("/", "-")
         .strip()
     )
-    data = re.sub("\s+", " ", data)
-
-    year = dt.year
-
-    regex_format_list = [
-        # 2013年8月15日 22:46:21
-        ("(\w+ \w+ \d+ \d+:\d+:\d+ \+\d+ \d+)", "%a %b %d %H:%M:%S +0800 %Y", ""),
-        # Wed Sep  5 12:37:25 2018
-        ("(\w+ \w+ \d+ \d+:\d+:\d+ \d+)", "%a %b %d %H:%M:%S %Y", ""),
-        # 2013年8月15日 22:46:21
-        ("(\d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M:%S", ""),
-        # "2013年8月15日 22:46"
-        ("(\d{4}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M", ""),
-        # "2014年5月11日"
-        ("(\d{4}-\d{1,2}-\d{1,2})", "%Y-%m-%d", ""),
-        # "2014年5月"
-        ("(\d{4}-\d{1,2})", "%Y-%m", ""),
-        # "13年8月15日 22:46:21",
-        ("(\d{2}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2}:\d{1,2})", "%y-%m-%d %H:%M:%S", ""),
-        # "13年8月15日 22:46",
-        ("(\d{2}-\d{1,2}-\d{1,2} \d{1,2}:\d{1,2})", "%y-%m-%d %H:%M", ""),
-        # "8月15日 22:46:21",
-        ("(\d{1,2}-\d{1,2} \d{1,2}:\d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M:%S", "+year"),
-        # "8月15日 22:46",
-        ("(\d{1,2}-\d{1,2} \d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M", "+year"),
-        # "8月15日",
-        ("(\d{1,2}-\d{1,2})", "%Y-%m-%d", "+year"),
-        # "3 秒前",
-        ("(\d+)\s*秒前", "", "-seconds"),
-        # "3 秒前",
-        ("(\d+)\s*分钟前", "", "-minutes"),
-        # "3 小时前",
-        ("(\d+)\s*小时前", "", "-hours"),
-        # "3 秒前",
-        ("(\d+)\s*天前", "", "-days"),
-        # 今天 15:42:21
-        ("今天\s*(\d{1,2}:\d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M:%S", "date-0"),
-        # 昨天 15:42:21
-        ("昨天\s*(\d{1,2}:\d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M:%S", "date-1"),
-        # 前天 15:42:21
-        ("前天\s*(\d{1,2}:\d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M:%S", "date-2"),
-        # 今天 15:42
-        ("今天\s*(\d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M", "date-0"),
-        # 昨天 15:42
-        ("昨天\s*(\d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M", "date-1"),
-        # 前天 15:42
-        ("前天\s*(\d{1,2}:\d{1,2})", "%Y-%m-%d %H:%M", "date-2"),
-    ]
-
-    for regex, dt_format, flag in regex_format_list:
-        m = re.search(regex, data)
-        if m:
-            if not flag:
-                dt = datetime.datetime.strptime(m.group(1), dt_format)
-            elif flag == "+year":
-                # 需要增加年份
-                dt = datetime.datetime.strptime("%s-%s" % (year, m.group(1)), dt_format)
-            elif flag in ("-seconds", "-minutes", "-hours", "-days"):
-                # 减秒
-                flag = flag.strip("-")
-                delta = eval("datetime.timedelta(%s=int(m.group(1)))" % flag)
-                dt = dt - delta
-            elif flag.startswith("date"):
-                del_days = int(flag.split("-")[1])
-                _date = dt.date() - datetime.timedelta(days=del_days)
-                _date = _date.strftime("%Y-%m-%d")
-                dt = datetime.datetime.strptime(
-                    "%s %s" % (_date, m.group(1)), dt_format
-                )
-            return dt
-    else:
+    return _whitespace_regex.sub(" ", data)
+
+
+def _local_datetime(data, now: datetime.datetime):
+    try:
+        if isinstance(data, bytes):
+            data = data.decode()
+    except Exception as e:
+        logger.error("local_datetime() error: data is not utf8 or unicode : %s" % data)
+    result = _parse_local_datetime(data, now.year)
+    if result is None:
         logger.error("unknow datetime format: %s" % data)
-        dt = None
-    return dt
+        return None
+    if result[0] == "delta":
+        return now - result[1]
+    elif result[0] == "date":
+        _date = now.date() - datetime.timedelta(days=result[1])
+        return datetime.datetime.combine(_date, result[2])
+    return result[1]
+
+
+def local_datetime(data):
+    """
+        把data转换为日期时间，时区为东八区北京时间，能够识别：今天、昨天、5分钟前等等，如果不能成功识别，则返回None
+        解析结果按输入字符串缓存 相对时间在每次调用时按当前时间计算
+    Args:
+        data:
+
+    Returns:
+
+    """
+    return _local_datetime(data, datetime.datetime.now())
+
+
+def local_datetime_many(data_list: List) -> List:
+    """
+        批量转换 所有数据使用同一个当前时间 相对时间的计算基准一致
+    Args:
+        data_list:
+
+    Returns:
+        与 data_list 一一对应 无法识别的为None
+    """
+    now = datetime.datetime.now()
+    return [_local_datetime(data, now) for data in data_list]
 
 
 def oom_killed_exit():
@@ -0,0 +1,54 @@
+# coding:utf8
+from batch_spider.share.db.db_mysql import MySQLOpt
+from batch_spider.share.db.pool import ConnectionPool
+
+setting_dict = {"host": "127.0.0.1", "port": 3306, "db": "test_connection_pool"}
+
+
+class FakeCursor(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_closed_by_last_owner():
+    pool = ConnectionPool(FakeCursor, max_size=2)
+    assert pool.acquire()
+    assert pool.acquire()
+    assert not pool.release()
+    item = pool.checkout()
+    pool.checkin(item)
+    assert not item.closed
+
+    assert pool.release()
+    assert item.closed
+    assert not pool.acquire()
+
+
+def test_mysql_opt_shares_pool_until_last_close():
+    db = MySQLOpt(setting_dict, pool_size=2)
+    other = MySQLOpt(setting_dict, pool_size=2)
+    _db = db.copy()
+    pool = db._pool
+    assert other._pool is pool and _db._pool is pool
+
+    # 临时对象关闭 不影响其他对象
+    _db.close()
+    other.close()
+    assert not pool._closed
+    assert MySQLOpt.connection_pool_dict[db.key] is pool
+
+    # 重复关闭只释放一次
+    other.close()
+    assert not pool._closed
+
+    db.close()
+    assert pool._closed
+    assert db.key not in MySQLOpt.connection_pool_dict
+
+    # 连接池关闭后新建的对象使用新的连接池
+    new_db = MySQLOpt(setting_dict, pool_size=2)
+    assert new_db._pool is not pool
+    new_db.close()
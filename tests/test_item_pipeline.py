@@ -0,0 +1,64 @@
+# coding:utf8
+import threading
+
+from batch_spider.spiders.pipeline import Item, ItemPipeline
+
+
+class FakeDB(object):
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.copies = []
+        self.data = []
+        self.closed = False
+        self._in_add_many = threading.Lock()
+
+    def copy(self):
+        db = FakeDB(parent=self)
+        self.copies.append(db)
+        return db
+
+    def add_many(self, data, table_name="", **kwargs):
+        # 同一连接不允许并发执行
+        assert self._in_add_many.acquire(blocking=False)
+        try:
+            self.data.extend(data)
+        finally:
+            self._in_add_many.release()
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDBWithoutCopy(object):
+    def add_many(self, data, table_name="", **kwargs):
+        pass
+
+
+def test_each_writer_uses_own_connection():
+    db = FakeDB()
+    pipeline = ItemPipeline(db, flush_size=1, writer_num=3)
+    for i in range(30):
+        pipeline.put(Item({"id": i}, table_name="t"))
+    pipeline.close()
+
+    assert len(db.copies) == 3
+    assert not db.data
+    assert sum(len(x.data) for x in db.copies) == 30
+    assert all(x.closed for x in db.copies)
+    assert not db.closed
+
+
+def test_single_writer_when_db_cannot_copy():
+    pipeline = ItemPipeline(FakeDBWithoutCopy(), writer_num=2)
+    assert pipeline.writer_num == 1
+    assert len(pipeline._writer_threads) == 1
+    pipeline.close()
+
+
+def test_pooled_db_is_shared_by_writers():
+    db = FakeDBWithoutCopy()
+    db.pool_size = 2
+    db.is_pool = True
+    pipeline = ItemPipeline(db, writer_num=2)
+    assert pipeline.writer_num == 2
+    pipeline.close()
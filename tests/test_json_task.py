@@ -0,0 +1,39 @@
+# coding:utf8
+import pytest
+
+from batch_spider.spiders import task_codec
+from batch_spider.spiders.batch_spider import JsonTask
+
+
+def test_copy_nested_mutation_does_not_affect_original():
+    task = JsonTask({"id": 1, "group": [1], "meta": {"a": 1}})
+
+    task.copy().group.append(2)
+    assert task.group == [1]
+
+    JsonTask(task).meta["a"] = 2
+    assert task.meta == {"a": 1}
+
+    task.copy(update={"id": 2}).group.append(3)
+    assert task.group == [1]
+
+    copied = task.copy()
+    task.group.append(4)
+    assert copied.group == [1]
+    assert task.group == [1, 4]
+
+
+def test_dict_nested_mutation_does_not_affect_source():
+    source = {"id": 1, "group": [1]}
+    task = JsonTask(source)
+    task.group.append(2)
+    assert source["group"] == [1]
+    assert task.to_json() == '{"id": 1, "group": [1, 2]}'
+
+
+def test_from_dict_rejects_non_dict():
+    for data in [b"[1,2]", b'"abc"', b"123"]:
+        with pytest.raises(TypeError):
+            JsonTask.from_dict(task_codec.decode_task(data))
+        with pytest.raises(TypeError):
+            JsonTask(data)
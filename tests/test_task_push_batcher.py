@@ -0,0 +1,58 @@
+# coding:utf8
+import threading
+
+import pytest
+
+from batch_spider.spiders import batch_spider
+from batch_spider.spiders.batch_spider import TaskPushBatcher
+
+
+class LeaderKilled(BaseException):
+    pass
+
+
+class FakePipeline(object):
+    def __init__(self, data):
+        self.data = data
+        self.commands = []
+
+    def lpush(self, key, *values):
+        self.commands.append((key, values))
+
+    def execute(self, raise_on_error=True):
+        result_list = []
+        for key, values in self.commands:
+            self.data.setdefault(key, [])[0:0] = reversed(values)
+            result_list.append(len(self.data[key]))
+        return result_list
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self.data)
+
+
+def test_lpush_after_leader_killed(monkeypatch):
+    redis_conn = FakeRedis()
+    batcher = TaskPushBatcher(redis_conn, interval=0.01)
+
+    # 模拟leader在等待合并时被kill
+    def killed_sleep(seconds):
+        raise LeaderKilled()
+
+    monkeypatch.setattr(batch_spider.time, "sleep", killed_sleep)
+    with pytest.raises(LeaderKilled):
+        batcher.lpush("task", ["a"])
+    monkeypatch.undo()
+
+    # 已入队的任务仍然写入 后续调用不会一直等待
+    assert redis_conn.data["task"] == ["a"]
+    result = []
+    thread = threading.Thread(target=lambda: result.append(batcher.lpush("task", ["b"])))
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert result == [2]